@@ -0,0 +1,486 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 KenV99
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import math
+import threading
+import json
+import platform
+import argparse
+from cPickle import dumps, loads
+
+if 'win' in sys.platform:
+    isKodi = 'xbmc' in sys.executable.lower() or 'kodi' in sys.executable.lower()
+else:
+    isKodi = True
+headless = not isKodi
+if isKodi:
+    try:
+        import xbmc
+    except ImportError:
+        # Headless run, eg from the command line on Linux: stand in for Kodi's modules
+        from resources.lib.xbmcdummy import install
+        headless = install()
+        import xbmc
+    import xbmcaddon
+
+    # ensure aceess to required script.module. Currently an issue in Helix Betas
+    path_to_required_modules = os.path.join(xbmcaddon.Addon('script.module.ipc').getAddonInfo('path'), 'lib')
+    if path_to_required_modules not in sys.path:
+        sys.path.insert(0, path_to_required_modules)
+
+# required modules outside local path
+from ipc.ipcserver import IPCServer
+import pyro4
+
+# required modules that should be in local path
+from resources.lib.ipcclientx import IPCClientX
+from resources.lib.ipcclientxasync import AsyncIPCClientX
+from resources.lib.datastore import DataObjects, DataObjectX, DataIO
+
+AUTHOR = 'benchmarks.ipcdatastore'
+
+
+def log(msg):
+    if isKodi:
+        xbmc.log('*&*&*&*& ipcdatastore benchmark: {0}'.format(msg))
+    else:
+        print msg
+
+
+def opspersec(func, count):
+    start = time.time()
+    for i in xrange(count):
+        func(i)
+    elapsed = time.time() - start
+    return count / elapsed if elapsed > 0 else float('inf')
+
+
+def bench_connection_pool(client, count=2000):
+    """
+    Compares set/get throughput when a new proxy is built for every call against kept-alive pooled proxies.
+
+    """
+    results = {}
+    client.set('x', 20, author=AUTHOR)
+    for pooled in (False, True):
+        client.use_connection_pool = pooled
+        label = 'pooled' if pooled else 'per-call'
+        results[label] = {
+            'set': opspersec(lambda i: client.set('x', i, author=AUTHOR), count),
+            'get': opspersec(lambda i: client.get('x', author=AUTHOR, requestor='benchmarks'), count),
+        }
+        log('{0:>10}: set {1:10.1f} ops/sec, get {2:10.1f} ops/sec'.format(label, results[label]['set'],
+                                                                         results[label]['get']))
+    client.use_connection_pool = True
+    client.proxypool.closeall()
+    return results
+
+
+def bench_concurrency(port, threadcounts=(1, 2, 4, 8), count=500):
+    """
+    Measures aggregate set+get throughput against the server as the number of client threads grows.
+
+    """
+    results = {}
+    for numthreads in threadcounts:
+        def worker(n):
+            c = IPCClientX(port=port)
+            for i in xrange(count):
+                c.set('t{0}'.format(n), i, author=AUTHOR)
+                c.get('t{0}'.format(n), author=AUTHOR)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(numthreads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        results[numthreads] = 2 * count * numthreads / elapsed
+        log('{0:>3} client threads: {1:10.1f} ops/sec'.format(numthreads, results[numthreads]))
+    return results
+
+
+def valueshapes():
+    """
+    Values shaped like what add-ons store: a small dict, a list of media info records, a large block of repetitive
+    text and incompressible bytes.
+
+    """
+    return {
+        'small dict': {'title': 'Big Buck Bunny', 'year': 2008, 'playcount': 3},
+        'records': [{'file': 'smb://nas/movies/{0}.mkv'.format(i), 'title': 'Movie {0}'.format(i), 'runtime': 5400 + i,
+                     'streams': [{'codec': 'h264', 'width': 1920, 'height': 1080}]} for i in xrange(500)],
+        'text': 'The quick brown fox jumps over the lazy dog. ' * 5000,
+        'random': os.urandom(256 * 1024),
+    }
+
+
+def bench_codecs(count=5, levels=(1, 6, 9)):
+    """
+    Compares save and restore time and file size of DataIO.savepickle/restorepickle across codecs, levels and value
+    shapes.
+
+    """
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'bench.p')
+        for shape, value in sorted(valueshapes().items()):
+            for codec in sorted(DataIO.CODECS):
+                for level in (levels if codec != 'none' else (0,)):
+                    start = time.time()
+                    for i in xrange(count):
+                        DataIO.savepickle(fn, value, codec=codec, level=level)
+                    save = (time.time() - start) / count
+                    start = time.time()
+                    for i in xrange(count):
+                        DataIO.restorepickle(fn)
+                    restore = (time.time() - start) / count
+                    size = os.path.getsize('{0}.gz'.format(fn))
+                    results[(shape, codec, level)] = {'save': save, 'restore': restore, 'size': size}
+                    log('{0:>10} {1:>5} {2}: save {3:8.2f} ms, restore {4:8.2f} ms, {5:9d} bytes'.format(
+                        shape, codec, level, save * 1000, restore * 1000, size))
+    finally:
+        shutil.rmtree(tmpdir, True)
+    return results
+
+
+class LegacyRecord(object):
+    """
+    A record laid out like the DataObjectX of earlier versions, with a per-instance dict and requestors dict.
+
+    """
+    def __init__(self, value):
+        self.ts = time.time()
+        self.value = value
+        self.requestors = {}
+        self.persist = False
+        self.expires = None
+        self.size = DataObjectX.sizeof(value)
+
+
+class LegacyDataObject(object):
+    """
+    The object earlier versions built for every get to send (value, ts) to the client.
+
+    """
+    def __init__(self, dox):
+        self.ts = dox.ts
+        self.value = dox.value
+
+
+def rss():
+    """
+    :return: The resident set size of the process in bytes, or None where it cannot be read
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def bench_records(count=100000):
+    """
+    Compares the memory taken by count stored records laid out as in earlier versions against the slotted
+    DataObjectX, both as the growth of the resident set size and as the size of the record objects themselves.
+
+    """
+    results = {}
+    # Slotted first: memory freed by the first run is reused by the second, which can only flatter the legacy layout
+    for label, factory in (('slotted', DataObjectX), ('legacy', LegacyRecord)):
+        before = rss()
+        records = dict((('bench', str(i)), factory(i)) for i in xrange(count))
+        after = rss()
+        record = records[('bench', '0')]
+        size = sys.getsizeof(record) + sum(sys.getsizeof(x) for x in (getattr(record, '__dict__', None),
+                                                                       record.requestors) if x is not None)
+        results[label] = {'rss': (after - before) if before is not None else None, 'record': size}
+        del records
+        log('{0:>8} records: {1} keys {2:>12} bytes rss, {3:4d} bytes per record'.format(
+            label, count, results[label]['rss'], size))
+    return results
+
+
+def bench_get(client, count=20000):
+    """
+    Measures get throughput: in process, building the legacy per-get object and pickling it against pickling the
+    (value, ts) tuple the server now returns, and over the wire with the client cache disabled.
+
+    """
+    results = {}
+    dos = DataObjects()
+    dos.set('x', {'title': 'Big Buck Bunny', 'year': 2008}, AUTHOR)
+    dox = DataObjectX({'title': 'Big Buck Bunny', 'year': 2008})
+    results['legacy'] = opspersec(lambda i: loads(dumps(LegacyDataObject(dox), -1)), count)
+    results['tuple'] = opspersec(lambda i: loads(dumps(dos.get_if_modified('x', AUTHOR), -1)), count)
+    dos.close()
+    client.set('x', {'title': 'Big Buck Bunny', 'year': 2008}, author=AUTHOR)
+    max_entries = client.cache.max_entries
+    client.cache.max_entries = 0
+    try:
+        results['client'] = opspersec(lambda i: client.get('x', author=AUTHOR), count / 10)
+    finally:
+        client.cache.max_entries = max_entries
+    for label in ('legacy', 'tuple', 'client'):
+        log('{0:>8} get: {1:10.1f} ops/sec'.format(label, results[label]))
+    return results
+
+
+def timeops(func, count):
+    """
+    Calls func(i) count times, timing each call.
+
+    :return: The throughput in ops/sec and the latency of each call in seconds
+    :rtype: tuple (float, list)
+    """
+    samples = []
+    start = time.time()
+    for i in xrange(count):
+        t = time.time()
+        func(i)
+        samples.append(time.time() - t)
+    elapsed = time.time() - start
+    return (count / elapsed if elapsed > 0 else float('inf')), samples
+
+
+def percentile(samples, p):
+    """
+    :return: The nearest-rank p-th percentile of samples, None if there are none
+    :rtype: float
+    """
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, max(0, int(math.ceil(p / 100.0 * len(samples))) - 1))]
+
+
+def record(op, shape, opsps, samples, persist=False, cache=None, clients=1, api='sync'):
+    """
+    :return: One result of the suite, with the latencies in milliseconds
+    :rtype: dict
+    """
+    result = {'op': op, 'shape': shape, 'persist': persist, 'cache': cache, 'clients': clients, 'api': api,
+              'count': len(samples), 'ops_per_sec': opsps, 'p50_ms': percentile(samples, 50) * 1000,
+              'p99_ms': percentile(samples, 99) * 1000}
+    log('{0:>7} {1:>6} persist={2:d} cache={3:<4} clients={4:<2} {5:<5}: {6:10.1f} ops/sec, p50 {7:8.3f} ms, '
+        'p99 {8:8.3f} ms'.format(op, shape, persist, cache or '-', clients, api, opsps, result['p50_ms'],
+                                 result['p99_ms']))
+    return result
+
+
+def suiteshapes():
+    """
+    The value sizes the suite runs with: a small scalar, a dict of about 1 KB pickled and a 1 MB str, which travels
+    as a shared memory file. Each comes with the divisor applied to the number of operations.
+
+    """
+    return [
+        ('scalar', 42, 1),
+        ('dict1k', dict(('field{0:02d}'.format(i), 'v' * 20) for i in xrange(32)), 1),
+        ('blob1m', os.urandom(1024 * 1024), 50),
+    ]
+
+
+def bench_ops(client, count=1000):
+    """
+    Measures set, get and delete for each of the suite's value sizes: sets and deletes with persistence off and on,
+    gets served from the client cache (the server answers that the cached copy is current) and gets with the cache
+    disabled, which transfer the value every time.
+
+    """
+    results = []
+    max_entries = client.cache.max_entries
+    try:
+        for shape, value, divisor in suiteshapes():
+            n = max(1, count / divisor)
+            for persist in (False, True):
+                opsps, samples = timeops(lambda i: client.set(shape, value, author=AUTHOR, persist=persist), n)
+                results.append(record('set', shape, opsps, samples, persist=persist))
+            client.set(shape, value, author=AUTHOR)
+            client.cache.max_entries = 0
+            opsps, samples = timeops(lambda i: client.get(shape, author=AUTHOR), n)
+            results.append(record('get', shape, opsps, samples, cache='miss'))
+            client.cache.max_entries = max_entries
+            client.get(shape, author=AUTHOR)
+            opsps, samples = timeops(lambda i: client.get(shape, author=AUTHOR), n)
+            results.append(record('get', shape, opsps, samples, cache='hit'))
+            for persist in (False, True):
+                names = ['{0}.{1}'.format(shape, i) for i in xrange(n)]
+                for name in names:
+                    client.set(name, value, author=AUTHOR, persist=persist)
+                opsps, samples = timeops(lambda i: client.delete(names[i], author=AUTHOR), n)
+                results.append(record('delete', shape, opsps, samples, persist=persist))
+            client.delete(shape, author=AUTHOR)
+    finally:
+        client.cache.max_entries = max_entries
+    return results
+
+
+def bench_clients(port, count=1000, maxclients=8):
+    """
+    Measures aggregate set+get throughput and latency of 1 KB dicts with 1, 2, 4... up to maxclients concurrent
+    clients, each in its own thread with its own IPCClientX.
+
+    """
+    results = []
+    value = suiteshapes()[1][1]
+    numclients = 1
+    while True:
+        samples = [[] for n in xrange(numclients)]
+
+        def worker(n):
+            c = IPCClientX(port=port)
+            name = 'client{0}'.format(n)
+            for i in xrange(count):
+                t = time.time()
+                if i % 2:
+                    c.get(name, author=AUTHOR)
+                else:
+                    c.set(name, value, author=AUTHOR)
+                samples[n].append(time.time() - t)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(numclients)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        results.append(record('set+get', 'dict1k', count * numclients / elapsed, sum(samples, []),
+                              clients=numclients))
+        if numclients >= maxclients:
+            break
+        numclients = min(numclients * 2, maxclients)
+    return results
+
+
+def bench_async(port, count=1000, maxclients=8):
+    """
+    Measures the same set+get mix as bench_clients through one AsyncIPCClientX with 1, 2, 4... up to maxclients
+    connections, all the calls submitted at once from a single thread. The latencies run from submitting a call to
+    its result being ready, so include the time spent queued.
+
+    """
+    results = []
+    value = suiteshapes()[1][1]
+    numclients = 1
+    while True:
+        client = AsyncIPCClientX(port=port, max_connections=numclients, max_pending=count * numclients)
+        samples = []
+        pending = []
+        start = time.time()
+        for i in xrange(count * numclients):
+            name = 'client{0}'.format(i % numclients)
+            t = time.time()
+            if (i / numclients) % 2:
+                result = client.get(name, author=AUTHOR)
+            else:
+                result = client.set(name, value, author=AUTHOR)
+            pending.append(result.then(lambda v, t=t: samples.append(time.time() - t)))
+        client.gather(pending)
+        elapsed = time.time() - start
+        client.close()
+        results.append(record('set+get', 'dict1k', count * numclients / elapsed, samples, clients=numclients,
+                              api='async'))
+        if numclients >= maxclients:
+            break
+        numclients = min(numclients * 2, maxclients)
+    return results
+
+
+def runsuite(port=9098, count=1000, maxclients=8, fn=None):
+    """
+    Runs the headless suite against a server started here, with a temporary persistence directory, and returns the
+    results, also written to fn as JSON if given. Outside of Kodi, script.module.ipc is looked up in the directory
+    given by the KODI_ADDONS environment variable (see resources.lib.xbmcdummy).
+
+    :return: The run's parameters under 'meta' and a list of results under 'results', or None if the server could
+             not be started
+    :rtype: dict
+    """
+    persist_dir = tempfile.mkdtemp()
+    dos = DataObjects(persist_dir=persist_dir)
+    server = IPCServer(dos, port=port)
+    server.start()
+    time.sleep(2)
+    try:
+        client = IPCClientX(port=port)
+        if not client.server_available():
+            log('Server down and could not be started')
+            return None
+        results = bench_ops(client, count) + bench_clients(port, count, maxclients) + bench_async(port, count,
+                                                                                               maxclients)
+    finally:
+        server.stop()
+        dos.close()
+        shutil.rmtree(persist_dir, True)
+    results = {
+        'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                 'platform': platform.platform(), 'pyro4': getattr(pyro4, '__version__', None), 'count': count,
+                 'maxclients': maxclients, 'headless': headless},
+        'results': results,
+    }
+    if fn is not None:
+        with open(fn, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def runbenchmarks(port=9098):
+    server = IPCServer(DataObjects(), port=port)
+    server.start()
+    time.sleep(2)
+    client = IPCClientX(port=port)
+    if not client.server_available():
+        log('Server down and could not be started')
+        return
+    try:
+        bench_connection_pool(client)
+        bench_concurrency(port)
+        bench_codecs()
+        bench_records()
+        bench_get(client)
+    finally:
+        server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for service.ipcdatastore')
+    parser.add_argument('--suite', action='store_true', help='run the headless suite instead of the benchmarks')
+    parser.add_argument('--json', metavar='FILE', help='write the results of the suite to FILE (implies --suite)')
+    parser.add_argument('--count', type=int, default=1000, help='operations per measurement (default 1000)')
+    parser.add_argument('--clients', type=int, default=8, help='the most concurrent clients (default 8)')
+    parser.add_argument('--port', type=int, default=9098, help='the port of the server started (default 9098)')
+    args = parser.parse_args(argv)
+    if args.suite or args.json:
+        runsuite(args.port, args.count, args.clients, args.json)
+    else:
+        runbenchmarks(args.port)
+
+
+if __name__ == '__main__':
+    main()
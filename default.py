@@ -19,6 +19,7 @@
 
 import sys
 import os
+import time
 import threading
 
 import xbmc
@@ -46,6 +47,7 @@ from resources.lib.ipcclientx import IPCClientX
 from resources.lib.mediainfofromlog import get_log_mediainfo
 
 myserver = None
+mydatastore = None
 
 
 def serverstart():
@@ -53,10 +55,18 @@ def serverstart():
     #    blocking and allow us to call in to stop thread during abort by holding a reference to the server daemon
     #    without doing this, an error is generated in the kodi logfile. The method of polling xbmc.abortrequested
     #    will likely be changed in the Helix final release.
-    global myserver
-    myserver = IPCServer(DataObjects(persist_dir=
-                                     xbmc.translatePath('special://masterprofile/addon_data/service.ipcdatastore')),
-                                     add_on_id='service.ipcdatastore')
+    global myserver, mydatastore
+    try:
+        budget = int(xbmcaddon.Addon().getSetting('memory_budget')) * 1024 * 1024 or None
+    except ValueError:
+        budget = None
+    try:
+        interval = int(xbmcaddon.Addon().getSetting('stats_interval')) * 60 or None
+    except ValueError:
+        interval = None
+    mydatastore = DataObjects(persist_dir=xbmc.translatePath('special://masterprofile/addon_data/service.ipcdatastore'),
+                              memory_budget=budget, stats_interval=interval, stats_log=xbmc.log)
+    myserver = IPCServer(mydatastore, add_on_id='service.ipcdatastore')
     xbmc.log('*&*&*&*& ipcdatastore: Attempting to start server on {0}:{1}'.format(myserver.host, myserver.port))
     myserver.start()
 
@@ -115,22 +125,24 @@ class PlayerClient(xbmc.Player):
     def onPlayBackStarted(self):
         self.playingfile = self.getPlayingFile()
         client = IPCClientX(addon_id='service.ipcdatastore')
+        # Wait on the server for the data rather than polling: returns as soon as PlayerServer sets it. The value is
+        # None between videos, so keep waiting for a newer version until the timeout expires.
         data = None
-        numchecks = 8
-        while numchecks > 0:
-            data = client.get('videodata', author='service.ipcdatastore')
-            if data is None:
-                xbmc.sleep(500)
-                numchecks -= 1
-            else:
+        ts = None
+        deadline = time.time() + 4.0
+        while data is None and time.time() < deadline:
+            nt = client.wait_for('videodata', author='service.ipcdatastore', newer_than=ts,
+                                 timeout=deadline - time.time(), return_tuple=True)
+            if nt.ts is None:
                 break
+            data = nt.value
+            ts = nt.ts
         dialog = xbmcgui.Dialog()
         if isinstance(data, dict):
             msg = '{0}x{1} @ {2}'.format(data['dwidth'], data['dheight'], data['fps'])
             dialog.notification('ipcdatastore', msg, None, 2000, True)
         else:
-            dialog.notification('ipcdatastore', 'Time out error receiving data x {0}'.format(9 - numchecks),
-                                None, 2000, True)
+            dialog.notification('ipcdatastore', 'Time out error receiving data', None, 2000, True)
 
     def onPlayBackResumed(self):
         if self.playingfile != self.getPlayingFile():
@@ -182,6 +194,9 @@ def main():
     #  If this occurs, you may not be able to restart kodi without manually terminating the orphaned process.
     if myserver is not None:
         myserver.stop()
+    #  Writes out the persistence log and the bulk persistent data
+    if mydatastore is not None:
+        mydatastore.close()
     if myserver.running is False:
         xbmc.log('*&*&*&*& ipcdatastore: IPC Server Stopped')
 
@@ -21,10 +21,31 @@ import os
 import sys
 import time
 import stat
-import gzip
-from cPickle import dump, load
+import errno
+import shutil
+import tempfile
+from cPickle import dumps, loads
 import re
+import struct
+import zlib
+import heapq
+import math
+import functools
+import bisect
+import fnmatch
+import itertools
+import copy_reg
 import threading
+import weakref
+import Queue
+from collections import OrderedDict, deque
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 if 'win' in sys.platform:
     isKodi = 'xbmc' in sys.executable.lower() or 'kodi' in sys.executable.lower()
@@ -32,6 +53,7 @@ else:
     isKodi = True
 
 if isKodi:
+    import xbmc
     import xbmcaddon
 
     path_to_required_modules = os.path.join(xbmcaddon.Addon('script.module.ipc').getAddonInfo('path'), 'lib')
@@ -46,39 +68,142 @@ IPCERROR_USE_CACHED_COPY = 2
 IPCERROR_SERVER_TIMEOUT = 3
 IPCERROR_CONNECTION_CLOSED = 4
 IPCERROR_NONSERIALIZABLE = 5
+IPCERROR_WAIT_TIMEOUT = 8
+IPCERROR_STREAM_NOT_FOUND = 9
+IPCERROR_NOT_STREAMABLE = 10
+IPCERROR_UPDATE_FAILED = 11
+IPCERROR_CONFLICT = 12
+
+__tslock = threading.Lock()
+__lastts = [0.0]
+
+
+def timestamp():
+    """
+    Returns the current time as a float, made strictly increasing so that two values stored within the resolution of
+    the system clock still get different timestamps. The timestamp is used as the version of a stored value.
+
+    :rtype: float
+    """
+    with __tslock:
+        ts = time.time()
+        if ts <= __lastts[0]:
+            ts = __lastts[0] + 1e-6
+        __lastts[0] = ts
+        return ts
 
 
 class DataIO(object):
+    """
+    File input and output for the datastore. Pickled data written to disk goes through :func:`compress` which prefixes
+    it with one byte naming the codec, so data written with any codec can be read back whatever the current setting.
+    CODEC and LEVEL choose the codec and its compression level ('none', 'zlib', 'gzip' and 'lzma' if the lzma module
+    is available); data shorter than THRESHOLD bytes is stored uncompressed.
+    """
     DEFAULT_DIR_MOD = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
     DEFAULT_FILE_MOD = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH
+    CODEC = 'zlib'
+    LEVEL = 6
+    THRESHOLD = 1024
+    GZIP_MAGIC = '\x1f\x8b'
+    CODECS = {
+        # name: (header byte, compress(data, level), decompress(data))
+        'none': ('\x00', lambda data, level: data, lambda data: data),
+        'zlib': ('\x01', lambda data, level: zlib.compress(data, level), zlib.decompress),
+        'gzip': ('\x02', lambda data, level: DataIO.gzipcompress(data, level), lambda data: zlib.decompress(data, 31)),
+    }
+    if lzma is not None:
+        CODECS['lzma'] = ('\x03', lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+    HEADERS = dict([(codec[0], codec[2]) for codec in CODECS.values()])
 
     def __init__(self):
         pass
 
     @staticmethod
-    def savepicklethread(fn, obj):
-        t = threading.Thread(target=DataIO.savepickle, args=(fn,obj))
-        t.start()
+    def gzipcompress(data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def compress(data, codec=None, level=None, threshold=None):
+        """
+        :param data: The data to compress
+        :type data: str
+        :param codec: *Optional*. The name of the codec, defaults to DataIO.CODEC
+        :type codec: str
+        :param level: *Optional*. The compression level, defaults to DataIO.LEVEL
+        :type level: int
+        :param threshold: *Optional*. Data shorter than this is not compressed, defaults to DataIO.THRESHOLD
+        :type threshold: int
+        :return: The header byte of the codec followed by the compressed data
+        :rtype: str
+        """
+        if codec is None:
+            codec = DataIO.CODEC
+        if level is None:
+            level = DataIO.LEVEL
+        if threshold is None:
+            threshold = DataIO.THRESHOLD
+        if len(data) < threshold:
+            codec = 'none'
+        header, compress = DataIO.CODECS[codec][0:2]
+        return header + compress(data, level)
+
+    @staticmethod
+    def decompress(data):
+        """
+        Reverses :func:`compress`.
+        """
+        try:
+            decompress = DataIO.HEADERS[data[0]]
+        except (KeyError, IndexError):
+            raise ValueError('Unknown codec')
+        return decompress(data[1:])
 
     @staticmethod
-    def savepickle(fn, obj):
+    def savepickle(fn, obj, codec=None, level=None):
+        """
+        Writes obj to a temporary file which is synced to disk and then renamed over fn, so fn always holds either the
+        old or the new complete data.
+
+        :param fn: Filename without the .gz extension
+        :type fn: str
+        :param codec: *Optional*. See :func:`compress`
+        :type codec: str
+        :param level: *Optional*. See :func:`compress`
+        :type level: int
+        :return: True on success, False on failure
+        :rtype: bool
+        """
         try:
             fn = '{0}.gz'.format(fn)
+            tmpfn = '{0}.tmp'.format(fn)
             path = os.path.dirname(fn)
             os.chmod(path, DataIO.DEFAULT_DIR_MOD)
-            output = gzip.open(fn, 'wb')
-            dump(obj, output, -1)
-            output.close()
+            with open(tmpfn, 'wb') as f:
+                f.write(DataIO.compress(dumps(obj, -1), codec, level))
+                f.flush()
+                os.fsync(f.fileno())
+            DataIO.rename(tmpfn, fn)
             os.chmod(fn, DataIO.DEFAULT_FILE_MOD)
             return True
         except:
             return False
 
+    @staticmethod
+    def rename(src, dst):
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # Windows does not rename over an existing file
+            os.remove(dst)
+            os.rename(src, dst)
+
     @staticmethod
     def restorepickle(fn):
         """
 
-        :param fn: Filename.
+        :param fn: Filename without the .gz extension. Files written by earlier versions with gzip are recognised.
         :type fn: str
         :return:
         :rtype: list or dict or DataObject or None
@@ -90,9 +215,12 @@ class DataIO(object):
             path = os.path.dirname(fn)
             os.chmod(path, DataIO.DEFAULT_DIR_MOD)
             os.chmod(fn, DataIO.DEFAULT_FILE_MOD)
-            inputf = gzip.open(fn, 'rb')
-            restore = load(inputf)
-            inputf.close()
+            with open(fn, 'rb') as inputf:
+                data = inputf.read()
+            if data[0:2] == DataIO.GZIP_MAGIC:
+                restore = loads(zlib.decompress(data, 31))
+            else:
+                restore = loads(DataIO.decompress(data))
         except:
             return None
         else:
@@ -124,39 +252,48 @@ class DataIO(object):
         return match.group('author'), match.group('varname')
 
     @staticmethod
-    def savepersist_bu(varname, author, pdir, do):
-        sfn = '@{0}~{1}.p'.format(author, varname)
-        fn = os.path.join(pdir, sfn)
-        DataIO.savepicklethread(fn, do)
-
-    @staticmethod
-    def restorepersist_bu(varname, author, pdir, odict):  # I don't think this is being used - restores one item from bu
-        sfn = '@{0}~{1}.p'.format(author, varname)
-        fn = os.path.join(pdir, sfn)
-        do = DataIO.restorepickle(fn)
-        dox = DataObjectX(do.value, persist=True)
-        dox.ts = do.ts
-        idx = (str(author), str(varname))
-        odict[idx] = dox
-        return odict
+    def persistentcopy(odict):
+        """
+        Cheap enough to call holding the item locks: values kept in a :class:`SharedBlob` are only opened, they are
+        read when the copy is saved.
 
-    @staticmethod
-    def savepersist(dos_state, pdir, odict):
-        persist = [dos_state]
+        :return: A dict of (ts, value, expires) for the items tagged for persistence in odict
+        :rtype: dict
+        """
         pdict = {}
         for key in odict:
             wt = odict[key]
             if wt.persist is True:
-                do = DataObject(wt)
-                pdict[key] = do
-        persist.append(pdict)
-        fn = os.path.join(pdir, 'persist.p')
-        DataIO.savepickle(fn, persist)
-        if dos_state == DataObjects.STATE_CLOSED:
-            DataIO.cleanbus(pdir)
+                value = wt.value
+                if isinstance(value, SharedBlob):
+                    value = value.pin()
+                pdict[key] = (wt.ts, value, wt.expires)
+        return pdict
+
+    @staticmethod
+    def savepersist(pdir, odict=None, pdict=None):
+        """
+        Writes a snapshot of the persistent data (see :class:`Snapshot`).
+
+        :param pdir: The persistence directory
+        :type pdir: str
+        :param odict: The datastore dict, only the items tagged for persistence are saved
+        :type odict: dict
+        :param pdict: Alternatively, the result of :func:`persistentcopy`
+        :type pdict: dict
+        :return: True on success, False on failure
+        :rtype: bool
+        """
+        if pdict is None:
+            try:
+                pdict = DataIO.persistentcopy(odict)
+            except Exception:  # a restored value that cannot be read from the old snapshot
+                return False
+        return Snapshot.save(os.path.join(pdir, Snapshot.FILENAME), pdict)
 
     @staticmethod
     def restorefrombu(pdir, odict):
+        # Per item backup files written by versions before the persistence log (see DataLog)
         for fn in os.listdir(pdir):
             if fn[0] == '@':
                 idx = DataIO.idxfromfn(fn)
@@ -167,132 +304,2145 @@ class DataIO(object):
                     dox = DataObjectX(do.value, persist=True)
                     dox.ts = do.ts
                     odict[idx] = dox
-        DataIO.cleanbus(pdir)
         return odict
 
-    @staticmethod
-    def restorepersist(pdir, odict):
-        fn = os.path.join(pdir, 'persist.p')
-        if os.path.exists("{0}.gz".format(fn)):
-            persist = DataIO.restorepickle(fn)
-            if persist:
-                last_saved_state = persist[0]
-                pdict = persist[1]
-                if last_saved_state == DataObjects.STATE_OPENED:
-                    return DataIO.restorefrombu(pdir, odict)
-                else:
-                    for key in pdict:
-                        wt = pdict[key]
-                        dox = DataObjectX(wt.value, True)
-                        dox.ts = wt.ts
-                        odict[key] = dox
-                return odict
-            else:
-                return DataIO.restorefrombu(pdir, odict)
-        else:
-            return DataIO.restorefrombu(pdir, odict)
+    @staticmethod
+    def restorepersist(pdir, odict):
+        """
+        Restores the persistent data: the key index of the snapshot is read, with the values left on disk until they
+        are first accessed (see :class:`LazyDataObjectX`), and the changes recorded in the persistence log since the
+        snapshot was written are replayed on top of it. If the server did not shut down cleanly, the log holds
+        everything that changed during the session.
+
+        :param pdir: The persistence directory
+        :type pdir: str
+        :param odict: The datastore dict to restore into
+        :type odict: dict
+        :return: The open snapshot the lazy values are read from or None, and whether data in the formats of earlier
+                 versions (persist.p.gz or backup files) was found and should be saved in the current format.
+        :rtype: tuple
+        """
+        snapshot = None
+        legacy = False
+        fn = os.path.join(pdir, Snapshot.FILENAME)
+        if os.path.exists(fn):
+            try:
+                snapshot = Snapshot(fn)
+                for idx, entry in snapshot.index().iteritems():
+                    dox = LazyDataObjectX(snapshot, entry[1], entry[2], entry[0], entry[3],
+                                          entry[4] if len(entry) > 4 else None)
+                    snapshot.items.append(dox)
+                    odict[idx] = dox
+            except Exception:
+                snapshot = None
+        else:
+            fn = os.path.join(pdir, 'persist.p')
+            if os.path.exists("{0}.gz".format(fn)):
+                legacy = True
+                persist = DataIO.restorepickle(fn)
+                if persist:
+                    pdict = persist[1]
+                    for key in pdict:
+                        wt = pdict[key]
+                        dox = DataObjectX(wt.value, True)
+                        dox.ts = wt.ts
+                        odict[key] = dox
+        count = len(odict)
+        DataIO.restorefrombu(pdir, odict)
+        legacy = legacy or len(odict) != count
+        fn = os.path.join(pdir, DataLog.FILENAME)
+        DataLog.replay(DataLog.rotatedname(fn), odict)
+        DataLog.replay(fn, odict)
+        return snapshot, legacy
+
+    @staticmethod
+    def cleanlegacy(pdir):
+        """
+        Removes the persistent data files of earlier versions once their data is in a snapshot.
+        """
+        DataIO.cleanbus(pdir)
+        DataIO.cleanbus(pdir, 'persist.p.gz')
+
+
+class Snapshot(object):
+    """
+    Snapshot of the persistent data (persist.db) with an index, so that the keys can be restored on startup without
+    reading the values::
+
+        MAGIC | pickled value | pickled value | ... | pickled index | index offset (8 bytes) | index length (4 bytes) | MAGIC
+
+    The index is a pickled dict of (author, name) -> (ts, offset, length, expires, size), where size is the size of the
+    value as accounted by :func:`DataObjectX.sizeof` (missing in snapshots of earlier versions). Each pickle goes through
+    :func:`DataIO.compress`. The file is written to a temporary file,
+    synced and renamed into place, so it is always complete.
+    """
+    FILENAME = 'persist.db'
+    MAGIC = 'IPCDS\x01'
+    TRAILER = struct.Struct('!QI')
+
+    def __init__(self, fn):
+        """
+        Opens a snapshot for reading.
+
+        :param fn: The full path of the snapshot
+        :type fn: str
+        """
+        self.fn = fn
+        self.lock = threading.RLock()
+        self.items = []  # the LazyDataObjectX restored from this snapshot
+        self.__file = open(fn, 'rb')
+
+    @staticmethod
+    def save(fn, pdict):
+        """
+        :param fn: The full path of the snapshot
+        :type fn: str
+        :param pdict: dict of (ts, value, expires) keyed by (author, name), see :func:`DataIO.persistentcopy`
+        :type pdict: dict
+        :return: True on success, False on failure
+        :rtype: bool
+        """
+        tmpfn = '{0}.tmp'.format(fn)
+        try:
+            os.chmod(os.path.dirname(fn), DataIO.DEFAULT_DIR_MOD)
+            index = {}
+            with open(tmpfn, 'wb') as f:
+                f.write(Snapshot.MAGIC)
+                offset = len(Snapshot.MAGIC)
+                for key, (ts, value, expires) in pdict.iteritems():
+                    value = SharedBlob.plain(value)
+                    data = DataIO.compress(dumps(value, -1))
+                    f.write(data)
+                    index[key] = (ts, offset, len(data), expires, DataObjectX.sizeof(value))
+                    offset += len(data)
+                data = DataIO.compress(dumps(index, -1))
+                f.write(data)
+                f.write(Snapshot.TRAILER.pack(offset, len(data)))
+                f.write(Snapshot.MAGIC)
+                f.flush()
+                os.fsync(f.fileno())
+            DataIO.rename(tmpfn, fn)
+            os.chmod(fn, DataIO.DEFAULT_FILE_MOD)
+            return True
+        except Exception:
+            return False
+
+    def index(self):
+        """
+        :return: dict of (author, name) -> (ts, offset, length, expires[, size])
+        :rtype: dict
+        """
+        size = len(Snapshot.MAGIC) + Snapshot.TRAILER.size
+        with self.lock:
+            self.__file.seek(-size, os.SEEK_END)
+            trailer = self.__file.read(size)
+            if trailer[Snapshot.TRAILER.size:] != Snapshot.MAGIC:
+                raise ValueError('Not a snapshot: {0}'.format(self.fn))
+            offset, length = Snapshot.TRAILER.unpack(trailer[:Snapshot.TRAILER.size])
+            self.__file.seek(offset)
+            return loads(DataIO.decompress(self.__file.read(length)))
+
+    def load(self, offset, length):
+        """
+        Reads one value.
+        """
+        with self.lock:
+            self.__file.seek(offset)
+            return loads(DataIO.decompress(self.__file.read(length)))
+
+    def warmup(self):
+        """
+        Reads the values of all restored items that have not been accessed yet. The file is closed once every value
+        has been read, so that it can be replaced by the next compaction; if some could not be read, it is left open
+        for those items to be read again when accessed.
+
+        :return: The number of values read and the number that could not be read
+        :rtype: tuple
+        """
+        count = 0
+        failed = 0
+        for dox in self.items:
+            if not dox.loaded:
+                try:
+                    dox.value
+                    count += 1
+                except Exception:
+                    failed += 1
+        if not failed:
+            self.items = []
+            self.close()
+        return count, failed
+
+    def close(self):
+        with self.lock:
+            self.__file.close()
+
+
+class DataLog(object):
+    """
+    Append-only log of the changes to persistent data between two snapshots (see :class:`Snapshot`). Each record is
+    written with a single buffered append as::
+
+        length (4 bytes) | crc32 (4 bytes) | pickle of (op, author, name, ts, value, expires)
+
+    The pickle goes through :func:`DataIO.compress`.
+
+    On startup, :func:`replay() <DataLog.replay>` applies the records in order and stops at the first incomplete or
+    corrupt record, which is what a crash in the middle of an append leaves behind. The log is truncated each time a
+    new snapshot has been written.
+
+    While the server runs, snapshots are written by :class:`Compactor`: the log is first rotated to persist.log.1 at
+    the point the snapshot is taken and the rotated file is removed once the snapshot is safely on disk. Replaying
+    persist.log.1 and then persist.log over either the old or the new snapshot gives the same result, so a crash at
+    any point of the compaction loses nothing.
+    """
+    FILENAME = 'persist.log'
+    OP_SET = 'S'
+    OP_DELETE = 'D'
+    OP_UNPERSIST = 'U'
+    OP_CLEAR = 'C'
+    HEADER = struct.Struct('!II')
+
+    def __init__(self, fn):
+        """
+        :param fn: The full path of the log file
+        :type fn: str
+        """
+        self.fn = fn
+        self.__lock = threading.Lock()
+        self.__file = open(fn, 'ab')
+        os.chmod(fn, DataIO.DEFAULT_FILE_MOD)
+
+    @staticmethod
+    def encode(op, idx, ts=None, value=None, expires=None):
+        payload = DataIO.compress(dumps((op, idx[0], idx[1], ts, value, expires), -1))
+        return DataLog.HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def append(self, op, idx, ts=None, value=None, expires=None):
+        """
+        :param op: One of the DataLog.OP_ constants
+        :type op: str
+        :param idx: The key (author, name)
+        :type idx: tuple
+        :param ts: The timestamp of the value for OP_SET
+        :type ts: float
+        :param value: The value for OP_SET
+        :type value: object
+        :param expires: The expiry time of the value for OP_SET, if it has a time to live
+        :type expires: float
+        :return: True on success, False on failure
+        :rtype: bool
+        """
+        return self.write([(op, idx, ts, value, expires)])
+
+    def write(self, records):
+        """
+        Appends several records with a single write.
+
+        :param records: list of (op, idx, ts, value, expires)
+        :type records: list
+        :return: True on success, False on failure
+        :rtype: bool
+        """
+        data = ''.join([DataLog.encode(*record) for record in records])
+        with self.__lock:
+            try:
+                self.__file.write(data)
+                self.__file.flush()
+                return True
+            except Exception:
+                return False
+
+    def truncate(self):
+        """
+        Empties the log once its records are contained in a snapshot.
+        """
+        with self.__lock:
+            self.__file.close()
+            self.__file = open(self.fn, 'wb')
+            self.discardrotated()
+
+    @staticmethod
+    def rotatedname(fn):
+        return '{0}.1'.format(fn)
+
+    def rotate(self):
+        """
+        Moves the records written so far to the rotated log and starts an empty log. If a rotated log is left over from
+        a compaction whose snapshot could not be written, the records are appended to it.
+        """
+        rfn = DataLog.rotatedname(self.fn)
+        with self.__lock:
+            self.__file.close()
+            if os.path.exists(rfn):
+                with open(self.fn, 'rb') as src, open(rfn, 'ab') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                self.__file = open(self.fn, 'wb')
+            else:
+                os.rename(self.fn, rfn)
+                self.__file = open(self.fn, 'ab')
+                os.chmod(self.fn, DataIO.DEFAULT_FILE_MOD)
+
+    def discardrotated(self):
+        """
+        Removes the rotated log once its records are contained in a snapshot.
+        """
+        rfn = DataLog.rotatedname(self.fn)
+        if os.path.exists(rfn):
+            os.remove(rfn)
+
+    def size(self):
+        """
+        :return: The size in bytes of the log and the rotated log
+        :rtype: int
+        """
+        size = 0
+        for fn in (self.fn, DataLog.rotatedname(self.fn)):
+            if os.path.exists(fn):
+                size += os.path.getsize(fn)
+        return size
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+    @staticmethod
+    def records(fn):
+        """
+        Generator over the valid records in the log file.
+
+        :rtype: tuple (op, author, name, ts, value, expires)
+        """
+        if not os.path.exists(fn):
+            return
+        with open(fn, 'rb') as f:
+            while True:
+                header = f.read(DataLog.HEADER.size)
+                if len(header) < DataLog.HEADER.size:
+                    return
+                length, crc = DataLog.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    return
+                try:
+                    record = loads(DataIO.decompress(payload))
+                except Exception:
+                    return
+                yield record + (None,) * (6 - len(record))  # records without an expiry time
+
+    @staticmethod
+    def replay(fn, odict):
+        """
+        Applies the records of the log file to odict.
+
+        :param fn: The full path of the log file
+        :type fn: str
+        :param odict: The datastore dict of :class:`DataObjectX` keyed by (author, name)
+        :type odict: dict
+        :return: The number of records applied
+        :rtype: int
+        """
+        count = 0
+        for op, author, name, ts, value, expires in DataLog.records(fn):
+            idx = (author, name)
+            if op == DataLog.OP_SET:
+                dox = DataObjectX(value, True)
+                dox.ts = ts
+                dox.expires = expires
+                odict[idx] = dox
+            elif op == DataLog.OP_CLEAR:
+                odict.clear()
+            else:
+                odict.pop(idx, None)
+            count += 1
+        return count
+
+
+class LogWriter(threading.Thread):
+    """
+    Writes the records for a :class:`DataLog` from a single background thread so that calls changing persistent data
+    do not wait on the disk. Pending records are held per key and a newer record replaces an older one that has not
+    been written yet (last write wins), so a key updated many times between two flushes is written once. The pending
+    records are written when FLUSH_SIZE keys are pending or FLUSH_INTERVAL seconds after the first one was queued,
+    whichever comes first. When MAX_PENDING keys are pending, callers queueing a new key block until the writer has
+    caught up.
+    """
+    MAX_PENDING = 4096
+    FLUSH_SIZE = 512
+    FLUSH_INTERVAL = 0.5
+    ROTATE = 'rotate'  # key of the marker queued by rotate()
+
+    def __init__(self, datalog, max_pending=MAX_PENDING, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        """
+        :param datalog: The log the records are written to
+        :type datalog: DataLog
+        :param max_pending: The number of pending keys at which callers block
+        :type max_pending: int
+        :param flush_size: The number of pending keys that triggers a write
+        :type flush_size: int
+        :param flush_interval: The maximum time in seconds a record is held before it is written
+        :type flush_interval: float
+        """
+        super(LogWriter, self).__init__(name='ipcdatastore.LogWriter')
+        self.daemon = True
+        self.log = datalog
+        self.max_pending = max_pending
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.__pending = OrderedDict()  # key -> record, a clear is held under the key None
+        self.__cond = threading.Condition()
+        self.__stopped = False
+        self.__queued = 0  # sequence number of the last record queued
+        self.__written = 0  # sequence number of the last record written
+        self.__flushwanted = 0
+        self.__firstqueued = None
+        self.__blocked = 0  # callers waiting for room in the queue
+        self.__stats = {'queued': 0, 'coalesced': 0, 'written': 0, 'flushes': 0, 'failures': 0, 'blocked': 0,
+                        'flush_latency_last': 0.0, 'flush_latency_max': 0.0, 'flush_latency_total': 0.0,
+                        'compactions': 0, 'compaction_failures': 0, 'compaction_last': 0.0}
+
+    def append(self, op, idx, ts=None, value=None, expires=None):
+        """
+        Queues a record. Arguments as for :func:`DataLog.append`. Values are encoded when they are written, so a value
+        must not be modified in place after it has been queued.
+        """
+        with self.__cond:
+            while len(self.__pending) >= self.max_pending and idx not in self.__pending and not self.__stopped:
+                self.__stats['blocked'] += 1
+                self.__blocked += 1
+                self.__cond.notify_all()
+                self.__cond.wait()
+                self.__blocked -= 1
+            if op == DataLog.OP_CLEAR:
+                rotate = LogWriter.ROTATE in self.__pending
+                self.__stats['coalesced'] += len(self.__pending) - rotate
+                self.__pending.clear()
+                if rotate:
+                    self.__pending[LogWriter.ROTATE] = None
+                key = None
+            else:
+                key = idx
+                if self.__pending.pop(key, None) is not None:
+                    self.__stats['coalesced'] += 1
+            self.__pending[key] = (op, idx, ts, value, expires)
+            self.__queued += 1
+            self.__stats['queued'] += 1
+            if len(self.__pending) == 1:
+                self.__firstqueued = time.time()
+                self.__cond.notify_all()
+            elif len(self.__pending) >= self.flush_size:
+                self.__cond.notify_all()
+
+    def rotate(self):
+        """
+        Queues a marker at which the writer rotates the log (see :func:`DataLog.rotate`). Records queued before the call
+        go to the rotated log, records queued after it to the new log, even if they replace a pending record for the
+        same key.
+        """
+        with self.__cond:
+            self.__pending.pop(LogWriter.ROTATE, None)
+            self.__pending[LogWriter.ROTATE] = None
+            self.__queued += 1
+            self.__flushwanted = self.__queued
+            self.__cond.notify_all()
+
+    def compacted(self, ok, duration):
+        """
+        Called once the snapshot for a rotation has been written. Waits for the rotation and removes the rotated log.
+
+        :param ok: Whether the snapshot was written
+        :type ok: bool
+        :param duration: The time in seconds the compaction took
+        :type duration: float
+        """
+        if ok:
+            self.flush()
+            self.log.discardrotated()
+        with self.__cond:
+            self.__stats['compactions' if ok else 'compaction_failures'] += 1
+            self.__stats['compaction_last'] = duration
+
+    def flush(self):
+        """
+        Blocks until every record queued before the call has been written.
+        """
+        with self.__cond:
+            target = self.__queued
+            self.__flushwanted = target
+            self.__cond.notify_all()
+            while self.__written < target and self.is_alive():
+                self.__cond.wait(0.1)
+
+    def truncate(self):
+        """
+        Writes the pending records and empties the log. See :func:`DataLog.truncate`.
+        """
+        self.flush()
+        self.log.truncate()
+
+    def close(self):
+        """
+        Writes the pending records, stops the thread and closes the log.
+        """
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+        if self.is_alive():
+            self.join()
+        self.log.close()
+
+    def queue_depth(self):
+        """
+        :return: The number of keys waiting to be written
+        :rtype: int
+        """
+        return len(self.__pending)
+
+    def stats(self):
+        """
+        :return: The queue depth and counters of the writer. Latencies are in seconds.
+        :rtype: dict
+        """
+        with self.__cond:
+            ret = dict(self.__stats)
+            ret['queue_depth'] = len(self.__pending)
+            ret['log_size'] = self.log.size()
+            ret['max_pending'] = self.max_pending
+        flushes = ret.pop('flush_latency_total')
+        ret['flush_latency_avg'] = flushes / ret['flushes'] if ret['flushes'] else 0.0
+        return ret
+
+    def run(self):
+        while True:
+            with self.__cond:
+                while not self.__pending and not self.__stopped:
+                    self.__cond.wait()
+                while (self.__pending and not self.__stopped and len(self.__pending) < self.flush_size and
+                       self.__flushwanted <= self.__written and not self.__blocked):
+                    remaining = self.__firstqueued + self.flush_interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+                if not self.__pending:
+                    if self.__stopped:
+                        break
+                    continue
+                batch = self.__pending.values()
+                self.__pending = OrderedDict()
+                seq = self.__queued
+                self.__cond.notify_all()
+            start = time.time()
+            ok = True
+            records = []
+            for record in batch:
+                if record is None:
+                    ok = self.log.write(records) and ok
+                    records = []
+                    try:
+                        self.log.rotate()
+                    except Exception:
+                        ok = False
+                else:
+                    records.append(record)
+            if records:
+                ok = self.log.write(records) and ok
+            latency = time.time() - start
+            with self.__cond:
+                self.__written = seq
+                self.__stats['flushes'] += 1
+                self.__stats['written'] += len(batch)
+                if not ok:
+                    self.__stats['failures'] += 1
+                self.__stats['flush_latency_last'] = latency
+                self.__stats['flush_latency_max'] = max(latency, self.__stats['flush_latency_max'])
+                self.__stats['flush_latency_total'] += latency
+                self.__cond.notify_all()
+
+
+class Compactor(threading.Thread):
+    """
+    Periodically folds the persistence log into a fresh snapshot, so that the time to restore the data on
+    startup and the disk space used stay bounded by the size of the persistent data rather than the number of writes.
+    A compaction runs every INTERVAL seconds when the log is not empty, or sooner when the log grows past MAX_LOG_SIZE
+    bytes.
+    """
+    INTERVAL = 300.0
+    CHECK_INTERVAL = 5.0
+    MAX_LOG_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, compact, logsize, interval=INTERVAL, max_log_size=MAX_LOG_SIZE):
+        """
+        :param compact: Writes a snapshot and truncates the log
+        :type compact: function
+        :param logsize: Returns the current size of the log in bytes
+        :type logsize: function
+        :param interval: The time in seconds between compactions
+        :type interval: float
+        :param max_log_size: The log size in bytes that triggers a compaction
+        :type max_log_size: int
+        """
+        super(Compactor, self).__init__(name='ipcdatastore.Compactor')
+        self.daemon = True
+        self.compact = compact
+        self.logsize = logsize
+        self.interval = interval
+        self.max_log_size = max_log_size
+        self.__stop = threading.Event()
+
+    def stop(self):
+        self.__stop.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        last = time.time()
+        while not self.__stop.wait(min(Compactor.CHECK_INTERVAL, self.interval)):
+            try:
+                size = self.logsize()
+                if size > self.max_log_size or (size > 0 and time.time() - last >= self.interval):
+                    self.compact()
+                    last = time.time()
+            except Exception:
+                pass
+
+
+class StatsLogger(threading.Thread):
+    """
+    Periodically writes the datastore's statistics (see :func:`DataObjects.stats`) to the log: one line for the store
+    and one for each method called since the datastore started.
+    """
+    def __init__(self, stats, interval, log=None):
+        """
+        :param stats: Returns the statistics, or None once the datastore is gone
+        :type stats: function
+        :param interval: The time in seconds between dumps
+        :type interval: float
+        :param log: Writes a line to the log, xbmc.log by default
+        :type log: function
+        """
+        super(StatsLogger, self).__init__(name='ipcdatastore.StatsLogger')
+        self.daemon = True
+        self.stats = stats
+        self.interval = interval
+        self.log = log if log is not None else StatsLogger.defaultlog
+        self.__stop = threading.Event()
+
+    @staticmethod
+    def defaultlog(msg):
+        if isKodi:
+            xbmc.log(msg)
+        else:
+            print msg
+
+    @staticmethod
+    def format(stats):
+        """
+        :return: The statistics as log lines
+        :rtype: list
+        """
+        lines = ['*&*&*&*& ipcdatastore stats: {0} keys ({1} persisted), {2} bytes, log queue {3}, up {4:.0f} s'.format(
+            stats['keys'], stats['persisted_keys'], stats['bytes'], stats['queue_depth'], stats['uptime'])]
+        for name, m in sorted(stats['methods'].iteritems()):
+            lines.append('*&*&*&*& ipcdatastore stats: {0} {1} calls, {2} errors, {3} cached, p50 {4:.3f} ms, '
+                         'p99 {5:.3f} ms, max {6:.3f} ms'.format(name, m['calls'], m['errors'], m['cached'],
+                                                                 m['p50'] * 1000, m['p99'] * 1000, m['max'] * 1000))
+        return lines
+
+    def stop(self):
+        self.__stop.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                stats = self.stats()
+                if stats is None:
+                    return
+                for line in StatsLogger.format(stats):
+                    self.log(line)
+            except Exception:
+                pass
+
+
+class Expirer(threading.Thread):
+    """
+    Removes items whose time to live has run out. Expiry times are kept in a heap, so the thread sleeps until the next
+    one is due rather than scanning the store. An entry for an item that has since been replaced or deleted is dropped
+    when it comes due: the expire function only removes the item if it still carries that expiry time. An expiry time
+    already scheduled for an item is not pushed again, so updates that keep the expiry time do not grow the heap.
+    """
+    def __init__(self, expire):
+        """
+        :param expire: Called with (idx, expires) when an expiry time is due, returns True if the item was removed
+        :type expire: function
+        """
+        super(Expirer, self).__init__(name='ipcdatastore.Expirer')
+        self.daemon = True
+        self.expire = expire
+        self.expired = 0
+        self.__heap = []
+        self.__scheduled = set()  # the (expires, idx) in the heap
+        self.__cond = threading.Condition()
+        self.__stopped = False
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def schedule(self, idx, expires):
+        """
+        :param idx: The key (author, name)
+        :type idx: tuple
+        :param expires: The time at which the item expires
+        :type expires: float
+        """
+        entry = (expires, idx)
+        with self.__cond:
+            if entry in self.__scheduled:
+                return
+            self.__scheduled.add(entry)
+            heapq.heappush(self.__heap, entry)
+            if self.__heap[0][0] == expires:
+                self.__cond.notify()
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+
+    def run(self):
+        while True:
+            with self.__cond:
+                while not self.__stopped:
+                    if not self.__heap:
+                        self.__cond.wait()
+                    else:
+                        wait = self.__heap[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                        self.__cond.wait(wait)
+                if self.__stopped:
+                    break
+                now = time.time()
+                due = []
+                while self.__heap and self.__heap[0][0] <= now:
+                    due.append(heapq.heappop(self.__heap))
+                    self.__scheduled.discard(due[-1])
+            for expires, idx in due:
+                try:
+                    if self.expire(idx, expires):
+                        self.expired += 1
+                except Exception:
+                    pass
+
+
+class Notifier(threading.Thread):
+    """
+    Delivers cache invalidations to subscribed clients (see :func:`DataObjects.subscribe`). Invalidations are queued and
+    sent from this single thread so that a slow or dead client never delays the call that changed the data. Keys queued
+    for the same client while a previous delivery was in progress are sent together.
+    """
+    CALLBACK_TIMEOUT = 5.0
+
+    def __init__(self, ondead):
+        """
+        :param ondead: Called with the callback uri of a client that could not be reached
+        :type ondead: function
+        """
+        super(Notifier, self).__init__(name='ipcdatastore.Notifier')
+        self.daemon = True
+        self.queue = Queue.Queue()
+        self.ondead = ondead
+        self.__proxies = {}
+
+    def notify(self, uri, keys):
+        """
+        :param uri: The callback uri of the client
+        :type uri: str
+        :param keys: list of (author, name) that changed or None for all
+        :type keys: list or None
+        """
+        self.queue.put((uri, keys))
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            pending = {}
+            while item is not None:
+                uri, keys = item
+                if keys is None or (uri in pending and pending[uri] is None):
+                    pending[uri] = None
+                else:
+                    pending.setdefault(uri, set()).update(keys)
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    item = None
+                else:
+                    if item is None:
+                        self.queue.put(None)
+                        break
+            for uri in pending:
+                keys = pending[uri]
+                self.__deliver(uri, None if keys is None else list(keys))
+        for proxy in self.__proxies.values():
+            proxy._pyroRelease()
+
+    def __deliver(self, uri, keys):
+        try:
+            proxy = self.__proxies.get(uri)
+            if proxy is None:
+                proxy = pyro4.Proxy(uri)
+                proxy._pyroTimeout = Notifier.CALLBACK_TIMEOUT
+                proxy._pyroOneway.add('invalidate')
+                self.__proxies[uri] = proxy
+            proxy.invalidate(keys)
+        except Exception:
+            proxy = self.__proxies.pop(uri, None)
+            if proxy is not None:
+                proxy._pyroRelease()
+            self.ondead(uri)
+
+
+class SharedBlob(object):
+    """
+    A large str value kept in a file of the :class:`BlobStore` rather than in the server's memory.
+
+    """
+    __slots__ = ('path', 'length')
+
+    def __init__(self, path, length):
+        """
+        :param path: The path of the file holding the value
+        :type path: str
+        :param length: The length of the value
+        :type length: int
+        """
+        self.path = path
+        self.length = length
+
+    def read(self):
+        """
+        :return: The value
+        :rtype: str
+        """
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def pin(self):
+        """
+        Opens the file so that the value can still be read once the blob has been retired and its file removed.
+
+        :return: The opened blob, or the blob itself if its file is already gone
+        :rtype: PinnedBlob or SharedBlob
+        """
+        try:
+            return PinnedBlob(open(self.path, 'rb'))
+        except (IOError, OSError):
+            return self
+
+    @staticmethod
+    def plain(value):
+        """
+        :return: The value itself for a SharedBlob or PinnedBlob, otherwise value unchanged. Used wherever a value is
+            written to disk.
+        :rtype: object
+        """
+        return value.read() if isinstance(value, (SharedBlob, PinnedBlob)) else value
+
+
+class PinnedBlob(object):
+    """
+    The open file of a :class:`SharedBlob`, see :func:`SharedBlob.pin`.
+
+    """
+    __slots__ = ('f',)
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self):
+        """
+        Reads the value and closes the file.
+
+        :return: The value
+        :rtype: str
+        """
+        try:
+            return self.f.read()
+        finally:
+            self.f.close()
+
+
+class BlobStore(object):
+    """
+    Keeps str values of at least ``threshold`` bytes in files on a memory backed file system (/dev/shm where available)
+    instead of in the server's memory. The server sends clients the path of the file rather than the value and clients
+    on the same host map the file read-only, so that large values such as artwork or library dumps are not pickled
+    through the Pyro socket on every get. Clients on the same host also write large values to the directory
+    themselves (see :func:`DataObjects.set_blob`).
+
+    Files of values that were replaced or deleted are removed GRACE seconds later, giving a client that was just handed
+    the path time to map it. The directory is created on first use and removed by :func:`close`. Its name holds the
+    server's process id, so that directories left behind by a server that did not close are removed by the next one.
+    """
+    THRESHOLD = 256 * 1024
+    GRACE = 10.0
+    PREFIX = 'ipcdatastore-'
+    SUFFIX = '.blob'
+
+    def __init__(self, threshold=THRESHOLD, base=None):
+        """
+        :param threshold: The size in bytes from which str values are kept in files, None to disable
+        :type threshold: int
+        :param base: The directory in which the blob directory is created, by default /dev/shm if it is writable and
+                     otherwise the system temporary directory
+        :type base: str
+        """
+        self.threshold = threshold
+        self.base = base
+        self.directory = None
+        self.__lock = threading.Lock()
+        self.__retired = deque()  # (time retired, path)
+
+    @staticmethod
+    def defaultbase():
+        shm = '/dev/shm'
+        if os.path.isdir(shm) and os.access(shm, os.W_OK):
+            return shm
+        return tempfile.gettempdir()
+
+    def path(self):
+        """
+        :return: The blob directory, created if needed, or None if the store is disabled or it cannot be created
+        :rtype: str
+        """
+        if self.threshold is None:
+            return None
+        with self.__lock:
+            if self.directory is None:
+                base = self.base or BlobStore.defaultbase()
+                BlobStore.removestale(base)
+                try:
+                    self.directory = tempfile.mkdtemp(prefix='{0}{1}-'.format(BlobStore.PREFIX, os.getpid()), dir=base)
+                except (IOError, OSError):
+                    self.threshold = None
+            return self.directory
+
+    @staticmethod
+    def removestale(base):
+        """
+        Removes the blob directories in base of servers that are no longer running. Only where a process can be probed
+        without side effects (not on Windows).
+        """
+        if os.name != 'posix':
+            return
+        try:
+            names = os.listdir(base)
+        except OSError:
+            return
+        for name in names:
+            parts = name.split('-')
+            if not name.startswith(BlobStore.PREFIX) or len(parts) < 3 or not parts[1].isdigit():
+                continue
+            try:
+                os.kill(int(parts[1]), 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    shutil.rmtree(os.path.join(base, name), True)
+
+    def accepts(self, value):
+        """
+        :return: Whether value should be kept in a file
+        :rtype: bool
+        """
+        return self.threshold is not None and isinstance(value, str) and len(value) >= self.threshold
+
+    def create(self, value):
+        """
+        Writes value to a new file.
+
+        :type value: str
+        :return: The blob, or None on failure
+        :rtype: SharedBlob
+        """
+        directory = self.path()
+        if directory is None:
+            return None
+        try:
+            fd, fn = tempfile.mkstemp(suffix=BlobStore.SUFFIX, dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+        except (IOError, OSError):
+            return None
+        return SharedBlob(fn, len(value))
+
+    def adopt(self, name):
+        """
+        Takes over a file a client wrote to the blob directory.
+
+        :param name: The name of the file in the blob directory
+        :type name: str
+        :return: The blob, or None if there is no such file
+        :rtype: SharedBlob
+        """
+        fn = self.owned(os.path.join(self.directory or '', str(name)))
+        if fn is None:
+            return None
+        return SharedBlob(fn, os.path.getsize(fn))
+
+    def owned(self, path):
+        """
+        :return: path if it is an existing file in the blob directory, otherwise None
+        :rtype: str
+        """
+        directory = self.directory
+        if (directory is None or os.path.dirname(path) != directory or not path.endswith(BlobStore.SUFFIX) or
+                not os.path.isfile(path)):
+            return None
+        return path
+
+    def retire(self, blob):
+        """
+        Schedules the file of a value that was replaced or deleted for removal and removes those retired more than
+        GRACE seconds ago.
+
+        :type blob: SharedBlob
+        """
+        now = time.time()
+        with self.__lock:
+            self.__retired.append((now, blob.path))
+            while self.__retired and self.__retired[0][0] < now - BlobStore.GRACE:
+                path = self.__retired.popleft()[1]
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Windows does not remove a file that is still mapped, try again later
+                    if os.path.exists(path):
+                        self.__retired.append((now, path))
+                        break
+
+    def close(self):
+        """
+        Removes the blob directory and every file in it.
+
+        """
+        with self.__lock:
+            directory = self.directory
+            self.directory = None
+            self.__retired.clear()
+        if directory is not None:
+            shutil.rmtree(directory, True)
+
+
+class StreamReader(object):
+    """
+    A str value being read in chunks through :func:`DataObjects.get_stream`. Holds a reference to the value as it was
+    when the stream was opened, so a value replaced meanwhile is still read consistently. Values kept in a
+    :class:`BlobStore` file are read from the file chunk by chunk.
+    """
+    def __init__(self, value, ts, chunk_size):
+        """
+        :param value: The value
+        :type value: str or SharedBlob
+        :param ts: The timestamp of the value
+        :type ts: float
+        :param chunk_size: The size of the chunks
+        :type chunk_size: int
+        """
+        self.ts = ts
+        self.chunk_size = chunk_size
+        self.used = time.time()
+        self.__value = value
+        self.__offset = 0
+        self.__file = None
+        if isinstance(value, SharedBlob):
+            self.length = value.length
+            self.__file = open(value.path, 'rb')  # stays readable if the value is replaced and the file removed
+        else:
+            self.length = len(value)
+
+    def read(self):
+        """
+        :return: The next chunk, or None when the value has been read
+        :rtype: str
+        """
+        self.used = time.time()
+        if self.__offset >= self.length:
+            return None
+        if self.__file is not None:
+            chunk = self.__file.read(self.chunk_size)
+        else:
+            chunk = self.__value[self.__offset:self.__offset + self.chunk_size]
+        self.__offset += len(chunk)
+        return chunk or None
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+class StreamWriter(object):
+    """
+    A str value being written in chunks through :func:`DataObjects.set_stream`. The chunks go straight to a
+    :class:`BlobStore` file when shared memory files are enabled, so the value is never held in the server's memory,
+    and are otherwise joined when the stream is committed.
+    """
+    def __init__(self, idx, persist, ttl, blobs):
+        """
+        :param idx: The key the value is stored under when the stream is committed
+        :type idx: tuple
+        :type persist: bool
+        :type ttl: float
+        :param blobs: The datastore's blob store
+        :type blobs: BlobStore
+        """
+        self.idx = idx
+        self.persist = persist
+        self.ttl = ttl
+        self.used = time.time()
+        self.length = 0
+        self.__chunks = []
+        self.__file = None
+        self.__path = None
+        directory = blobs.path()
+        if directory is not None:
+            try:
+                fd, self.__path = tempfile.mkstemp(suffix=BlobStore.SUFFIX, dir=directory)
+                self.__file = os.fdopen(fd, 'wb')
+            except (IOError, OSError):
+                self.__file = None
+
+    def write(self, chunk):
+        """
+        :type chunk: str
+        """
+        self.used = time.time()
+        chunk = str(chunk)
+        if self.__file is not None:
+            self.__file.write(chunk)
+        else:
+            self.__chunks.append(chunk)
+        self.length += len(chunk)
+
+    def finish(self):
+        """
+        :return: The value written, a :class:`SharedBlob` if it went to a file
+        :rtype: str or SharedBlob
+        """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+            return SharedBlob(self.__path, self.length)
+        value = ''.join(self.__chunks)
+        self.__chunks = []
+        return value
+
+    def close(self):
+        """
+        Discards the value written so far.
+
+        """
+        self.__chunks = []
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+            try:
+                os.remove(self.__path)
+            except OSError:
+                pass
+
+
+class KeyIndex(object):
+    """
+    The keys of the datastore as a sorted list of (author, name), for scans by prefix or pattern with
+    :func:`bisect.bisect_left`. Adding or removing a key only records the change; the sorted list is rebuilt when it
+    is next read, so a burst of sets costs one sort (a merge of the sorted list with the new keys) rather than an
+    insertion into the list for every new key. A rebuilt list is never modified, so readers can walk it without
+    holding a lock. The owner serializes the calls.
+    """
+    def __init__(self, keys=()):
+        """
+        :param keys: The keys to start with
+        :type keys: iterable of tuple
+        """
+        self.__sorted = sorted(keys)
+        self.__added = set()  # keys not in __sorted yet
+        self.__removed = set()  # keys still in __sorted
+
+    def __len__(self):
+        return len(self.__sorted) + len(self.__added) - len(self.__removed)
+
+    def add(self, key):
+        """
+        Records a key that is new to the datastore.
+
+        :type key: tuple
+        """
+        if key in self.__removed:
+            self.__removed.discard(key)
+        else:
+            self.__added.add(key)
+
+    def remove(self, key):
+        """
+        Records a key that was removed from the datastore.
+
+        :type key: tuple
+        """
+        if key in self.__added:
+            self.__added.discard(key)
+        else:
+            self.__removed.add(key)
+
+    def keys(self):
+        """
+        :return: The keys in sorted order. The list must not be modified.
+        :rtype: list
+        """
+        if self.__removed:
+            removed = self.__removed
+            self.__sorted = [key for key in self.__sorted if key not in removed]
+            self.__removed = set()
+        if self.__added:
+            self.__sorted = sorted(self.__sorted + list(self.__added))
+            self.__added = set()
+        return self.__sorted
+
+
+class MethodMetrics(object):
+    """
+    The counters and latency histogram of one method, see :class:`Metrics`.
+    """
+    __slots__ = ('calls', 'errors', 'cached', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cached = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * Metrics.BUCKETS
+
+
+class Metrics(object):
+    """
+    Call counts, error counts and latency histograms of the datastore's methods, recorded by :func:`metered`. The
+    latencies are counted in logarithmic buckets, four to each doubling of the latency in microseconds, so a
+    percentile read from the histogram is at most a quarter above the true value whatever the scale, and recording a
+    call costs the same however many calls were recorded before.
+    """
+    BUCKETS = 4 * 40 + 1  # up to 2**40 microseconds
+
+    def __init__(self):
+        self.started = time.time()
+        self.__methods = {}  # method name -> MethodMetrics
+        self.__lock = threading.Lock()
+        self.calling = threading.local()  # 'active' is set while a metered call is in progress on the thread
+
+    @staticmethod
+    def bucket(seconds):
+        """
+        :return: The index of the histogram bucket counting a latency of seconds
+        :rtype: int
+        """
+        # seconds * 1e6 = mantissa * 2 ** exponent with mantissa in [0.5, 1): bucket 1 + 4 * (exponent - 1) + the
+        # quarter of [0.5, 1) the mantissa falls in
+        mantissa, exponent = math.frexp(seconds * 1e6)
+        if exponent < 1:
+            return 0
+        bucket = exponent * 4 + int(mantissa * 8) - 7
+        return bucket if bucket < Metrics.BUCKETS else Metrics.BUCKETS - 1
+
+    @staticmethod
+    def upper(bucket):
+        """
+        :return: The upper bound in seconds of the latencies counted in bucket
+        :rtype: float
+        """
+        if bucket == 0:
+            return 1e-6
+        exponent, quarter = divmod(bucket - 1, 4)
+        return 2 ** exponent * (1 + (quarter + 1) / 4.0) * 1e-6
+
+    def record(self, name, seconds, error=False, cached=0):
+        """
+        :param name: The method called
+        :type name: str
+        :param seconds: The time the call took
+        :type seconds: float
+        :param error: Whether the call raised or returned an error code
+        :type error: bool
+        :param cached: The number of items answered with IPCERROR_USE_CACHED_COPY
+        :type cached: int
+        """
+        bucket = Metrics.bucket(seconds)
+        with self.__lock:
+            m = self.__methods.get(name)
+            if m is None:
+                m = self.__methods[name] = MethodMetrics()
+            m.calls += 1
+            m.errors += error
+            m.cached += cached
+            m.total += seconds
+            if seconds > m.max:
+                m.max = seconds
+            m.histogram[bucket] += 1
+
+    @staticmethod
+    def percentile(histogram, calls, p):
+        """
+        :return: The upper bound of the bucket holding the p-th percentile of the latencies in histogram
+        :rtype: float
+        """
+        rank = math.ceil(p / 100.0 * calls)
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= rank:
+                return Metrics.upper(bucket)
+        return 0.0
+
+    def snapshot(self):
+        """
+        :return: For each method called: the number of calls, errors and items answered with
+                 IPCERROR_USE_CACHED_COPY, the average, maximum and 50th, 90th and 99th percentile latency in seconds
+                 and the histogram as a list of (upper bound in seconds, count) for the buckets counted in
+        :rtype: dict
+        """
+        with self.__lock:
+            methods = [(name, m.calls, m.errors, m.cached, m.total, m.max, list(m.histogram))
+                       for name, m in self.__methods.iteritems()]
+        ret = {}
+        for name, calls, errors, cached, total, maximum, histogram in methods:
+            ret[name] = {'calls': calls, 'errors': errors, 'cached': cached, 'avg': total / calls, 'max': maximum,
+                         'p50': Metrics.percentile(histogram, calls, 50),
+                         'p90': Metrics.percentile(histogram, calls, 90),
+                         'p99': Metrics.percentile(histogram, calls, 99),
+                         'histogram': [(Metrics.upper(bucket), count) for bucket, count in enumerate(histogram)
+                                       if count]}
+        return ret
+
+    def reset(self):
+        with self.__lock:
+            self.__methods = {}
+        self.started = time.time()
+
+
+def metered(*codes):
+    """
+    Decorator for the methods of :class:`DataObjects` called by the clients: records each call in the datastore's
+    :class:`Metrics`. codes are the IPCERROR_* message codes the method returns. Returning one of them counts as an
+    error, except IPCERROR_USE_CACHED_COPY which counts as an answer to use the cached copy, as does each
+    IPCERROR_USE_CACHED_COPY in the list returned by a batch method. Other results, one byte values included, count as
+    successes. Only the outermost call on a thread is recorded, so that the calls the datastore makes to itself (mget
+    calling get for each key) are not counted twice.
+
+    :param codes: The IPCERROR_* message codes the method returns
+    :type codes: int
+    """
+    cachedcopy = chr(IPCERROR_USE_CACHED_COPY)
+    errors = frozenset(chr(code) for code in codes if code != IPCERROR_USE_CACHED_COPY)
+    batchcached = IPCERROR_USE_CACHED_COPY in codes
+
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            calling = metrics.calling
+            if getattr(calling, 'active', False):
+                return func(self, *args, **kwargs)
+            calling.active = True
+            start = time.time()
+            error = True
+            cached = 0
+            try:
+                ret = func(self, *args, **kwargs)
+                if isinstance(ret, str):
+                    cached = int(batchcached and ret == cachedcopy)
+                    error = ret in errors
+                else:
+                    error = False
+                    if batchcached and isinstance(ret, list):
+                        cached = ret.count(cachedcopy)
+                return ret
+            finally:
+                calling.active = False
+                metrics.record(name, time.time() - start, error, cached)
+        return wrapper
+    return decorator
+
+
+class DataObjectBase(object):
+    """
+    Base class for DataObject and DataObjectX. The records use __slots__ rather than a per-instance dict, which matters
+    when hundreds of thousands of items are stored. The pickled state is a dict of the fields, the same as that of
+    records pickled by earlier versions, so files saved by either can be read by both.
+
+    """
+    __slots__ = ('ts', 'value')
+    STATE = ('ts', 'value')
+
+    def __init__(self):
+        self.ts = None
+        self.value = None
+
+    def __getstate__(self):
+        state = dict((name, getattr(self, name)) for name in self.STATE)
+        state['value'] = SharedBlob.plain(state['value'])
+        return state
+
+    def __setstate__(self, state):
+        self.defaults()
+        for name in self.STATE:
+            if name in state:
+                setattr(self, name, state[name])
+
+    def defaults(self):
+        """
+        Sets the fields a pickled state may lack.
+
+        """
+        self.ts = None
+        self.value = None
+
+
+class DataObject(DataObjectBase):
+    """
+    Class of the objects returned by the server in earlier versions, which are found in the backup files they wrote.
+    Items are now sent over the wire as a (value, ts) tuple.
+
+    """
+    __slots__ = ()
+
+    def __init__(self, dox):
+        """
+        :param dox: *Required*. The stored item
+        :type dox: DataObjectX()
+
+        """
+        super(DataObject, self).__init__()
+        self.ts = dox.ts
+        self.value = dox.value
+
+
+class DataObjectX(DataObjectBase):
+    """
+    Class used to store objects in the datastore. Extends :class:`datastore.DataObjectBase` with the requestors the
+    item was sent to (None until the first get that tracks requestors), whether it persists, its expiry time and the
+    serialized size of the value.
+    """
+    __slots__ = ('requestors', 'persist', 'expires', 'size')
+    STATE = ('ts', 'value', 'requestors', 'persist', 'expires', 'size')
+
+    def __init__(self, value, persist=False, expires=None, size=None):
+        """
+        :param value: The object to be stored
+        :type value: pickleable obj
+        :param expires: The time at which the object expires or None
+        :type expires: float
+        :param size: The size of the value if already known, see :func:`sizeof`
+        :type size: int
+        """
+        super(DataObjectX, self).__init__()
+        self.ts = timestamp()
+        self.value = value
+        self.requestors = None
+        self.persist = persist
+        self.expires = expires
+        self.size = DataObjectX.sizeof(value) if size is None else size
+
+    def defaults(self):
+        super(DataObjectX, self).defaults()
+        self.requestors = None
+        self.persist = False
+        self.expires = None  # objects pickled by earlier versions have no expiry time
+        self.size = 0
+
+    @staticmethod
+    def sizeof(value):
+        """
+        :return: The size in bytes of the value when serialized, used to account for the memory the datastore uses
+        :rtype: int
+        """
+        if isinstance(value, str):
+            return len(value)
+        if isinstance(value, SharedBlob):
+            return value.length
+        try:
+            return len(dumps(value, -1))
+        except Exception:
+            return 0
+
+    def expired(self, now=None):
+        """
+        :return: Whether the time to live of the object has run out
+        :rtype: bool
+        """
+        return self.expires is not None and self.expires <= (time.time() if now is None else now)
+
+    def wire(self):
+        """
+        :return: The (value, ts) tuple sent to clients, or (None, ts, path, length) for a value kept in a
+                 :class:`BlobStore` file
+        :rtype: tuple
+        """
+        value = self.value
+        if isinstance(value, SharedBlob):
+            return None, self.ts, value.path, value.length
+        return value, self.ts
+
+
+class LazyDataObjectX(DataObjectX):
+    """
+    An item restored from the key index of a :class:`Snapshot`. The value is read from the snapshot when it is first
+    accessed or by the warm-up thread started with the datastore, whichever comes first. Pickled as a plain
+    :class:`DataObjectX`.
+    """
+    __slots__ = ('__snapshot', '__offset', '__length', '__loaded', '__value')
+
+    def __init__(self, snapshot, offset, length, ts, expires=None, size=None):
+        """
+        :param snapshot: The open snapshot
+        :type snapshot: Snapshot
+        :param offset: The offset of the pickled value in the snapshot
+        :type offset: int
+        :param length: The length of the pickled value
+        :type length: int
+        :param ts: The timestamp of the value
+        :type ts: float
+        :param expires: The expiry time of the value or None
+        :type expires: float
+        :param size: The size of the value as accounted for live items, see :func:`DataObjectX.sizeof`. The length is
+                     used if not known.
+        :type size: int
+        """
+        super(LazyDataObjectX, self).__init__(None, persist=True, expires=expires, size=0)
+        self.ts = ts
+        self.size = length if size is None else size
+        self.__snapshot = snapshot
+        self.__offset = offset
+        self.__length = length
+        self.__loaded = False
+
+    def __reduce__(self):
+        return copy_reg._reconstructor, (DataObjectX, object, None), self.__getstate__()
+
+    @property
+    def loaded(self):
+        return self.__loaded
+
+    @property
+    def value(self):
+        if not self.__loaded:
+            with self.__snapshot.lock:
+                if not self.__loaded:
+                    self.__value = self.__snapshot.load(self.__offset, self.__length)
+                    self.__loaded = True
+        return self.__value
+
+    @value.setter
+    def value(self, value):
+        self.__value = value
+        self.__loaded = True
+
+
+class DataObjects(object):
+    """
+    The actual datastore object whose methods are exposed via pyro4.proxy
+
+    Pyro's threaded server dispatches calls from many clients at once, so each item is guarded by one of
+    LOCK_STRIPES locks chosen by the hash of its key: calls on different keys rarely contend, while a read-modify-write
+    on one key is atomic. The indexes have their own lock and operations over many keys work on a snapshot of the keys
+    rather than iterating the live dicts.
+    """
+    STATE_OPENED = 'open'
+    STATE_CLOSED = 'closed'
+    MAX_WAIT = 5.0
+    LOCK_STRIPES = 16
+    STREAM_TIMEOUT = 60.0
+    MAX_CHUNK = 1024 * 1024
+    MAX_SCAN = 1000
+    COMMTIMEOUT = 30.0
+    THREADPOOL_SIZE = 32  # one worker per open connection: a client process keeps one (see ipcclientx.ProxyPool)
+    __pyroconfig = None  # the pyro4 settings configure() replaced, put back when the last datastore is closed
+    __pyrousers = 0
+    __pyrolock = threading.Lock()
+
+    def __init__(self, persist_dir=None, memory_budget=None, blob_threshold=BlobStore.THRESHOLD, stats_interval=None,
+                 stats_log=None):
+        """
+        If you desire to allow data to persist between Kodi sessions, the directory to store persistent data
+        is needed at the time of instantiation in order to restore any saved data, if any exists.
+
+        :param persist_dir: the directory where the persistent data is stored
+        :type persist_dir: str
+        :param memory_budget: The size in bytes the stored values may take, measured serialized. When it is exceeded,
+                              the least recently used items that are not tagged for persistence are evicted. None for
+                              no limit.
+        :type memory_budget: int
+        :param blob_threshold: The size in bytes from which str values are kept in shared memory files (see
+                               :class:`BlobStore`). None to keep all values in memory.
+        :type blob_threshold: int
+        :param stats_interval: The time in seconds between dumps of :func:`stats() <DataObjects.stats>` to the log by
+                               a :class:`StatsLogger`. None for no dumps.
+        :type stats_interval: float
+        :param stats_log: Writes a line to the log for the dumps, xbmc.log by default
+        :type stats_log: function
+
+        The datastore is created before the server that exposes it, which picks up the pyro4 configuration set by
+        :func:`configure() <DataObjects.configure>`.
+        """
+        DataObjects.configure()
+        self.persist_dir = persist_dir
+        self.memory_budget = memory_budget
+        self.__blobs = BlobStore(blob_threshold)
+        self.__streams = {}  # stream id -> StreamReader or StreamWriter
+        self.__streamlock = threading.Lock()
+        self.__streamids = itertools.count(1)
+        self.__odict = {}
+        self.__authors = {}  # author -> set of names, so per-author operations do not scan the whole store
+        self.__keyindex = KeyIndex()  # sorted keys, for scan
+        self.__persisted = set()  # keys of the items tagged for persistence
+        self.metrics = Metrics()
+        self.__statslogger = None
+        self.__requested = {}  # requestor -> set of keys, for clearcache
+        self.__used = 0  # total size of the stored values
+        self.__authorsize = {}  # author -> size of the author's values
+        self.__lru = OrderedDict()  # key -> item for the evictable items, least recently used first
+        self.__evicted = [0, 0]  # items, bytes
+        self.__stripes = [threading.RLock() for i in xrange(DataObjects.LOCK_STRIPES)]
+        self.__indexlock = threading.Lock()
+        self.__subscribers = {}  # callback uri -> [set of keys, set of authors, lease expiry]
+        self.__sublock = threading.Lock()
+        self.__notifier = None
+        self.__waitlock = threading.Lock()
+        self.__waiting = {}  # key -> [condition, number of waiters], for the keys wait_for is waiting on
+        self.__expirer = None
+        self.__expirelock = threading.Lock()
+        self.__expiredlazy = 0
+        self.__log = None
+        self.__compactor = None
+        self.__warmup = None
+        self.__startup = {}
+        if self.persist_dir is not None:
+            start = time.time()
+            snapshot, legacy = DataIO.restorepersist(self.persist_dir, self.__odict)
+            for idx, dox in self.__odict.iteritems():
+                self.__authors.setdefault(idx[0], set()).add(idx[1])
+                self.__account(idx, None, dox)
+                self.__schedule(idx, dox)
+            self.__keyindex = KeyIndex(self.__odict)
+            self.__startup['restore_time'] = time.time() - start
+            self.__startup['keys'] = len(self.__odict)
+            self.__log = LogWriter(DataLog(os.path.join(self.persist_dir, DataLog.FILENAME)))
+            self.__log.start()
+            if legacy and DataIO.savepersist(self.persist_dir, self.__odict):
+                self.__log.truncate()
+                DataIO.cleanlegacy(self.persist_dir)
+            if snapshot is not None:
+                self.__warmup = threading.Thread(target=self.__warmupvalues, args=(snapshot,),
+                                                 name='ipcdatastore.Warmup')
+                self.__warmup.daemon = True
+                self.__warmup.start()
+            ref = weakref.ref(self)  # the compactor must not keep the datastore alive
+            self.__compactor = Compactor(lambda: ref() is not None and ref().compact(), self.__log.log.size)
+            self.__compactor.start()
+        if stats_interval:
+            ref = weakref.ref(self)  # the logger must not keep the datastore alive
+            self.__statslogger = StatsLogger(lambda: ref().stats() if ref() is not None else None, stats_interval,
+                                             stats_log)
+            self.__statslogger.start()
+        self.__state = DataObjects.STATE_OPENED
+        self.autosave = True
+
+    @staticmethod
+    def configure():
+        """
+        Sets the pyro4 configuration the server relies on. Pyro4 has no per-daemon configuration and reads these
+        settings while the server runs, so they are set in the server's process for as long as a datastore is open and
+        put back by :func:`unconfigure() <DataObjects.unconfigure>` once the last one is closed. Clients importing this
+        module are not affected.
+
+        Clients keep their connection open between calls (see :class:`ipcclientx.ProxyPool`), so oneway calls such as
+        set() are handled in order on the connection's worker thread, otherwise a get() issued right after a set() can
+        overtake it. Pyro's threaded server dedicates one of its THREADPOOL_SIZE workers to each open connection, so
+        connections left idle for COMMTIMEOUT seconds (unless a timeout is already configured), such as those of a
+        client process that went away without closing them, are closed to give the worker back.
+
+        """
+        with DataObjects.__pyrolock:
+            if DataObjects.__pyrousers == 0:
+                DataObjects.__pyroconfig = (pyro4.config.ONEWAY_THREADED, pyro4.config.COMMTIMEOUT,
+                                            pyro4.config.THREADPOOL_SIZE)
+                pyro4.config.ONEWAY_THREADED = False
+                if not pyro4.config.COMMTIMEOUT:
+                    pyro4.config.COMMTIMEOUT = DataObjects.COMMTIMEOUT
+                pyro4.config.THREADPOOL_SIZE = max(pyro4.config.THREADPOOL_SIZE, DataObjects.THREADPOOL_SIZE)
+            DataObjects.__pyrousers += 1
+
+    @staticmethod
+    def unconfigure():
+        """
+        Undoes a :func:`configure() <DataObjects.configure>`, putting back the process's own pyro4 settings after the
+        last one.
+
+        """
+        with DataObjects.__pyrolock:
+            if DataObjects.__pyrousers == 0:
+                return
+            DataObjects.__pyrousers -= 1
+            if DataObjects.__pyrousers == 0:
+                pyro4.config.ONEWAY_THREADED, pyro4.config.COMMTIMEOUT, pyro4.config.THREADPOOL_SIZE = \
+                    DataObjects.__pyroconfig
+
+    @pyro4.oneway
+    def setautosave(self, val):
+        """
+        If True will save data when object deleted or .close() called
+
+        :param val: True or False
+        :type val: bool
+        """
+        self.autosave = val
+
+    @pyro4.oneway
+    @metered()
+    def set(self, name, value, author, persist=False, ttl=None):
+        """
+        :param name:
+        :type name: str
+        :param value:
+        :type value: object
+        :param author:
+        :type author: str
+        :param persist:
+        :type persist: bool
+        :param ttl: Seconds after which the item expires and is removed, or None to keep it until it is deleted
+        :type ttl: float
+        :returns: Nothing
+        """
+        stored = value
+        if self.__blobs.accepts(value):
+            stored = self.__blobs.create(value) or value
+        self.__set((str(author), str(name)), stored, persist, ttl, value)
+
+    @pyro4.oneway
+    @metered()
+    def set_blob(self, name, filename, author, persist=False, ttl=None):
+        """
+        Stores a large str value that a client on the same host wrote to a file in the directory returned by
+        :func:`blob_dir() <DataObjects.blob_dir>`, so that the value does not travel through the socket. The datastore
+        takes over the file. Ignored if there is no such file.
+
+        :param name:
+        :type name: str
+        :param filename: The name of the file in the blob directory
+        :type filename: str
+        :param author:
+        :type author: str
+        :param persist:
+        :type persist: bool
+        :param ttl: See :func:`set() <DataObjects.set>`
+        :type ttl: float
+        :returns: Nothing
+        """
+        blob = self.__blobs.adopt(filename)
+        if blob is not None:
+            self.__set((str(author), str(name)), blob, persist, ttl)
+
+    @metered()
+    def blob_dir(self):
+        """
+        :return: The directory of the shared memory files (see :class:`BlobStore`), or None if they are disabled
+        :rtype: str
+        """
+        return self.__blobs.path()
+
+    @metered(IPCERROR_NO_VALUE_FOUND)
+    def read_blob(self, path):
+        """
+        Returns the value kept in a shared memory file, for clients that cannot map the file themselves such as those
+        on another host.
+
+        :param path: The path sent in place of the value
+        :type path: str
+        :return: The value or a one byte message code
+        :rtype: str
+        """
+        path = self.__blobs.owned(str(path))
+        if path is None:
+            return chr(IPCERROR_NO_VALUE_FOUND)
+        return SharedBlob(path, 0).read()
+
+    @metered()
+    def set_stream(self, name, author, persist=False, ttl=None):
+        """
+        Opens a stream to store a large str value in chunks with :func:`write_stream() <DataObjects.write_stream>`, so
+        that no single message holds the whole value. The value is stored when the stream is closed with
+        :func:`close_stream() <DataObjects.close_stream>`. Streams left idle for STREAM_TIMEOUT seconds are dropped.
+
+        :param name:
+        :type name: str
+        :param author:
+        :type author: str
+        :param persist:
+        :type persist: bool
+        :param ttl: See :func:`set() <DataObjects.set>`
+        :type ttl: float
+        :return: The stream id
+        :rtype: int
+        """
+        return self.__openstream(StreamWriter((str(author), str(name)), persist, ttl, self.__blobs))
+
+    @metered(IPCERROR_STREAM_NOT_FOUND)
+    def write_stream(self, sid, chunk):
+        """
+        Appends a chunk to a stream opened with :func:`set_stream() <DataObjects.set_stream>`. Not oneway, so that a
+        writer is held back while the server catches up and chunks cannot overtake each other.
 
+        :param sid: The stream id
+        :type sid: int
+        :param chunk:
+        :type chunk: str
+        :return: True or a one byte message code
+        :rtype: bool or str
+        """
+        writer = self.__streamfor(sid, StreamWriter)
+        if writer is None:
+            return chr(IPCERROR_STREAM_NOT_FOUND)
+        writer.write(chunk)
+        return True
 
-class DataObjectBase(object):
-    """
-    Base class for DataObject and DataObjectX
+    @metered(IPCERROR_NO_VALUE_FOUND, IPCERROR_NOT_STREAMABLE)
+    def get_stream(self, name, author, chunk_size=65536):
+        """
+        Opens a stream to read a str value in chunks of chunk_size bytes (at most MAX_CHUNK) with
+        :func:`read_stream() <DataObjects.read_stream>`. The stream reads the value as it was when it was opened.
+        Streams left idle for STREAM_TIMEOUT seconds are dropped.
 
-    """
-    def __init__(self):
-        self.ts = None
-        self.value = None
+        :param name:
+        :type name: str
+        :param author:
+        :type author: str
+        :param chunk_size:
+        :type chunk_size: int
+        :return: The stream id, the timestamp and the length of the value, or a one byte message code
+        :rtype: tuple or str
+        """
+        idx = (str(author), str(name))
+        with self.__lockfor(idx):
+            dox = self.__lookup(idx)
+            if dox is None:
+                return chr(IPCERROR_NO_VALUE_FOUND)
+            value = dox.value
+            if not isinstance(value, (str, SharedBlob)):
+                return chr(IPCERROR_NOT_STREAMABLE)
+            self.__touch(idx)
+            reader = StreamReader(value, dox.ts, max(1, min(int(chunk_size), DataObjects.MAX_CHUNK)))
+        return self.__openstream(reader), reader.ts, reader.length
 
+    @metered(IPCERROR_STREAM_NOT_FOUND)
+    def read_stream(self, sid):
+        """
+        Reads the next chunk of a stream opened with :func:`get_stream() <DataObjects.get_stream>`. The stream is
+        closed once the value has been read.
 
-class DataObject(DataObjectBase):
-    """
-    Class of all objects returned by server. Includes object and timestamp.
+        :param sid: The stream id
+        :type sid: int
+        :return: A list holding the next chunk, empty when the value has been read, or a one byte message code
+        :rtype: list or str
+        """
+        reader = self.__streamfor(sid, StreamReader)
+        if reader is None:
+            return chr(IPCERROR_STREAM_NOT_FOUND)
+        chunk = reader.read()
+        if chunk is None:
+            self.close_stream(sid)
+            return []
+        return [chunk]
 
-    """
-    def __init__(self, dox):
+    @metered(IPCERROR_STREAM_NOT_FOUND)
+    def close_stream(self, sid, commit=True):
         """
-        Requires instance of :class:`datastore.DataObjectX` during instantiation: that is the class actually stored
-        in the datastore dict.
+        Closes a stream. The value written to a stream opened with :func:`set_stream() <DataObjects.set_stream>` is
+        stored if commit is True and discarded otherwise.
 
-        :param dox: *Required*. See above.
-        :type dox: DataObjectX()
+        :param sid: The stream id
+        :type sid: int
+        :param commit:
+        :type commit: bool
+        :return: True or a one byte message code
+        :rtype: bool or str
+        """
+        with self.__streamlock:
+            stream = self.__streams.pop(sid, None)
+        if stream is None:
+            return chr(IPCERROR_STREAM_NOT_FOUND)
+        if isinstance(stream, StreamWriter) and commit is True:
+            self.__set(stream.idx, stream.finish(), stream.persist, stream.ttl)
+        else:
+            stream.close()
+        return True
 
+    def __openstream(self, stream):
+        """
+        Registers a stream, dropping those left idle for STREAM_TIMEOUT seconds, and returns its id.
         """
+        idle = []
+        with self.__streamlock:
+            deadline = time.time() - DataObjects.STREAM_TIMEOUT
+            for sid, other in self.__streams.items():
+                if other.used < deadline:
+                    idle.append(self.__streams.pop(sid))
+            sid = next(self.__streamids)
+            self.__streams[sid] = stream
+        for other in idle:
+            other.close()
+        return sid
 
-        super(DataObject, self).__init__()
-        self.ts = dox.ts
-        self.value = dox.value
+    def __streamfor(self, sid, kind):
+        with self.__streamlock:
+            stream = self.__streams.get(sid)
+        return stream if isinstance(stream, kind) else None
 
+    def __set(self, idx, value, persist, ttl, plain=None):
+        """
+        Stores an item. plain is the value to record in the persistence log if value is a :class:`SharedBlob`; if not
+        given it is read from the blob before the lock is taken.
+        """
+        if persist is True and plain is None and isinstance(value, SharedBlob):
+            plain = value.read()
+        with self.__lockfor(idx):
+            dox = self.__put(idx, value, persist, DataObjects.expiry(ttl), plain)
+        self.__afterset(idx, dox)
 
-class DataObjectX(DataObjectBase):
-    """
-    Class used to store objects in the datastore. Extends :class:`datastore.DataOnject` with a dict of requestors
-    """
-    def __init__(self, value, persist=False):
+    @staticmethod
+    def expiry(ttl):
         """
-        :param value: The object to be stored
-        :type value: pickleable obj
+        :return: The expiry time of an item stored now with the time to live ttl, or None
+        :rtype: float
         """
-        super(DataObjectX, self).__init__()
-        self.ts = time.time()
-        self.value = value
-        self.requestors = {}
-        self.persist = persist
+        return None if ttl is None else time.time() + ttl
 
+    def __put(self, idx, value, persist, expires, plain=None):
+        """
+        Stores an item and records it in the persistence log. The caller holds the lock for idx and calls
+        :func:`__afterset` once it has released it.
+        """
+        dox = DataObjectX(value, persist, expires)
+        old = self.__odict.get(idx)
+        self.__store(idx, dox)
+        if self.__log is not None:
+            if persist is True:
+                self.__log.append(DataLog.OP_SET, idx, dox.ts, SharedBlob.plain(value) if plain is None else plain,
+                                  dox.expires)
+            elif old is not None and old.persist is True:
+                self.__log.append(DataLog.OP_UNPERSIST, idx)
+        return dox
 
-class DataObjects(object):
-    """
-    The actual datastore object whose methods are exposed via pyro4.proxy
-    """
-    STATE_OPENED = 'open'
-    STATE_CLOSED = 'closed'
+    def __afterset(self, idx, dox):
+        """
+        Schedules the expiry of a newly stored item, notifies waiters and subscribers and enforces the memory budget.
+        Must not be called holding an item lock, since evictions take the locks of other items.
+        """
+        self.__schedule(idx, dox)
+        self.__publish([idx])
+        self.__enforcebudget()
 
-    def __init__(self, persist_dir=None):
+    @metered(IPCERROR_NO_VALUE_FOUND, IPCERROR_UPDATE_FAILED)
+    def update(self, name, author, op, args=()):
         """
-        If you desire to allow data to persist between Kodi sessions, the directory to store persistent data
-        is needed at the time of instantiation in order to restore any saved data, if any exists.
+        Applies a partial update to a stored dict or list, so that changing one field of a large value does not mean
+        sending the whole value. The operations are:
 
-        :param persist_dir: the directory where the persistent data is stored
-        :type persist_dir: str
+        ================  ==================  ===================================================================
+        ``set_field``     (key, value)        dict: sets one item
+        ``delete_field``  (key,)              dict: removes one item if present
+        ``merge``         (fields,)           dict: updates with the items of the dict fields
+        ``append``        (item,)             list: appends item
+        ``extend``        (items,)            list: appends the items
+        ``trim``          (maxlen,)           list: keeps only the last maxlen items
+        ================  ==================  ===================================================================
+
+        The item gets a new timestamp, so cached copies are replaced on the next get and subscribers are notified,
+        and keeps its persistence and expiry time. The stored value is replaced by an updated shallow copy rather
+        than changed in place, since the persistence log writer and snapshots may be pickling it in the background.
+        Its size is adjusted by the size of the change rather than measured again.
+
+        :param name:
+        :type name: str
+        :param author:
+        :type author: str
+        :param op: One of the operations above
+        :type op: str
+        :param args: The arguments of the operation
+        :type args: tuple
+        :return: The new timestamp or a one byte message code
+        :rtype: float or str
         """
-        self.persist_dir = persist_dir
-        self.__odict = {}
-        if self.persist_dir is not None:
-            ret = DataIO.restorepersist(self.persist_dir, self.__odict)
-            self.__odict.update(ret)
-            DataIO.savepersist(DataObjects.STATE_OPENED, self.persist_dir, self.__odict)
-        self.__state = DataObjects.STATE_OPENED
-        self.autosave = True
+        idx = (str(author), str(name))
+        with self.__lockfor(idx):
+            dox = self.__lookup(idx)
+            if dox is None:
+                return chr(IPCERROR_NO_VALUE_FOUND)
+            try:
+                value, delta = DataObjects.applyupdate(dox.value, op, tuple(args))
+            except (TypeError, ValueError, KeyError):
+                return chr(IPCERROR_UPDATE_FAILED)
+            new = DataObjectX(value, dox.persist, dox.expires, max(0, dox.size + delta))
+            self.__store(idx, new)
+            if new.persist is True and self.__log is not None:
+                self.__log.append(DataLog.OP_SET, idx, new.ts, value, new.expires)
+        self.__publish([idx])
+        self.__enforcebudget()
+        return new.ts
 
-    @pyro4.oneway
-    def setautosave(self, val):
+    @metered(IPCERROR_UPDATE_FAILED)
+    def incr(self, name, author, delta=1, default=0, persist=False, ttl=None):
         """
-        If True will save data when object deleted or .close() called
+        Atomically adds delta to a stored number, in one round trip and without the lost updates of a get followed by
+        a set. A missing item is created as default + delta with the given persistence and time to live; an existing
+        one keeps its own.
 
-        :param val: True or False
-        :type val: bool
+        :param name:
+        :type name: str
+        :param author:
+        :type author: str
+        :param delta: The amount to add, negative to decrement
+        :type delta: int or float
+        :param default: The value a missing item starts from
+        :type default: int or float
+        :param persist: See :func:`set() <DataObjects.set>`, for a new item
+        :type persist: bool
+        :param ttl: See :func:`set() <DataObjects.set>`, for a new item
+        :type ttl: float
+        :return: The item as a (value, ts) tuple or a one byte message code
+        :rtype: tuple or str
         """
-        self.autosave = val
+        idx = (str(author), str(name))
+        with self.__lockfor(idx):
+            dox = self.__lookup(idx)
+            current = default if dox is None else dox.value
+            if (not isinstance(current, (int, long, float)) or isinstance(current, bool) or
+                    not isinstance(delta, (int, long, float))):
+                return chr(IPCERROR_UPDATE_FAILED)
+            if dox is None:
+                dox = self.__put(idx, current + delta, persist, DataObjects.expiry(ttl))
+            else:
+                dox = self.__put(idx, current + delta, dox.persist, dox.expires)
+        self.__afterset(idx, dox)
+        return dox.wire()
 
-    @pyro4.oneway
-    def set(self, name, value, author, persist=False):
+    @metered(IPCERROR_CONFLICT)
+    def compare_and_set(self, name, value, author, ts, persist=False, ttl=None):
         """
+        Atomically stores value only if the stored item still has the timestamp ts, that is if nobody else has changed
+        it since the caller read it. The timestamp works as the version of the item. With ts None the value is only
+        stored if the item does not exist.
+
         :param name:
         :type name: str
         :param value:
         :type value: object
         :param author:
         :type author: str
-        :param persist:
+        :param ts: The timestamp of the version the caller expects to replace, or None
+        :type ts: float
+        :param persist: See :func:`set() <DataObjects.set>`
         :type persist: bool
-        :returns: Nothing
+        :param ttl: See :func:`set() <DataObjects.set>`
+        :type ttl: float
+        :return: The stored item as a (value, ts) tuple, or a one byte message code if the item was changed
+        :rtype: tuple or str
         """
-        dox = DataObjectX(value, persist)
         idx = (str(author), str(name))
-        self.__odict[idx] = dox
-        if persist is True and self.persist_dir is not None:
-            do = DataObject(dox)
-            DataIO.savepersist_bu(name, author, self.persist_dir, do)
+        with self.__lockfor(idx):
+            dox = self.__lookup(idx)
+            if (dox.ts if dox is not None else None) != ts:
+                return chr(IPCERROR_CONFLICT)
+            dox = self.__put(idx, value, persist, DataObjects.expiry(ttl))
+        self.__afterset(idx, dox)
+        return dox.wire()
 
+    @metered()
+    def setdefault(self, name, value, author, persist=False, ttl=None):
+        """
+        Atomically stores value if the item does not exist, like dict.setdefault.
+
+        :param name:
+        :type name: str
+        :param value:
+        :type value: object
+        :param author:
+        :type author: str
+        :param persist: See :func:`set() <DataObjects.set>`
+        :type persist: bool
+        :param ttl: See :func:`set() <DataObjects.set>`
+        :type ttl: float
+        :return: The item now stored, either the existing one or the new one, as a (value, ts) tuple
+        :rtype: tuple
+        """
+        idx = (str(author), str(name))
+        with self.__lockfor(idx):
+            dox = self.__lookup(idx)
+            if dox is not None:
+                self.__touch(idx)
+                return dox.wire()
+            dox = self.__put(idx, value, persist, DataObjects.expiry(ttl))
+        self.__afterset(idx, dox)
+        return dox.wire()
+
+    @staticmethod
+    def applyupdate(value, op, args):
+        """
+        Applies one of the operations of :func:`update() <DataObjects.update>` to a copy of value.
+
+        :return: The updated copy and the change in size
+        :rtype: tuple
+        :raises TypeError: If the value has the wrong type or the operation is unknown
+        """
+        sizeof = DataObjectX.sizeof
+        if op in ('set_field', 'delete_field', 'merge'):
+            if not isinstance(value, dict):
+                raise TypeError('{0} needs a dict'.format(op))
+            new = value.copy()
+            delta = 0
+            if op == 'delete_field':
+                if args[0] in new:
+                    delta -= sizeof(args[0]) + sizeof(new.pop(args[0]))
+                return new, delta
+            fields = dict(args[0]) if op == 'merge' else {args[0]: args[1]}
+            for key, item in fields.iteritems():
+                if key in new:
+                    delta -= sizeof(key) + sizeof(new[key])
+                new[key] = item
+                delta += sizeof(key) + sizeof(item)
+            return new, delta
+        elif op in ('append', 'extend', 'trim'):
+            if not isinstance(value, list):
+                raise TypeError('{0} needs a list'.format(op))
+            if op == 'trim':
+                maxlen = int(args[0])
+                if maxlen < 0:
+                    raise ValueError('maxlen must not be negative')
+                removed = value[:max(0, len(value) - maxlen)]
+                return value[len(removed):], -sum(sizeof(item) for item in removed)
+            items = [args[0]] if op == 'append' else list(args[0])
+            return value + items, sum(sizeof(item) for item in items)
+        raise TypeError('Unknown update {0}'.format(op))
+
+    @metered(IPCERROR_NO_VALUE_FOUND, IPCERROR_USE_CACHED_COPY)
     def get(self, requestor, name, author, force=False):
         """
 
@@ -304,25 +2454,96 @@ class DataObjects(object):
         :type author: str
         :param force:
         :type force: bool
-        :return: Either a dataoject or a one byte message code
-        :rtype: :class:`datastore.DataObject` or one character str
+        :return: Either the item as a (value, ts) tuple or a one byte message code
+        :rtype: tuple (value, ts) or one character str
         """
         idx = (str(author), str(name))
-        if idx in self.__odict:
-            dox = self.__odict[idx]
-            do = DataObject(dox)
+        with self.__lockfor(idx):
+            dox = self.__lookup(idx)
+            if dox is None:
+                return chr(IPCERROR_NO_VALUE_FOUND)
+            self.__touch(idx)
+            if dox.requestors is None:
+                dox.requestors = {}
             if requestor in dox.requestors and force is False:
                 if dox.requestors[requestor] == dox.ts:
                     return chr(IPCERROR_USE_CACHED_COPY)
                 else:
                     dox.requestors[requestor] = dox.ts
-                    return do
+                    return dox.wire()
             else:
                 dox.requestors[requestor] = dox.ts
-                return do
-        else:
+                with self.__indexlock:
+                    self.__requested.setdefault(requestor, set()).add(idx)
+                return dox.wire()
+
+    @metered(IPCERROR_NO_VALUE_FOUND, IPCERROR_USE_CACHED_COPY)
+    def get_if_modified(self, name, author, ts=None):
+        """
+        Conditional get which keeps no state on the server. The client supplies the timestamp of the copy it already
+        holds, if any, and only receives the data if the stored timestamp differs. Reads do not modify the store.
+
+        :param name:
+        :type name: str
+        :param author:
+        :type author: str
+        :param ts: The timestamp of the client's cached copy or None
+        :type ts: float
+        :return: Either the item as a (value, ts) tuple or a one byte message code
+        :rtype: tuple (value, ts) or one character str
+        """
+        idx = (str(author), str(name))
+        dox = self.__lookup(idx)
+        if dox is None:
             return chr(IPCERROR_NO_VALUE_FOUND)
+        self.__touch(idx)
+        if ts is not None and dox.ts == ts:
+            return chr(IPCERROR_USE_CACHED_COPY)
+        else:
+            return dox.wire()
+
+    @metered(IPCERROR_WAIT_TIMEOUT)
+    def wait_for(self, name, author, newer_than=None, timeout=10.0):
+        """
+        Blocks until the item exists with a timestamp newer than ``newer_than`` and then returns it. If newer_than is
+        None, returns as soon as the item exists (immediately if it already does). Replaces polling the server with
+        repeated gets while waiting for another addon to provide data. A waiting call holds one of the server's
+        worker threads, so the wait is capped at MAX_WAIT seconds; :func:`ipcclientx.IPCClientX.wait_for` waits longer
+        by calling again. Only the waiters of a key are woken up when it changes.
+
+        :param name:
+        :type name: str
+        :param author:
+        :type author: str
+        :param newer_than: The timestamp the returned item must be newer than, or None
+        :type newer_than: float
+        :param timeout: Seconds to wait
+        :type timeout: float
+        :return: Either the item as a (value, ts) tuple or a one byte message code on timeout
+        :rtype: tuple (value, ts) or one character str
+        """
+        idx = (str(author), str(name))
+        deadline = time.time() + min(timeout, DataObjects.MAX_WAIT)
+        with self.__waitlock:
+            waiting = self.__waiting.get(idx)
+            if waiting is None:
+                waiting = self.__waiting[idx] = [threading.Condition(self.__waitlock), 0]
+            waiting[1] += 1
+            try:
+                while True:
+                    dox = self.__odict.get(idx)
+                    if dox is not None and not dox.expired() and (newer_than is None or dox.ts > newer_than):
+                        return dox.wire()
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return chr(IPCERROR_WAIT_TIMEOUT)
+                    waiting[0].wait(remaining)
+            finally:
+                waiting[1] -= 1
+                if not waiting[1]:
+                    del self.__waiting[idx]
 
+    @metered(IPCERROR_NO_VALUE_FOUND)
     def delete(self, name, author):
         """
 
@@ -330,19 +2551,78 @@ class DataObjects(object):
         :type name: str
         :param author:
         :type author: str
-        :return: Either a dataoject or a one byte message code
-        :rtype: :class:`datastore.DataObject` or one character str
+        :return: Either the item as a (value, ts) tuple or a one byte message code
+        :rtype: tuple (value, ts) or one character str
         """
         idx = (str(author), str(name))
-        if idx in self.__odict:
-            if self.__odict[idx].persist is True:
-                self.remove_persistence(name, author)
-            dox = self.__odict.pop(idx)
-            do = DataObject(dox)
-            return do
-        else:
-            return chr(IPCERROR_NO_VALUE_FOUND)
+        with self.__lockfor(idx):
+            if self.__lookup(idx) is None:
+                return chr(IPCERROR_NO_VALUE_FOUND)
+            dox = self.__discard(idx)
+            if dox.persist is True and self.__log is not None:
+                self.__log.append(DataLog.OP_DELETE, idx)
+        self.__publish([idx])
+        return dox.wire()
+
+    @pyro4.oneway
+    @metered()
+    def mset(self, items, persist=False, ttl=None):
+        """
+        Batch version of :func:`set() <DataObjects.set>` storing many values in one call.
+
+        :param items: dict of values keyed by (author, name)
+        :type items: dict
+        :param persist:
+        :type persist: bool
+        :param ttl: See :func:`set() <DataObjects.set>`
+        :type ttl: float
+        :returns: Nothing
+        """
+        for key in items:
+            self.set(key[1], items[key], key[0], persist, ttl)
+
+    @metered(IPCERROR_NO_VALUE_FOUND, IPCERROR_USE_CACHED_COPY)
+    def mget(self, requestor, keys, force=False):
+        """
+        Batch version of :func:`get() <DataObjects.get>`. Each item of the result has the same meaning as the return
+        of a single get, so cached copies and missing values are reported per key.
+
+        :param requestor:
+        :type requestor: str
+        :param keys: list of (author, name)
+        :type keys: list
+        :param force:
+        :type force: bool
+        :return: list with a (value, ts) tuple or one byte message code for each key, in the order given
+        :rtype: list
+        """
+        return [self.get(requestor, key[1], key[0], force) for key in keys]
+
+    @metered(IPCERROR_NO_VALUE_FOUND, IPCERROR_USE_CACHED_COPY)
+    def mget_if_modified(self, keys):
+        """
+        Batch version of :func:`get_if_modified() <DataObjects.get_if_modified>`.
+
+        :param keys: list of (author, name, ts)
+        :type keys: list
+        :return: list with a (value, ts) tuple or one byte message code for each key, in the order given
+        :rtype: list
+        """
+        return [self.get_if_modified(key[1], key[0], key[2]) for key in keys]
+
+    @metered(IPCERROR_NO_VALUE_FOUND)
+    def mdelete(self, keys):
+        """
+        Batch version of :func:`delete() <DataObjects.delete>`.
+
+        :param keys: list of (author, name)
+        :type keys: list
+        :return: list with the deleted (value, ts) tuple or one byte message code for each key, in the order given
+        :rtype: list
+        """
+        return [self.delete(key[1], key[0]) for key in keys]
 
+    @metered()
     def get_data_list(self, author=None):
         """
 
@@ -352,22 +2632,119 @@ class DataObjects(object):
         :rtype: dict with author(s) as key(s)
         """
         dl = {}
-        for key in self.__odict.keys():
-            if key[0] == author or author is None:
-                if key[0] in dl:
-                    dl[key[0]].append(key[1])
-                else:
-                    dl[key[0]] = [key[1]]
+        with self.__indexlock:
+            if author is None:
+                authors = self.__authors.keys()
+            else:
+                authors = [author]
+            for author in authors:
+                names = self.__authors.get(author)
+                if names:
+                    dl[author] = list(names)
         return dl
 
+    @metered()
+    def scan(self, prefix='', author=None, pattern=None, cursor=None, limit=100, values=False):
+        """
+        Lists keys in (author, name) order, a page at a time. Only names starting with prefix are listed, and if
+        pattern is given only those matching it as a glob (see :mod:`fnmatch`, case sensitive). The literal start of
+        the pattern narrows the scan like a prefix, so 'player.video.*' only visits the 'player.video.' keys.
+
+        :param prefix: The start of the names to list
+        :type prefix: str
+        :param author: The author whose keys are listed, None for all authors
+        :type author: str
+        :param pattern: A glob the names must match, None to match all
+        :type pattern: str
+        :param cursor: The cursor returned with the previous page, None for the first page
+        :type cursor: tuple
+        :param limit: The number of keys per page, at most MAX_SCAN
+        :type limit: int
+        :param values: Whether to return the items with the keys
+        :type values: bool
+        :return: A page of keys, as (author, name), or of (key, item) pairs with the items as from
+                 :func:`get_if_modified() <DataObjects.get_if_modified>`, and the cursor for the next page (None
+                 once the scan is complete)
+        :rtype: tuple (list, tuple)
+        """
+        prefix = str(prefix)
+        if author is not None:
+            author = str(author)
+        if pattern is not None:
+            pattern = str(pattern)
+            literal = re.match(r'[^*?\[]*', pattern).group(0)
+            if literal.startswith(prefix):
+                prefix = literal
+            elif not prefix.startswith(literal):
+                return [], None
+        limit = max(1, min(int(limit), DataObjects.MAX_SCAN))
+        with self.__indexlock:
+            keys = self.__keyindex.keys()
+        if cursor is not None:
+            i = bisect.bisect_right(keys, tuple(cursor))
+        elif author is not None:
+            i = bisect.bisect_left(keys, (author, prefix))
+        else:
+            i = 0
+        page = []
+        while i < len(keys) and len(page) < limit:
+            key = keys[i]
+            if author is not None and key[0] != author:
+                break
+            if not key[1].startswith(prefix):
+                if key[1] < prefix:
+                    i = bisect.bisect_left(keys, (key[0], prefix), i + 1)
+                elif author is None:
+                    i = bisect.bisect_left(keys, (key[0] + '\0',), i + 1)
+                else:
+                    break
+                continue
+            i += 1
+            if pattern is not None and not fnmatch.fnmatchcase(key[1], pattern):
+                continue
+            if values:
+                with self.__lockfor(key):
+                    dox = self.__lookup(key)
+                    if dox is not None:
+                        page.append((key, dox.wire()))
+            else:
+                dox = self.__odict.get(key)
+                if dox is not None and not dox.expired():
+                    page.append(key)
+        if len(page) < limit or i >= len(keys):
+            return page, None
+        return page, (page[-1][0] if values else page[-1])
+
     @pyro4.oneway
+    @metered()
     def clearall(self):
         """
 
         :return: Nothing
         """
-        self.__odict = {}
+        for lock in self.__stripes:
+            lock.acquire()
+        try:
+            with self.__indexlock:
+                cleared = self.__odict
+                self.__odict = {}
+                self.__authors = {}
+                self.__keyindex = KeyIndex()
+                self.__persisted = set()
+                self.__requested = {}
+                self.__used = 0
+                self.__authorsize = {}
+                self.__lru = OrderedDict()
+            if self.__log is not None:
+                self.__log.append(DataLog.OP_CLEAR, ('', ''))
+        finally:
+            for lock in self.__stripes:
+                lock.release()
+        for dox in cleared.itervalues():
+            self.__retire(dox)
+        self.__publish(None)
 
+    @metered()
     def savedata(self, author, fn):
         """
 
@@ -379,14 +2756,19 @@ class DataObjects(object):
         :rtype: bool
         """
         save = {}
-        for key in self.__odict:
-            if key[0] == author:
-                tmp = self.__odict[key]
-                tmp.requestors = {}
-                save[key] = tmp
+        with self.__indexlock:
+            names = list(self.__authors.get(author, ()))
+        for name in names:
+            key = (author, name)
+            with self.__lockfor(key):
+                tmp = self.__odict.get(key)
+                if tmp is not None:
+                    tmp.requestors = None
+                    save[key] = tmp
         ret = DataIO.savepickle(fn, save)
         return ret
 
+    @metered()
     def restoredata(self, author, fn):
         """
 
@@ -399,13 +2781,24 @@ class DataObjects(object):
         """
         restore = DataIO.restorepickle(fn)
         if restore is not False:
+            restored = []
             for key in restore:
                 if key[0] == author:
-                    self.__odict[key] = restore[key]
+                    dox = restore[key]
+                    dox.size = DataObjectX.sizeof(dox.value)
+                    with self.__lockfor(key):
+                        self.__store(key, dox)
+                        if dox.persist is True and self.__log is not None:
+                            self.__log.append(DataLog.OP_SET, key, dox.ts, dox.value, dox.expires)
+                    self.__schedule(key, dox)
+                    restored.append(key)
+            self.__publish(restored)
+            self.__enforcebudget()
             return True
         return False
 
     @pyro4.oneway
+    @metered()
     def clearcache(self, requestor):
         """
 
@@ -413,9 +2806,303 @@ class DataObjects(object):
         :type requestor: str
         :return: Nothing
         """
-        for key in self.__odict:
-            if requestor in self.__odict[key].requestors:
-                del self.__odict[key].requestors[requestor]
+        with self.__indexlock:
+            keys = self.__requested.pop(requestor, ())
+        for key in keys:
+            with self.__lockfor(key):
+                dox = self.__odict.get(key)
+                if dox is not None and dox.requestors is not None:
+                    dox.requestors.pop(requestor, None)
+
+    def expiry_stats(self):
+        """
+        Reports on items stored with a time to live.
+
+        :return: The number of expiry times scheduled (including those of items replaced or deleted since), the number of
+                 items removed by the background sweeper and the number found expired when accessed.
+        :rtype: dict
+        """
+        expirer = self.__expirer
+        ret = {'scheduled': 0, 'expired_sweeper': 0, 'expired_on_access': self.__expiredlazy}
+        if expirer is not None:
+            ret['scheduled'] = len(expirer)
+            ret['expired_sweeper'] = expirer.expired
+        ret['expired'] = ret['expired_sweeper'] + ret['expired_on_access']
+        return ret
+
+    def __schedule(self, idx, dox):
+        """
+        Hands the expiry time of an item with a time to live to the :class:`Expirer`, started on first use.
+        """
+        if dox.expires is None:
+            return
+        with self.__expirelock:
+            if self.__expirer is None:
+                ref = weakref.ref(self)  # the expirer must not keep the datastore alive
+                self.__expirer = Expirer(lambda idx, expires: ref() is not None and ref().__expire(idx, expires))
+                self.__expirer.start()
+            expirer = self.__expirer
+        expirer.schedule(idx, dox.expires)
+
+    def __expire(self, idx, expires=None):
+        """
+        Removes an item whose time to live has run out. If expires is given, only removes the item if it still has that
+        expiry time, since it may have been replaced after the expiry was scheduled.
+
+        :return: True if the item was removed
+        :rtype: bool
+        """
+        with self.__lockfor(idx):
+            dox = self.__odict.get(idx)
+            if dox is None or not dox.expired() or (expires is not None and dox.expires != expires):
+                return False
+            self.__discard(idx)
+            if dox.persist is True and self.__log is not None:
+                self.__log.append(DataLog.OP_DELETE, idx)
+        self.__publish([idx])
+        return True
+
+    def __lookup(self, idx):
+        """
+        Returns the item with key idx or None, removing it if its time to live has run out.
+        """
+        dox = self.__odict.get(idx)
+        if dox is not None and dox.expired():
+            if self.__expire(idx):
+                with self.__expirelock:
+                    self.__expiredlazy += 1
+            return None
+        return dox
+
+    def __lockfor(self, idx):
+        """
+        Returns the lock guarding the item with key idx.
+        """
+        return self.__stripes[hash(idx) % DataObjects.LOCK_STRIPES]
+
+    def __store(self, idx, dox):
+        """
+        Stores or replaces an item, keeping the indexes up to date. The caller holds the lock for idx.
+        """
+        old = self.__odict.get(idx)
+        self.__odict[idx] = dox
+        with self.__indexlock:
+            self.__authors.setdefault(idx[0], set()).add(idx[1])
+            if old is None:
+                self.__keyindex.add(idx)
+            elif old is not dox:
+                self.__forget(idx, old)
+            self.__account(idx, old, dox)
+        if old is not dox:
+            self.__retire(old)
+
+    def __discard(self, idx):
+        """
+        Removes an item, keeping the indexes up to date, and returns it. The caller holds the lock for idx.
+        """
+        dox = self.__odict.pop(idx)
+        with self.__indexlock:
+            names = self.__authors.get(idx[0])
+            if names is not None:
+                names.discard(idx[1])
+                if not names:
+                    del self.__authors[idx[0]]
+            self.__keyindex.remove(idx)
+            self.__forget(idx, dox)
+            self.__account(idx, dox, None)
+        self.__retire(dox)
+        return dox
+
+    def __forget(self, idx, dox):
+        """
+        Removes idx from the keys recorded for clearcache under the requestors the item dox was sent to, once the item
+        is replaced or removed. The caller holds the index lock.
+        """
+        if dox is None or not dox.requestors:
+            return
+        for requestor in dox.requestors:
+            keys = self.__requested.get(requestor)
+            if keys is not None:
+                keys.discard(idx)
+                if not keys:
+                    del self.__requested[requestor]
+
+    def __retire(self, dox):
+        """
+        Schedules the removal of the shared memory file of an item that was replaced or removed, if it has one.
+        """
+        if dox is not None and not isinstance(dox, LazyDataObjectX) and isinstance(dox.value, SharedBlob):
+            self.__blobs.retire(dox.value)
+
+    def __account(self, idx, old, new):
+        """
+        Updates the size totals and the eviction order when the item with key idx changes from old to new (either may
+        be None). The caller holds the index lock.
+        """
+        delta = (new.size if new is not None else 0) - (old.size if old is not None else 0)
+        self.__used += delta
+        size = self.__authorsize.get(idx[0], 0) + delta
+        if idx[0] in self.__authors:
+            self.__authorsize[idx[0]] = size
+        else:
+            self.__authorsize.pop(idx[0], None)
+        if new is not None and new.persist is True:
+            self.__persisted.add(idx)
+        else:
+            self.__persisted.discard(idx)
+        if self.memory_budget is not None:
+            self.__lru.pop(idx, None)
+            if new is not None and new.persist is not True:
+                self.__lru[idx] = new
+
+    def __touch(self, idx):
+        """
+        Marks an item as the most recently used.
+        """
+        if self.memory_budget is not None:
+            with self.__indexlock:
+                dox = self.__lru.pop(idx, None)
+                if dox is not None:
+                    self.__lru[idx] = dox
+
+    def __enforcebudget(self):
+        """
+        Evicts the least recently used items not tagged for persistence until the stored values fit in the memory
+        budget. Evictions are published like deletes.
+        """
+        budget = self.memory_budget
+        if budget is None or self.__used <= budget:
+            return
+        evicted = []
+        while True:
+            with self.__indexlock:
+                if self.__used <= budget or not self.__lru:
+                    break
+                idx, candidate = self.__lru.popitem(last=False)
+            with self.__lockfor(idx):
+                dox = self.__odict.get(idx)
+                if dox is not candidate or dox.persist is True:
+                    continue
+                self.__discard(idx)
+            with self.__indexlock:
+                self.__evicted[0] += 1
+                self.__evicted[1] += dox.size
+            evicted.append(idx)
+        if evicted:
+            self.__publish(evicted)
+
+    def memory_stats(self):
+        """
+        Reports on the memory used by the stored values, measured as their serialized size.
+
+        :return: The budget in bytes (None for no limit), the bytes used in total and per author, the number of items,
+                 the number of items that can be evicted and the number of items and bytes evicted so far.
+        :rtype: dict
+        """
+        with self.__indexlock:
+            return {'budget': self.memory_budget, 'used': self.__used, 'authors': dict(self.__authorsize),
+                    'items': len(self.__odict), 'evictable': len(self.__lru), 'evicted': self.__evicted[0],
+                    'evicted_bytes': self.__evicted[1]}
+
+    def stats(self):
+        """
+        Reports on the calls made to the datastore since it started (see :class:`Metrics`) and on its contents. Cheap
+        enough to be polled: it copies counters and does not look at the stored items.
+
+        :return: The number of keys and of keys tagged for persistence, the bytes used by the values, the number of
+                 keys waiting for the persistence log writer, the seconds since the datastore started and, under
+                 'methods', the counters and latencies in seconds of each method called, see
+                 :func:`Metrics.snapshot`.
+        :rtype: dict
+        """
+        with self.__indexlock:
+            ret = {'keys': len(self.__odict), 'persisted_keys': len(self.__persisted), 'bytes': self.__used}
+        log = self.__log
+        ret['queue_depth'] = log.queue_depth() if log is not None else 0
+        ret['uptime'] = time.time() - self.metrics.started
+        ret['methods'] = self.metrics.snapshot()
+        return ret
+
+    @metered()
+    def subscribe(self, callback_uri, keys=None, authors=None, lease=60.0):
+        """
+        Registers a client callback object which is sent invalidations whenever one of the given keys, or any key of
+        one of the given authors, is set, deleted or cleared. The callback object must expose a oneway method
+        ``invalidate(keys)``, where keys is a list of (author, name) or None meaning everything. Calling again with the
+        same uri adds to the subscription and renews the lease. A subscription that is not renewed within ``lease``
+        seconds, or whose callback cannot be reached, is dropped.
+
+        :param callback_uri: The pyro uri of the client callback object
+        :type callback_uri: str
+        :param keys: list of (author, name)
+        :type keys: list
+        :param authors: list of authors whose whole namespace is subscribed
+        :type authors: list
+        :param lease: Seconds the subscription stays valid without being renewed
+        :type lease: float
+        :return: True if the subscription already existed, False if it is new
+        :rtype: bool
+        """
+        callback_uri = str(callback_uri)
+        with self.__sublock:
+            sub = self.__subscribers.get(callback_uri)
+            existed = sub is not None
+            if sub is None:
+                sub = [set(), set(), 0]
+                self.__subscribers[callback_uri] = sub
+            if keys:
+                sub[0].update((str(key[0]), str(key[1])) for key in keys)
+            if authors:
+                sub[1].update(str(author) for author in authors)
+            sub[2] = time.time() + lease
+            if self.__notifier is None:
+                self.__notifier = Notifier(self.__dropsubscriber)
+                self.__notifier.start()
+        return existed
+
+    @metered()
+    def unsubscribe(self, callback_uri):
+        """
+        Removes a subscription made with :func:`subscribe() <DataObjects.subscribe>`.
+
+        :param callback_uri: The pyro uri of the client callback object
+        :type callback_uri: str
+        :return: True if the subscription existed
+        :rtype: bool
+        """
+        with self.__sublock:
+            return self.__subscribers.pop(str(callback_uri), None) is not None
+
+    def __dropsubscriber(self, callback_uri):
+        with self.__sublock:
+            self.__subscribers.pop(callback_uri, None)
+
+    def __publish(self, keys):
+        """
+        Wakes up any :func:`wait_for() <DataObjects.wait_for>` calls and queues invalidations for the subscribers
+        interested in the given keys (None for all keys).
+        """
+        if self.__waiting:
+            with self.__waitlock:
+                if keys is None:
+                    keys = self.__waiting.keys()
+                for key in keys:
+                    waiting = self.__waiting.get(key)
+                    if waiting is not None:
+                        waiting[0].notify_all()
+        if not self.__subscribers:
+            return
+        now = time.time()
+        with self.__sublock:
+            for uri, sub in self.__subscribers.items():
+                if sub[2] < now:
+                    del self.__subscribers[uri]
+                elif keys is None:
+                    self.__notifier.notify(uri, None)
+                else:
+                    mine = [key for key in keys if key in sub[0] or key[0] in sub[1]]
+                    if mine:
+                        self.__notifier.notify(uri, mine)
 
     @pyro4.oneway
     def close(self):
@@ -423,17 +3110,96 @@ class DataObjects(object):
         Explicitly write persistent data to a file in anticipation of shutting down.
 
         """
-        if self.persist_dir is not None and self.autosave is True:
-            DataIO.savepersist(DataObjects.STATE_CLOSED, self.persist_dir, self.__odict)
+        if self.__compactor is not None:
+            self.__compactor.stop()
+            self.__compactor = None
+        if self.__log is not None:
+            self.__waitwarmup()
+            if self.autosave is True and DataIO.savepersist(self.persist_dir, dict(self.__odict)):
+                self.__log.truncate()
+            self.__log.close()
+            self.__log = None
+        if self.__notifier is not None:
+            self.__notifier.stop()
+            self.__notifier = None
+        if self.__expirer is not None:
+            self.__expirer.stop()
+            self.__expirer = None
+        if self.__statslogger is not None:
+            self.__statslogger.stop()
+            self.__statslogger = None
+        with self.__streamlock:
+            streams = self.__streams.values()
+            self.__streams.clear()
+        for stream in streams:
+            stream.close()
+        self.__blobs.close()
+        if self.__state != DataObjects.STATE_CLOSED:
+            DataObjects.unconfigure()
         self.__state = DataObjects.STATE_CLOSED
 
+    def compact(self):
+        """
+        Writes a snapshot of the persistent data and drops the part of the persistence log it contains. Called
+        periodically by :class:`Compactor`; writes to the datastore are only held up while the persistent items are
+        copied, the values kept in shared memory files are read once the locks are released.
+
+        :return: True on success, False on failure
+        :rtype: bool
+        """
+        log = self.__log
+        if log is None:
+            return False
+        self.__waitwarmup()
+        start = time.time()
+        for lock in self.__stripes:
+            lock.acquire()
+        try:
+            pdict = DataIO.persistentcopy(self.__odict)
+            log.rotate()
+        finally:
+            for lock in self.__stripes:
+                lock.release()
+        ok = DataIO.savepersist(self.persist_dir, pdict=pdict)
+        log.compacted(ok, time.time() - start)
+        return ok
+
+    def __warmupvalues(self, snapshot):
+        start = time.time()
+        self.__startup['warmup_loaded'], self.__startup['warmup_failed'] = snapshot.warmup()
+        self.__startup['warmup_time'] = time.time() - start
+
+    def __waitwarmup(self):
+        warmup = self.__warmup
+        if warmup is not None and warmup is not threading.current_thread():
+            warmup.join()
+
+    def persistence_stats(self):
+        """
+        Reports on the background writer of the persistence log (see :class:`LogWriter`).
+
+        :return: The queue depth, the number of records queued, coalesced and written, the number of times callers
+                 were blocked, the last, average and maximum flush latency in seconds, the log size in bytes and the
+                 number and last duration of compactions. Under 'startup', the time taken to restore the key index and
+                 replay the log, the number of keys, the time the background warm-up took to read the values and the
+                 number it read and failed to read. An empty dict if the datastore has no persistence directory.
+        :rtype: dict
+        """
+        log = self.__log
+        if log is None:
+            return {}
+        ret = log.stats()
+        ret['startup'] = dict(self.__startup)
+        return ret
+
     def __del__(self):
         if self.__state == DataObjects.STATE_OPENED and self.autosave is True:
             self.close()
 
+    @metered()
     def add_persistence(self, varname, author):
         """
-        Adds a persistence tag to a pre-existing stored object and saves data to backup.
+        Adds a persistence tag to a pre-existing stored object and records it in the persistence log.
 
         :param varname:
         :type varname: str
@@ -442,18 +3208,22 @@ class DataObjects(object):
         :return: True on success, False on failure
         :rtype: bool
         """
-        if self.persist_dir is not None:
+        if self.__log is not None:
             idx = (author, varname)
-            self.__odict[idx].persist = True
-            do = DataObject(self.__odict[idx])
-            DataIO.savepersist_bu(varname, author, self.persist_dir, do)
+            with self.__lockfor(idx):
+                dox = self.__odict[idx]
+                dox.persist = True
+                with self.__indexlock:
+                    self.__account(idx, dox, dox)
+                self.__log.append(DataLog.OP_SET, idx, dox.ts, SharedBlob.plain(dox.value), dox.expires)
             return True
         else:
             return False
 
+    @metered()
     def remove_persistence(self, varname, author):
         """
-        Removes the persistence tag from a stored object and deletes it from backup.
+        Removes the persistence tag from a stored object and records it in the persistence log.
 
         :param varname:
         :type varname: str
@@ -462,11 +3232,14 @@ class DataObjects(object):
         :return: True on success, False on failure
         :rtype: bool
         """
-        if self.persist_dir is not None:
-            sfn = '@{0}~{1}.p.gz'.format(author, varname)
-            DataIO.cleanbus(self.persist_dir, sfn)
+        if self.__log is not None:
             idx = (author, varname)
-            self.__odict[idx].persist = False
+            with self.__lockfor(idx):
+                dox = self.__odict[idx]
+                dox.persist = False
+                with self.__indexlock:
+                    self.__account(idx, dox, dox)
+                self.__log.append(DataLog.OP_UNPERSIST, idx)
             return True
         else:
             return False
\ No newline at end of file
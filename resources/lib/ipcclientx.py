@@ -18,8 +18,13 @@
 #
 import sys
 import os
-from collections import namedtuple
-from cPickle import PickleError, PicklingError
+import time
+import mmap
+import tempfile
+import threading
+import weakref
+from collections import namedtuple, OrderedDict
+from cPickle import PickleError, PicklingError, dumps, HIGHEST_PROTOCOL
 
 if 'win' in sys.platform:
     isKodi = 'xbmc' in sys.executable.lower() or 'kodi' in sys.executable.lower()
@@ -49,11 +54,14 @@ else:
 import pyro4
 import pyro4.errors
 import pyro4.util
+import pyro4.core
+import pyro4.socketutil
 from ipc.ipcclient import IPCClient as IPCClient
 
 # required modules that should be in local path
 import resources.lib.ipcclientxerrors as ipcclientxerrors
 from resources.lib.caller_name import caller_name
+from resources.lib.datastore import Metrics
 
 __callingmodule__ = caller_name()
 
@@ -61,11 +69,536 @@ DEBUG = False
 if DEBUG:
     from datastore import DataObjects
 
+
+class ProxySweeper(threading.Thread):
+    """
+    Periodically releases the proxies of a :class:`ProxyPool` that have been idle too long or whose thread has exited.
+    Stops once the pool is empty or gone and is started again by the pool when needed.
+
+    """
+
+    def __init__(self, sweep, interval):
+        """
+        :param sweep: Sweeps the pool, returning False once the pool is empty or gone
+        :type sweep: function
+        :param interval: The time in seconds between sweeps
+        :type interval: float
+        """
+        super(ProxySweeper, self).__init__(name='ipcclientx.ProxySweeper')
+        self.daemon = True
+        self.sweep = sweep
+        self.interval = interval
+        self.__stop = threading.Event()
+
+    def stop(self):
+        self.__stop.set()
+
+    def run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                if not self.sweep():
+                    return
+            except Exception:
+                pass
+
+
+class ProxyPool(object):
+    """
+    Thread-safe pool of kept-alive pyro4 proxies. Each thread is handed its own proxy for a given uri so that the
+    TCP connect and pyro handshake are only paid once per thread instead of once per call. Proxies that have not
+    been used for ``idle_timeout`` seconds, and those of threads that have exited, are released by a background
+    :class:`ProxySweeper`, and the number of pooled proxies is capped at ``max_proxies``. When the cap is reached and no
+    idle proxy can be evicted, a :func:`temporary() <ProxyPool.temporary>` proxy is handed out and released after the
+    call.
+
+    The server dedicates one of its worker threads to each open connection, so by default a process keeps a single
+    connection open, which is released after a couple of idle seconds, and the server's worker count (see
+    :func:`DataObjects.configure() <datastore.DataObjects.configure>`) is a count of client processes.
+
+    """
+
+    def __init__(self, max_proxies=1, idle_timeout=2.0):
+        """
+        :param max_proxies: *Optional keyword*. Maximum number of proxies kept alive at any one time
+        :type max_proxies: int
+        :param idle_timeout: *Optional keyword*. Seconds after which an unused proxy is released
+        :type idle_timeout: float
+        """
+        self.max_proxies = max_proxies
+        self.idle_timeout = idle_timeout
+        self.__lock = threading.Lock()
+        self.__proxies = {}  # (thread ident, uri) -> [proxy, last used, in use, thread]
+        self.__sweeper = None
+
+    def acquire(self, uri):
+        """
+        Returns the calling thread's proxy for the uri, creating it if needed. Must be paired with
+        :func:`release() <ProxyPool.release>` or :func:`discard() <ProxyPool.discard>`.
+
+        :param uri: The uri of the exposed object
+        :type uri: str
+        :rtype: pyro4.Proxy
+        """
+        thread = threading.current_thread()
+        key = (thread.ident, uri)
+        with self.__lock:
+            now = time.time()
+            entry = self.__proxies.get(key)
+            if entry is not None:
+                if entry[3] is thread and now - entry[1] <= self.idle_timeout:
+                    entry[1] = now
+                    entry[2] = True
+                    return entry[0]
+                # Left by an exited thread whose ident was reused, or idle for so long the server may have closed it
+                del self.__proxies[key]
+                entry[0]._pyroRelease()
+            if len(self.__proxies) >= self.max_proxies:
+                self.__evict(now)
+            if len(self.__proxies) >= self.max_proxies:
+                self.__evictlru()
+            full = len(self.__proxies) >= self.max_proxies
+            if not full:
+                entry = [pyro4.Proxy(uri), now, True, thread]
+                self.__proxies[key] = entry
+                if self.__sweeper is None:
+                    ref = weakref.ref(self)  # the sweeper must not keep the pool alive
+                    self.__sweeper = ProxySweeper(lambda: ref() is not None and ref().sweep(), self.idle_timeout / 2.0)
+                    self.__sweeper.start()
+        if full:
+            return ProxyPool.temporary(uri)
+        # Connect outside of the lock, the entry belongs to this thread only
+        try:
+            ProxyPool.connect(entry[0])
+        except Exception:
+            with self.__lock:
+                if self.__proxies.get(key) is entry:
+                    del self.__proxies[key]
+            raise
+        return entry[0]
+
+    @staticmethod
+    def connect(proxy):
+        """
+        Connects a proxy that is going to be kept alive. Nagle's algorithm is disabled on its socket: a oneway call
+        such as set() followed by another call would otherwise be held back by the server's delayed ACK.
+
+        :type proxy: pyro4.Proxy
+        """
+        proxy._pyroBind()
+        pyro4.socketutil.setNoDelay(proxy._pyroConnection.sock)
+
+    @staticmethod
+    def temporary(uri):
+        """
+        Returns a connected proxy for a single call. Its oneway methods are called as ordinary methods: its connection
+        is closed after the call, so a oneway set() could still be waiting on the server when the next call, made over
+        another connection, overtakes it.
+
+        :param uri: The uri of the exposed object
+        :type uri: str
+        :rtype: pyro4.Proxy
+        """
+        proxy = pyro4.Proxy(uri)
+        proxy._pyroBind()
+        proxy._pyroOneway.clear()
+        return proxy
+
+    def release(self, uri, proxy):
+        """
+        Returns a proxy obtained with :func:`acquire() <ProxyPool.acquire>` to the pool, keeping its connection open.
+        Temporary (overflow) proxies are closed.
+
+        :param uri: The uri the proxy was acquired for
+        :type uri: str
+        :type proxy: pyro4.Proxy
+        """
+        key = (threading.current_thread().ident, uri)
+        with self.__lock:
+            entry = self.__proxies.get(key)
+            if entry is not None and entry[0] is proxy:
+                entry[1] = time.time()
+                entry[2] = False
+                return
+        proxy._pyroRelease()
+
+    def discard(self, uri, proxy):
+        """
+        Closes a proxy whose connection failed and removes it from the pool so that the next
+        :func:`acquire() <ProxyPool.acquire>` reconnects with a fresh one.
+
+        :param uri: The uri the proxy was acquired for
+        :type uri: str
+        :type proxy: pyro4.Proxy
+        """
+        key = (threading.current_thread().ident, uri)
+        with self.__lock:
+            entry = self.__proxies.get(key)
+            if entry is not None and entry[0] is proxy:
+                del self.__proxies[key]
+        proxy._pyroRelease()
+
+    def sweep(self):
+        """
+        Releases the proxies that have been idle for ``idle_timeout`` seconds and those of threads that have exited.
+        Called periodically by the pool's :class:`ProxySweeper`.
+
+        :return: False if the pool is now empty, which stops the sweeper
+        :rtype: bool
+        """
+        with self.__lock:
+            self.__evict(time.time())
+            if self.__proxies:
+                return True
+            if self.__sweeper is not None:
+                self.__sweeper.stop()
+                self.__sweeper = None
+            return False
+
+    def closeall(self):
+        """
+        Releases every pooled proxy.
+
+        """
+        with self.__lock:
+            entries = self.__proxies.values()
+            self.__proxies = {}
+        for entry in entries:
+            entry[0]._pyroRelease()
+
+    def __len__(self):
+        return len(self.__proxies)
+
+    def __evict(self, now):
+        for key, entry in self.__proxies.items():
+            if not entry[3].is_alive() or (entry[2] is False and now - entry[1] > self.idle_timeout):
+                del self.__proxies[key]
+                entry[0]._pyroRelease()
+
+    def __evictlru(self):
+        idle = [(entry[1], key) for key, entry in self.__proxies.iteritems() if entry[2] is False]
+        if idle:
+            key = min(idle)[1]
+            self.__proxies.pop(key)[0]._pyroRelease()
+
+# Shared by all IPCClientX instances in the process, since addons typically create a new client per event
+proxypool = ProxyPool()
+
+# Items are sent by the server as (value, ts) tuples and kept in the cache in this form
+CachedData = namedtuple('CachedData', ['value', 'ts'])
+
+# Suffix of the shared memory files the server adopts, see datastore.BlobStore
+BLOB_SUFFIX = '.blob'
+
+
+class ClientCache(object):
+    """
+    Thread-safe, bounded cache of the data objects a client has received, keyed by (author, name). At most
+    ``max_entries`` items and ``max_bytes`` bytes of values are kept and the least recently used items are evicted
+    first. Either limit may be None for no limit. A value larger than ``max_bytes`` is not cached at all.
+    Supports the dict operations :class:`IPCClientX` relies on.
+
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024):
+        """
+        :param max_entries: *Optional keyword*. Maximum number of cached items
+        :type max_entries: int
+        :param max_bytes: *Optional keyword*. Maximum total size of the cached values in bytes
+        :type max_bytes: int
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+        self.__items = OrderedDict()  # key -> (data object, size), least recently used first
+        self.__bytes = 0
+        self.__maxentries = max_entries
+        self.__maxbytes = max_bytes
+
+    @property
+    def max_entries(self):
+        return self.__maxentries
+
+    @max_entries.setter
+    def max_entries(self, value):
+        with self.__lock:
+            self.__maxentries = value
+            self.__evict()
+
+    @property
+    def max_bytes(self):
+        return self.__maxbytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self.__lock:
+            self.__maxbytes = value
+            self.__evict()
+
+    @staticmethod
+    def sizeof(value):
+        """
+        Approximate size of a value in bytes, measured the same way as the server's memory accounting.
+
+        :type value: object
+        :rtype: int
+        """
+        if isinstance(value, (str, mmap.mmap)):
+            return len(value)
+        try:
+            return len(dumps(value, HIGHEST_PROTOCOL))
+        except Exception:
+            return 0
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__items.pop(key, None)
+            if entry is None:
+                return default
+            self.__items[key] = entry
+            return entry[0]
+
+    def __getitem__(self, key):
+        do = self.get(key)
+        if do is None:
+            raise KeyError(key)
+        return do
+
+    def __setitem__(self, key, do):
+        size = ClientCache.sizeof(do.value)
+        with self.__lock:
+            self.__discard(key)
+            if self.__maxbytes is not None and size > self.__maxbytes:
+                return
+            self.__items[key] = (do, size)
+            self.__bytes += size
+            self.__evict()
+
+    def __delitem__(self, key):
+        with self.__lock:
+            if self.__discard(key) is None:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+    def __len__(self):
+        return len(self.__items)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            entry = self.__discard(key)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+            self.__bytes = 0
+
+    def count(self, hit):
+        """
+        Records whether a result was served from the cache or had to be fetched from the server.
+
+        :type hit: bool
+        """
+        with self.__lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """
+        :return: The number of cached items and bytes, the limits and the hit, miss and eviction counters
+        :rtype: dict
+        """
+        with self.__lock:
+            return {'entries': len(self.__items), 'bytes': self.__bytes, 'max_entries': self.__maxentries,
+                    'max_bytes': self.__maxbytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __discard(self, key):
+        entry = self.__items.pop(key, None)
+        if entry is not None:
+            self.__bytes -= entry[1]
+        return entry
+
+    def __evict(self):
+        while self.__items and ((self.__maxentries is not None and len(self.__items) > self.__maxentries) or
+                                (self.__maxbytes is not None and self.__bytes > self.__maxbytes)):
+            self.__bytes -= self.__items.popitem(last=False)[1][1]
+            self.evictions += 1
+
+
+class ClientMetrics(object):
+    """
+    Thread-safe counters of the calls a client makes to the server: per operation, the number of calls, errors and
+    answers to use the cached copy and a latency histogram (see :class:`datastore.Metrics`), and in total, the number
+    of retries, of reconnects after the server dropped a kept-alive connection and of errors by exception type.
+    Latencies include the time spent on retries.
+
+    """
+
+    def __init__(self):
+        self.retries = 0
+        self.reconnects = 0
+        self.errors = {}  # exception class name -> count
+        self.__calls = Metrics()
+        self.__lock = threading.Lock()
+
+    def record(self, operation, seconds, retries=0, reconnects=0, error=None, cached=False):
+        """
+        :param operation: The server method called
+        :type operation: str
+        :param seconds: The time the call took, retries included
+        :type seconds: float
+        :param retries: The number of attempts made after the first
+        :type retries: int
+        :param reconnects: The number of times the connection had to be reopened
+        :type reconnects: int
+        :param error: The exception the call failed with, None on success
+        :type error: ipcclientxerrors.IPCClientError
+        :param cached: Whether the server answered to use the cached copy
+        :type cached: bool
+        """
+        self.__calls.record(operation, seconds, error is not None, int(cached))
+        if retries or reconnects or error is not None:
+            with self.__lock:
+                self.retries += retries
+                self.reconnects += reconnects
+                if error is not None:
+                    name = error.__class__.__name__
+                    self.errors[name] = self.errors.get(name, 0) + 1
+
+    def snapshot(self):
+        """
+        :return: The retry and reconnect counts, the error counts by exception type under 'errors' and, under
+                 'operations', the counters and latencies in seconds of each operation, see
+                 :func:`datastore.Metrics.snapshot`
+        :rtype: dict
+        """
+        with self.__lock:
+            ret = {'retries': self.retries, 'reconnects': self.reconnects, 'errors': dict(self.errors)}
+        ret['operations'] = self.__calls.snapshot()
+        return ret
+
+    def reset(self):
+        with self.__lock:
+            self.retries = 0
+            self.reconnects = 0
+            self.errors = {}
+        self.__calls.reset()
+
+
+class CacheListener(object):
+    """
+    Callback object registered with the server by :func:`IPCClientX.subscribe`. The server calls
+    :func:`invalidate() <CacheListener.invalidate>` whenever subscribed data changes. Keys fetched while no invalidation
+    arrived are *trusted*, meaning the client may serve them from its cache without asking the server.
+
+    """
+
+    def __init__(self, cache):
+        """
+        :param cache: The client's cache
+        :type cache: ClientCache
+        """
+        self.cache = cache
+        self.trusted = set()
+        self.generation = 0
+        self.__lock = threading.Lock()
+
+    @pyro4.callback
+    @pyro4.oneway
+    def invalidate(self, keys):
+        """
+        Drops the given keys from the client cache.
+
+        :param keys: list of (author, name) or None for all keys
+        :type keys: list or None
+        """
+        with self.__lock:
+            self.generation += 1
+            if keys is None:
+                self.trusted.clear()
+                self.cache.clear()
+            else:
+                for key in keys:
+                    key = tuple(key)
+                    self.trusted.discard(key)
+                    self.cache.pop(key, None)
+
+    def trust(self, key, generation):
+        """
+        Marks a key as trusted, unless an invalidation arrived since ``generation`` was read.
+        """
+        with self.__lock:
+            if generation == self.generation:
+                self.trusted.add(key)
+
+    def reset(self):
+        with self.__lock:
+            self.generation += 1
+            self.trusted.clear()
+
+
+class CallbackDaemon(threading.Thread):
+    """
+    Pyro daemon running in the client process to host :class:`CacheListener` objects. Started on first use and shared
+    by all IPCClientX instances.
+
+    It listens on the given host (localhost unless the server is remote), hosts nothing but the listeners and accepts
+    only the serializer the server calls back with. A pyro4 daemon copies the accepted serializers from the
+    configuration when it is created, so this one replaces its own copy and the process-wide setting, which other
+    threads may be reading, is left alone.
+
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self, host):
+        super(CallbackDaemon, self).__init__(name='ipcclientx.CallbackDaemon')
+        self.daemon = True
+        self.pyrodaemon = pyro4.Daemon(host=host)
+        serializer = pyro4.util.get_serializer(pyro4.config.SERIALIZER)
+        self.pyrodaemon._Daemon__serializer_ids = set([serializer.serializer_id])
+
+    @staticmethod
+    def instance(host='localhost'):
+        """
+        Returns the running daemon, starting it if needed.
+
+        :param host: The interface to listen on, which must be reachable from the server
+        :type host: str
+        :rtype: CallbackDaemon
+        """
+        with CallbackDaemon.__lock:
+            if CallbackDaemon.__instance is None:
+                CallbackDaemon.__instance = CallbackDaemon(host)
+                CallbackDaemon.__instance.start()
+            return CallbackDaemon.__instance
+
+    def run(self):
+        self.pyrodaemon.requestLoop()
+
+    def register(self, obj):
+        return str(self.pyrodaemon.register(obj))
+
+    def unregister(self, obj):
+        self.pyrodaemon.unregister(obj)
+
+    def stop(self):
+        with CallbackDaemon.__lock:
+            CallbackDaemon.__instance = None
+        self.pyrodaemon.shutdown()
+
+
 class IPCClientX(IPCClient):
     """
     Subclasses IPCClient from script.module.ipc and extends functionality for a datastore object
 
     """
+    MAX_WAIT = 5.0  # longest single wait_for call, see datastore.DataObjects.MAX_WAIT
 
     def __init__(self, addon_id='', name='kodi-IPC', host='localhost', port=9099, datatype='pickle'):
         """
@@ -80,24 +613,50 @@ class IPCClientX(IPCClient):
                           marshall. Must match server.
         :type datatype: str
 
-        There are two useful *public* attributes than can be changed after instantiation:
+        The following useful *public* attributes can be changed after instantiation:
 
         ==========================  =============================================================================
         ``raise_exception``:        | When set to True, will raise exceptions that can be caught rather than
                                     | failing silently, which is the default behavior.
         ``num_of_server_retries``:  | If the client fails to connect to the server, the number of retries before
                                     | failing finally.
+        ``use_connection_pool``:    | When True (default), calls are made over a kept-alive proxy from
+                                    | :class:`ProxyPool` rather than a new connection per call.
+        ``use_conditional_get``:    | When True (default), gets send the timestamp of the locally cached copy
+                                    | and the server keeps no per-requestor state. When False, the server tracks
+                                    | what each requestor has received.
+        ``blob_threshold``:         | str values of at least this many bytes (default 256 KB) are written to the
+                                    | server's shared memory directory instead of being sent through the socket
+                                    | when the server is on the same host. None to always use the socket.
+        ``cache``:                  | The local :class:`ClientCache`. Its ``max_entries`` and ``max_bytes``
+                                    | limits can be changed.
+        ``metrics_hook``:           | None, or a function called after every call to the server with the
+                                    | operation, the seconds it took, the number of retries and the exception
+                                    | it failed with (None on success). See :func:`metrics`.
         ==========================  =============================================================================
 
         """
         super(IPCClientX, self).__init__(addon_id, name, host, port, datatype)
-        self.cache = {}
+        self.cache = ClientCache()
+        self.metrics_hook = None
+        self.__metrics = ClientMetrics()
         if __callingmodule__ == 'default.py':
             self.addonname = xbmcaddon.Addon().getAddonInfo('id')
         else:
             self.addonname = 'service.ipcdatastore'
         self.raise_exception = False
         self.num_of_server_retries = 5
+        self.use_connection_pool = True
+        self.use_conditional_get = True
+        self.blob_threshold = 256 * 1024
+        self.__blobdir = ''  # the server's shared memory directory, '' until asked and None if it cannot be used
+        self.__listener = None
+        self.__callbackuri = None
+        self.__subkeys = set()
+        self.__subauthors = set()
+        self.__lease = 60.0
+        self.__renewat = 0
+        self.proxypool = proxypool
         self.ReturnData = namedtuple('Data', ['value', 'ts', 'cached'])
         if DEBUG:
             self.dos = DataObjects()
@@ -109,38 +668,81 @@ class IPCClientX(IPCClient):
         if hasattr(exc, 'tb'):
             xbmc.log(exc.tb)
 
-    def __callwrapper(self, calltype, *args):
+    def __acquireproxy(self):
+        if self.use_connection_pool:
+            return self.proxypool.acquire(self.uri)
+        else:
+            return ProxyPool.temporary(self.uri)
+
+    def __releaseproxy(self, dos, failed=False):
+        if not self.use_connection_pool:
+            dos._pyroRelease()
+        elif failed:
+            self.proxypool.discard(self.uri, dos)
+        else:
+            self.proxypool.release(self.uri, dos)
+
+    def __callwrapper(self, calltype, *args, **kwargs):
+        # calltimeout: seconds the call itself may block on the server, added to the communication timeout
+        # records: the call returns items (or a list of items) sent as (value, ts) tuples, see CachedData
+        calltimeout = kwargs.get('calltimeout')
         retries = self.num_of_server_retries
         err = -1
         do = None
         exc = None
+        start = time.time()
+        attempts = 0
+        reconnects = 0
         while retries > 0:
+            attempts += 1
+            dos = None
             try:
                 if DEBUG:
                     dos = self.dos
                 else:
-                    dos = pyro4.Proxy(self.uri)
-                do = getattr(dos, calltype)(*args)
+                    dos = self.__acquireproxy()
+                commtimeout = None if DEBUG else dos._pyroTimeout
+                if calltimeout is not None and commtimeout:
+                    dos._pyroTimeout = commtimeout + calltimeout
+                    try:
+                        do = getattr(dos, calltype)(*args)
+                    finally:
+                        dos._pyroTimeout = commtimeout
+                else:
+                    do = getattr(dos, calltype)(*args)
             except pyro4.errors.ConnectionClosedError:
+                # The kept-alive connection went away (eg server restart), drop it so the retry reconnects
                 retries -= 1
                 if not DEBUG and dos:
-                    dos._pyroReconnect()
+                    self.__releaseproxy(dos, failed=True)
                 err = ipcclientxerrors.IPCERROR_CONNECTION_CLOSED
                 exc = ipcclientxerrors.ServerReconnectFailedError
+                reconnects += 1
             except pyro4.errors.CommunicationError:
                 retries -= 1
+                if not DEBUG and dos:
+                    self.__releaseproxy(dos, failed=True)
                 err = ipcclientxerrors.IPCERROR_SERVER_TIMEOUT
             except (PickleError, PicklingError, TypeError):
                 # TypeError is what you get when using cPickle and the object is not serializable for some reason
+                if not DEBUG and dos:
+                    self.__releaseproxy(dos)
                 err = ipcclientxerrors.IPCERROR_NONSERIALIZABLE
                 break
             except Exception:
+                if not DEBUG and dos:
+                    self.__releaseproxy(dos, failed=True)
                 err = ipcclientxerrors.IPCERROR_UKNOWN
                 break
             else:
                 err = -1
                 if not DEBUG and dos:
-                    dos._pyroRelease()
+                    self.__releaseproxy(dos)
+                if kwargs.get('records'):
+                    if isinstance(do, list):
+                        do = [self.__record(x) if isinstance(x, tuple) else x for x in do]
+                    elif isinstance(do, tuple):
+                        do = self.__record(do)
                 break
         #  Client side errors
         if err == ipcclientxerrors.IPCERROR_SERVER_TIMEOUT:
@@ -153,7 +755,7 @@ class IPCClientX(IPCClient):
             exc = ipcclientxerrors.UnknownError(sys.exc_info()[1], self.get_traceback())
         # Server side errors
         elif do is not None:
-            if isinstance(do, str):
+            if isinstance(do, str) and len(do) == 1:
                 # To minimize the amount of data sent back during an error, the error is sent as a one byte string
                 err = ord(do)
                 if err == ipcclientxerrors.IPCERROR_NO_VALUE_FOUND:
@@ -164,15 +766,41 @@ class IPCClientX(IPCClient):
                     exc = ipcclientxerrors.SaveFailedError()
                 elif err == ipcclientxerrors.IPCERROR_RESTOREFAILED:
                     exc = ipcclientxerrors.RestoreFailedError()
+                elif err == ipcclientxerrors.IPCERROR_WAIT_TIMEOUT:
+                    exc = ipcclientxerrors.WaitTimeoutError()
+                elif err == ipcclientxerrors.IPCERROR_STREAM_NOT_FOUND:
+                    exc = ipcclientxerrors.StreamNotFoundError()
+                elif err == ipcclientxerrors.IPCERROR_NOT_STREAMABLE:
+                    exc = ipcclientxerrors.NotStreamableError()
+                elif err == ipcclientxerrors.IPCERROR_UPDATE_FAILED:
+                    exc = ipcclientxerrors.UpdateFailedError()
+                elif err == ipcclientxerrors.IPCERROR_CONFLICT:
+                    exc = ipcclientxerrors.ConflictError()
                 elif err != -1:
                     exc = ipcclientxerrors.UnknownError(sys.exc_info()[1], self.get_traceback())
         if exc is not None:
             exc.errno = err
         else:
             exc = ipcclientxerrors.NoError()
+        self.__measure(calltype, time.time() - start, max(attempts - 1, 0), reconnects, exc)
         return do, exc
 
-    def set(self, name, value, author=None, persist=False):
+    def __measure(self, operation, seconds, retries, reconnects, exc):
+        """
+        Records a call to the server in the client's metrics and passes it on to metrics_hook.
+        """
+        cached = exc.errno == ipcclientxerrors.IPCERROR_USE_CACHED_COPY
+        error = exc if exc.errno != -1 and not cached else None
+        self.__metrics.record(operation, seconds, retries, reconnects, error, cached)
+        hook = self.metrics_hook
+        if hook is not None:
+            try:
+                hook(operation, seconds, retries, error)
+            except Exception:
+                # Monitoring must not break the call being monitored
+                pass
+
+    def set(self, name, value, author=None, persist=False, ttl=None):
         """
         Sets a value on the server. Automatically adds the addon name as the author. The value is any valid object
         that can be accepted by the chosen datatype (see :class:`above <IPCClientX>`). If the class attribute
@@ -187,13 +815,22 @@ class IPCClientX(IPCClient):
         :type author: str
         :param persist: Flag data to be saved between Kodi sessions
         :type persist: bool
+        :param ttl: *Optional keyword*. Seconds after which the server removes the item. By default items are kept
+                    until they are deleted.
+        :type ttl: float
         :returns: True for success, False for failure
         :rtype: bool
 
         """
         if author is None:
             author = self.addonname
-        do, exc = self.__callwrapper('set', name, value, author, persist)
+        if isinstance(value, mmap.mmap):
+            value = value[:]  # a large value as returned by get
+        filename = self.__writeblob(value)
+        if filename is not None:
+            do, exc = self.__callwrapper('set_blob', name, filename, author, persist, ttl)
+        else:
+            do, exc = self.__callwrapper('set', name, value, author, persist, ttl)
         if exc.errno == ipcclientxerrors.IPCERROR_NONSERIALIZABLE:
             exc.updatemessage(value)
         if exc.errno != -1:
@@ -205,13 +842,59 @@ class IPCClientX(IPCClient):
         else:
             return True
 
-    def __setreturn(self, do, cached=False, return_tuple=False):
+    def __writeblob(self, value):
+        """
+        Writes a large str value to the server's shared memory directory (see :class:`datastore.BlobStore`) if the
+        server is on the same host.
+
+        :return: The name of the file, or None if the value is to be sent through the socket
+        :rtype: str
+        """
+        if self.blob_threshold is None or not isinstance(value, str) or len(value) < self.blob_threshold:
+            return None
+        if self.__blobdir == '' or (self.__blobdir is not None and not os.path.isdir(self.__blobdir)):
+            directory, exc = self.__callwrapper('blob_dir')
+            if exc.errno == -1 and directory is not None and os.path.isdir(directory):
+                self.__blobdir = directory
+            else:
+                self.__blobdir = None
+        if self.__blobdir is None:
+            return None
+        try:
+            fd, fn = tempfile.mkstemp(suffix=BLOB_SUFFIX, dir=self.__blobdir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+        except (IOError, OSError):
+            return None
+        return os.path.basename(fn)
+
+    def __record(self, item):
+        """
+        Turns an item as sent by the server into CachedData. A large value sent as the path of a shared memory file is
+        mapped read-only without copying it, or read through the server if the file cannot be opened here. The cache
+        holds the only reference to the mapping unless a caller asked for it (see :func:`get() <IPCClientX.get>`), so
+        the file is unmapped once the item is evicted or invalidated.
+        """
+        if len(item) == 2:
+            return CachedData._make(item)
+        path = item[2]
+        try:
+            with open(path, 'rb') as f:
+                value = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            value, exc = self.__callwrapper('read_blob', path)
+            if exc.errno != -1:
+                value = None
+        return CachedData(value, item[1])
+
+    def __setreturn(self, do, cached=False, return_tuple=False, mapped=False):
         """
         Assembles the return to be either a single object or a list of objects depending on the options during the
-        call.
-        :type do: DataObject(), None
+        call. A value mapped from a shared memory file is copied to a str unless mapped is True.
+        :type do: CachedData, None
         :type cached: bool
         :type return_tuple: bool
+        :type mapped: bool
         :return: Either the stored item or a :py:class:`collections.namedtuple` containing the stored item followed by
                  the timestamp(float) and whether or not the item was returned from the cache
         :rtype: object or namedtuple('Data', ['value', 'ts', 'cached'])
@@ -219,6 +902,8 @@ class IPCClientX(IPCClient):
         if do is not None:
             value = do.value
             ts = do.ts
+            if isinstance(value, mmap.mmap) and not mapped:
+                value = value[:]
         else:
             value = None
             ts = None
@@ -229,18 +914,18 @@ class IPCClientX(IPCClient):
         return ret
 
     def __get(self, name, author, requestor, force=False):
-        do, exc = self.__callwrapper('get', requestor, name, author, force)
+        do, exc = self.__callwrapper('get', requestor, name, author, force, records=True)
         return do, exc
 
-    def get(self, name, author=None, requestor=None, return_tuple=False):
+    def get(self, name, author=None, requestor=None, return_tuple=False, mapped=False):
         """
         Retrieves data from the server based on author and variable name, optionally returns a
         :py:func:`namedtuple <collections.namedtuple>` which also includes time stamp (float) and a bool representing
         whether or not the item came from the local cache.
-        There is a caching function implemented such that the server tracks addon requests for data - if the most recent
-        version has already been received by the client, a message is sent to the client to look in it's cache for the
-        data. There is a fallback such that if the data is NOT in the cache, the server then provides the data. Each
-        piece of data that is received is locally cached for this purpose.
+        Each piece of data that is received is locally cached. By default the timestamp of the cached copy is sent
+        with the request and if the server's copy has the same timestamp, a message is sent back to the client to use
+        its cache instead of the data. If ``use_conditional_get`` is False, the server instead tracks addon requests
+        for data and there is a fallback such that if the data is NOT in the cache, the server then provides the data.
 
         If returning a :py:func:`namedtuple <collections.namedtuple>`, the parameters can be accessed as follows::
 
@@ -249,6 +934,11 @@ class IPCClientX(IPCClient):
            x_timestamp = nt.ts
            x_was_cached = nt.cached
 
+        Large str values the server keeps in shared memory (see :class:`datastore.BlobStore`) are read from the
+        server's file. With ``mapped=True`` they are instead returned as a read-only :py:class:`mmap.mmap` of the file,
+        which supports len(), slicing and the buffer interface without the value being copied (``value[:]`` gives a
+        str). Other values are returned as usual.
+
         :param name: *Required*. The variable name
         :type name: str
         :param author: *Optional keyword*. The author of the data. All of the data is indexed by author and variable
@@ -261,6 +951,8 @@ class IPCClientX(IPCClient):
                               object, the timestamp and a bool indicating that the object came from the local cache.
                               The named tuple returns the value, ts and cached.
         :type return_tuple: bool
+        :param mapped: *Optional keyword*. Whether to return large values as a :py:class:`mmap.mmap`, see above
+        :type mapped: bool
         :return: Either the value(object) assigned to 'name' or a :py:func:`namedtuple <collections.namedtuple>`
                  containing the value, ts and/or if the item came from the local cache.
         :rtype: object or :py:func:`namedtuple <collections.namedtuple>` defined as:
@@ -272,11 +964,25 @@ class IPCClientX(IPCClient):
         if requestor is None:
             requestor = self.addonname
         idx = (author, name)
-        do, exc = self.__get(name, author, requestor)
+        pushed = self.__pushcached(idx)
+        if pushed is not None:
+            self.cache.count(True)
+            return self.__setreturn(pushed, cached=True, return_tuple=return_tuple, mapped=mapped)
+        generation = self.__listener.generation if self.__listener is not None else None
+        # Hold on to the cached copy before asking, so a 'use cached copy' answer can be served even if the entry is
+        # evicted by another thread in the meantime
+        cached = self.cache.get(idx)
+        if self.use_conditional_get:
+            ts = cached.ts if cached is not None else None
+            do, exc = self.__callwrapper('get_if_modified', name, author, ts, records=True)
+        else:
+            # Without a local copy there is nothing the server could tell us to use, so ask for the data by force
+            do, exc = self.__get(name, author, requestor, force=cached is None)
         if exc.errno == ipcclientxerrors.IPCERROR_USE_CACHED_COPY:
-            if idx in self.cache:
-                do = self.cache[idx]
-                return self.__setreturn(do, cached=True, return_tuple=return_tuple)
+            if cached is not None:
+                self.__trust(idx, generation)
+                self.cache.count(True)
+                return self.__setreturn(cached, cached=True, return_tuple=return_tuple, mapped=mapped)
             else:  # SHOULD BE IN CACHE, SO FORCE SERVER TO PROVIDE
                 do, exc = self.__get(name, author, requestor, force=True)
                 if exc.errno == ipcclientxerrors.IPCERROR_NO_VALUE_FOUND:
@@ -287,10 +993,11 @@ class IPCClientX(IPCClient):
                     if self.raise_exception:
                         raise exc
                     else:
-                        return self.__setreturn(None, return_tuple=return_tuple)
+                        return self.__setreturn(None, return_tuple=return_tuple, mapped=mapped)
                 else:
                     self.cache[idx] = do
-                    return self.__setreturn(do, return_tuple=return_tuple)
+                    self.cache.count(False)
+                    return self.__setreturn(do, return_tuple=return_tuple, mapped=mapped)
         elif exc.errno == ipcclientxerrors.IPCERROR_NO_VALUE_FOUND:
             exc.updatemessage(name, author)
         if exc.errno != -1:
@@ -298,11 +1005,352 @@ class IPCClientX(IPCClient):
             if self.raise_exception:
                 raise exc
             else:
-                return self.__setreturn(None, return_tuple=return_tuple)
+                return self.__setreturn(None, return_tuple=return_tuple, mapped=mapped)
         else:
             self.cache[idx] = do
+            self.cache.count(False)
+            self.__trust(idx, generation)
+            return self.__setreturn(do, return_tuple=return_tuple, mapped=mapped)
+
+    def wait_for(self, name, author=None, newer_than=None, timeout=10.0, return_tuple=False):
+        """
+        Waits on the server until the item is set with a timestamp newer than ``newer_than`` and returns it, so that a
+        consumer wakes up as soon as the producer calls :func:`set() <IPCClientX.set>` instead of polling with
+        :func:`get() <IPCClientX.get>`. If newer_than is None, returns as soon as the item exists. Returns None on
+        timeout (or raises WaitTimeoutError if raise_exception is True). Each waiting call holds one of the server's
+        worker threads, so longer waits are made of successive calls of at most MAX_WAIT seconds.
+
+        A typical use is to wait for a newer version of what was last seen::
+
+           nt = client.wait_for('x', author='me', newer_than=nt.ts, return_tuple=True)
+
+        :param name: *Required*. The variable name
+        :type name: str
+        :param author: *Optional keyword*. The author of the data. Defaults to the addon id.
+        :type author: str
+        :param newer_than: *Optional keyword*. A timestamp (eg the ts of a previous get) the item must be newer than
+        :type newer_than: float
+        :param timeout: *Optional keyword*. Seconds to wait
+        :type timeout: float
+        :param return_tuple: *Optional keyword*. Flag to return data as namedtuple as in :func:`get() <IPCClientX.get>`
+        :type return_tuple: bool
+        :return: The item, or None on timeout or failure
+        :rtype: object or :py:func:`namedtuple <collections.namedtuple>`
+
+        """
+        if author is None:
+            author = self.addonname
+        deadline = time.time() + timeout
+        while True:
+            wait = max(0, min(deadline - time.time(), IPCClientX.MAX_WAIT))
+            do, exc = self.__callwrapper('wait_for', name, author, newer_than, wait, calltimeout=wait, records=True)
+            if exc.errno != ipcclientxerrors.IPCERROR_WAIT_TIMEOUT or time.time() >= deadline:
+                break
+        if exc.errno == ipcclientxerrors.IPCERROR_WAIT_TIMEOUT:
+            exc.updatemessage(name, author, timeout)
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return self.__setreturn(None, return_tuple=return_tuple)
+        else:
+            self.cache[(author, name)] = do
             return self.__setreturn(do, return_tuple=return_tuple)
 
+    def update(self, name, op, args=(), author=None):
+        """
+        Applies a partial update to a dict or list stored on the server, sending only the change rather than the whole
+        value. See :func:`datastore.DataObjects.update` for the operations; :func:`set_field() <IPCClientX.set_field>`,
+        :func:`delete_field() <IPCClientX.delete_field>`, :func:`merge() <IPCClientX.merge>`,
+        :func:`append() <IPCClientX.append>`, :func:`extend() <IPCClientX.extend>` and :func:`trim() <IPCClientX.trim>`
+        are shorthands. The item gets a new timestamp, so every client's cached copy is replaced on its next get.
+
+        :param name: *Required*. The variable name
+        :type name: str
+        :param op: *Required*. The operation
+        :type op: str
+        :param args: *Optional keyword*. The arguments of the operation
+        :type args: tuple
+        :param author: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type author: str
+        :returns: True for success, False for failure
+        :rtype: bool
+
+        """
+        if author is None:
+            author = self.addonname
+        do, exc = self.__callwrapper('update', name, author, op, args)
+        if exc.errno == ipcclientxerrors.IPCERROR_NO_VALUE_FOUND:
+            exc.updatemessage(name, author)
+        elif exc.errno == ipcclientxerrors.IPCERROR_UPDATE_FAILED:
+            exc.updatemessage(name, author, op)
+        elif exc.errno == ipcclientxerrors.IPCERROR_NONSERIALIZABLE:
+            exc.updatemessage(args)
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return False
+        else:
+            return True
+
+    def set_field(self, name, key, value, author=None):
+        """
+        Sets one item of a stored dict. See :func:`update() <IPCClientX.update>`.
+
+        :rtype: bool
+        """
+        return self.update(name, 'set_field', (key, value), author)
+
+    def delete_field(self, name, key, author=None):
+        """
+        Removes one item from a stored dict, if present. See :func:`update() <IPCClientX.update>`.
+
+        :rtype: bool
+        """
+        return self.update(name, 'delete_field', (key,), author)
+
+    def merge(self, name, fields, author=None):
+        """
+        Updates a stored dict with the items of fields. See :func:`update() <IPCClientX.update>`.
+
+        :rtype: bool
+        """
+        return self.update(name, 'merge', (fields,), author)
+
+    def append(self, name, item, author=None):
+        """
+        Appends an item to a stored list. See :func:`update() <IPCClientX.update>`.
+
+        :rtype: bool
+        """
+        return self.update(name, 'append', (item,), author)
+
+    def extend(self, name, items, author=None):
+        """
+        Appends items to a stored list. See :func:`update() <IPCClientX.update>`.
+
+        :rtype: bool
+        """
+        return self.update(name, 'extend', (list(items),), author)
+
+    def trim(self, name, maxlen, author=None):
+        """
+        Keeps only the last maxlen items of a stored list. See :func:`update() <IPCClientX.update>`.
+
+        :rtype: bool
+        """
+        return self.update(name, 'trim', (maxlen,), author)
+
+    def incr(self, name, delta=1, author=None, default=0, persist=False, ttl=None):
+        """
+        Atomically adds delta to a number stored on the server and returns the result, in one round trip and without
+        losing updates made concurrently by other clients. A missing item is created as default + delta.
+
+        :param name: *Required*. The variable name
+        :type name: str
+        :param delta: *Optional keyword*. The amount to add
+        :type delta: int or float
+        :param author: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type author: str
+        :param default: *Optional keyword*. The value a missing item starts from
+        :type default: int or float
+        :param persist: *Optional keyword*. Persistence of a new item, see :func:`set() <IPCClientX.set>`
+        :type persist: bool
+        :param ttl: *Optional keyword*. Time to live of a new item, see :func:`set() <IPCClientX.set>`
+        :type ttl: float
+        :return: The new value. Returns None on failure or raises an exception.
+        :rtype: int or float
+
+        """
+        if author is None:
+            author = self.addonname
+        do, exc = self.__callwrapper('incr', name, author, delta, default, persist, ttl, records=True)
+        if exc.errno == ipcclientxerrors.IPCERROR_UPDATE_FAILED:
+            exc.updatemessage(name, author, 'incr')
+        return self.__atomicreturn((author, name), do, exc)
+
+    def decr(self, name, delta=1, author=None, default=0, persist=False, ttl=None):
+        """
+        Atomically subtracts delta from a number stored on the server and returns the result. See
+        :func:`incr() <IPCClientX.incr>`.
+
+        :rtype: int or float
+        """
+        return self.incr(name, -delta, author, default, persist, ttl)
+
+    def compare_and_set(self, name, value, ts, author=None, persist=False, ttl=None):
+        """
+        Stores value only if the item on the server still has the timestamp ts, that is if no one has changed it since
+        it was read with ``get(..., return_tuple=True)``. With ts None the value is only stored if the item does not
+        exist. Typically used in a loop::
+
+           while True:
+               nt = client.get('queue', return_tuple=True)
+               if client.compare_and_set('queue', (nt.value or []) + ['new'], nt.ts):
+                   break
+
+        :param name: *Required*. The variable name
+        :type name: str
+        :param value: *Required*. The new value
+        :type value: Any object type compatible with the datatype transport
+        :param ts: *Required*. The timestamp of the version expected on the server, or None
+        :type ts: float
+        :param author: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type author: str
+        :param persist: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type persist: bool
+        :param ttl: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type ttl: float
+        :return: True if the value was stored, False if the item had been changed or on failure
+        :rtype: bool
+
+        """
+        if author is None:
+            author = self.addonname
+        do, exc = self.__callwrapper('compare_and_set', name, value, author, ts, persist, ttl, records=True)
+        if exc.errno == ipcclientxerrors.IPCERROR_CONFLICT:
+            return False
+        elif exc.errno == ipcclientxerrors.IPCERROR_NONSERIALIZABLE:
+            exc.updatemessage(value)
+        self.__atomicreturn((author, name), do, exc)
+        return exc.errno == -1
+
+    def setdefault(self, name, value, author=None, persist=False, ttl=None, return_tuple=False):
+        """
+        Stores value if the item does not exist on the server and returns the item then stored, like dict.setdefault.
+        Atomic, so of several clients racing to initialize an item exactly one succeeds and all see its value.
+
+        :param name: *Required*. The variable name
+        :type name: str
+        :param value: *Required*. The value to store if the item does not exist
+        :type value: Any object type compatible with the datatype transport
+        :param author: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type author: str
+        :param persist: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type persist: bool
+        :param ttl: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type ttl: float
+        :param return_tuple: *Optional keyword*. See :func:`get() <IPCClientX.get>`
+        :type return_tuple: bool
+        :return: The stored value. Returns None on failure or raises an exception.
+        :rtype: object or namedtuple
+
+        """
+        if author is None:
+            author = self.addonname
+        do, exc = self.__callwrapper('setdefault', name, value, author, persist, ttl, records=True)
+        if exc.errno == ipcclientxerrors.IPCERROR_NONSERIALIZABLE:
+            exc.updatemessage(value)
+        self.__atomicreturn((author, name), do, exc)
+        return self.__setreturn(do if exc.errno == -1 else None, return_tuple=return_tuple)
+
+    def __atomicreturn(self, idx, do, exc):
+        """
+        Caches the item returned by an atomic operation, so that a following get is answered from the cache, and
+        returns its value. Logs and returns None or raises on failure.
+        """
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            return None
+        self.cache[idx] = do
+        return do.value
+
+    def set_stream(self, name, chunks, author=None, persist=False, ttl=None):
+        """
+        Stores a large str value sent to the server in chunks, so that neither end holds more than a chunk of it in a
+        message. The value is stored once every chunk has arrived. A file can be sent without reading it whole::
+
+           with open(fn, 'rb') as f:
+               client.set_stream('library', iter(lambda: f.read(65536), ''))
+
+        :param name: *Required*. The variable name
+        :type name: str
+        :param chunks: *Required*. An iterable of str chunks
+        :type chunks: iterable
+        :param author: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type author: str
+        :param persist: Flag data to be saved between Kodi sessions
+        :type persist: bool
+        :param ttl: *Optional keyword*. See :func:`set() <IPCClientX.set>`
+        :type ttl: float
+        :returns: True for success, False for failure
+        :rtype: bool
+
+        """
+        if author is None:
+            author = self.addonname
+        sid, exc = self.__callwrapper('set_stream', name, author, persist, ttl)
+        if exc.errno == -1:
+            try:
+                for chunk in chunks:
+                    do, exc = self.__callwrapper('write_stream', sid, chunk)
+                    if exc.errno != -1:
+                        break
+            except Exception:
+                self.__callwrapper('close_stream', sid, False)
+                raise
+            if exc.errno == -1:
+                do, exc = self.__callwrapper('close_stream', sid)
+            else:
+                self.__callwrapper('close_stream', sid, False)
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return False
+        else:
+            return True
+
+    def get_stream(self, name, author=None, chunk_size=65536):
+        """
+        Generator yielding a large str value in chunks of chunk_size bytes as they arrive from the server, so that the
+        value need not be held whole and processing can start before the transfer has finished. The value is read as
+        it was when the first chunk was requested. Nothing is cached. On failure nothing more is yielded, or an
+        exception is raised if raise_exception is True. Only str values can be streamed.
+
+        ::
+
+           with open(fn, 'wb') as f:
+               for chunk in client.get_stream('library'):
+                   f.write(chunk)
+
+        :param name: *Required*. The variable name
+        :type name: str
+        :param author: *Optional keyword*. See :func:`get() <IPCClientX.get>`
+        :type author: str
+        :param chunk_size: *Optional keyword*. The size of the chunks in bytes
+        :type chunk_size: int
+        :rtype: generator of str
+
+        """
+        if author is None:
+            author = self.addonname
+        opened, exc = self.__callwrapper('get_stream', name, author, chunk_size)
+        if exc.errno in (ipcclientxerrors.IPCERROR_NO_VALUE_FOUND, ipcclientxerrors.IPCERROR_NOT_STREAMABLE):
+            exc.updatemessage(name, author)
+        finished = exc.errno != -1
+        try:
+            while not finished:
+                chunks, exc = self.__callwrapper('read_stream', opened[0])
+                if exc.errno != -1 or not chunks:
+                    finished = True
+                else:
+                    yield chunks[0]
+        finally:
+            if not finished:
+                # The consumer stopped early
+                self.__callwrapper('close_stream', opened[0], False)
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+
     def delete(self, name, author=None, return_tuple=False):
         """
         Deletes an item from the datastore and returns the deleted item's value. Returns None if not found or raises
@@ -321,7 +1369,7 @@ class IPCClientX(IPCClient):
         """
         if author is None:
             author = self.addonname
-        do, exc = self.__callwrapper('delete', name, author)
+        do, exc = self.__callwrapper('delete', name, author, records=True)
         if exc.errno == ipcclientxerrors.IPCERROR_NO_VALUE_FOUND:
             exc.updatemessage(name, author)
         if exc.errno != -1:
@@ -332,10 +1380,256 @@ class IPCClientX(IPCClient):
                 return self.__setreturn(None, return_tuple=return_tuple)
         else:
             idx = (author, name)
-            if idx in self.cache:
-                del self.cache[idx]
+            self.cache.pop(idx)
             return self.__setreturn(do, return_tuple=return_tuple)
 
+    def __normalizekeys(self, names, author):
+        """
+        Converts a list of variable names and/or (author, name) tuples into a list of (author, name) keys.
+        """
+        if author is None:
+            author = self.addonname
+        keys = []
+        for name in names:
+            if isinstance(name, tuple):
+                keys.append((name[0], name[1]))
+            else:
+                keys.append((author, name))
+        return keys
+
+    def mset(self, values, author=None, persist=False, ttl=None):
+        """
+        Sets many values on the server in a single call. See :func:`set() <IPCClientX.set>`.
+
+        :param values: *Required*. A dict of values keyed by variable name or by an (author, name) tuple
+        :type values: dict
+        :param author: *Optional keyword*. The author used for keys that are plain variable names. Defaults to the
+                        addon id.
+        :type author: str
+        :param persist: Flag all of the data to be saved between Kodi sessions
+        :type persist: bool
+        :param ttl: *Optional keyword*. Seconds after which the server removes the items
+        :type ttl: float
+        :returns: True for success, False for failure
+        :rtype: bool
+
+        """
+        names = values.keys()
+        keys = self.__normalizekeys(names, author)
+        items = {}
+        for name, key in zip(names, keys):
+            items[key] = values[name]
+        do, exc = self.__callwrapper('mset', items, persist, ttl)
+        if exc.errno == ipcclientxerrors.IPCERROR_NONSERIALIZABLE:
+            exc.updatemessage(values)
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return False
+        else:
+            return True
+
+    def mget(self, names, author=None, requestor=None, return_tuple=False):
+        """
+        Retrieves many values from the server in a single call. Caching works per key exactly as in
+        :func:`get() <IPCClientX.get>`. Values that are not found are returned as None (or raise VarNotFoundError
+        if raise_exception is True).
+
+        :param names: *Required*. A list of variable names and/or (author, name) tuples
+        :type names: list
+        :param author: *Optional keyword*. The author used for plain variable names. Defaults to the addon id.
+        :type author: str
+        :param requestor: *Optional keyword*. The name of the requestor of the data. Defaults to the addon id.
+        :type requestor: str
+        :param return_tuple: *Optional keyword*. Return each value as a namedtuple as in
+                              :func:`get() <IPCClientX.get>`
+        :type return_tuple: bool
+        :return: A dict keyed by the items in names. Returns None on failure.
+        :rtype: dict
+
+        """
+        if requestor is None:
+            requestor = self.addonname
+        keys = self.__normalizekeys(names, author)
+        # Copies held for the duration of the call, so that entries evicted meanwhile can still be served
+        cached = {}
+        for key in keys:
+            do = self.cache.get(key)
+            if do is not None:
+                cached[key] = do
+        if self.use_conditional_get:
+            dos, exc = self.__callwrapper('mget_if_modified', [key + ((cached[key].ts if key in cached else None),)
+                                                               for key in keys], records=True)
+        else:
+            dos, exc = self.__callwrapper('mget', requestor, keys, not cached, records=True)
+        if exc.errno == -1 and not self.use_conditional_get:
+            # Anything the server expects us to have cached but which is not, is requested again by force
+            missing = [key for key, do in zip(keys, dos) if isinstance(do, str) and
+                       ord(do) == ipcclientxerrors.IPCERROR_USE_CACHED_COPY and key not in cached]
+            if missing:
+                forced, exc = self.__callwrapper('mget', requestor, missing, True, records=True)
+                if exc.errno == -1:
+                    forced = dict(zip(missing, forced))
+                    dos = [forced.get(key, do) for key, do in zip(keys, dos)]
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return None
+        ret = {}
+        notfound = None
+        for name, key, do in zip(names, keys, dos):
+            fromcache = False
+            if isinstance(do, str):
+                if ord(do) == ipcclientxerrors.IPCERROR_USE_CACHED_COPY:
+                    do = cached[key]
+                    fromcache = True
+                else:
+                    if notfound is None:
+                        notfound = key
+                    do = None
+            else:
+                self.cache[key] = do
+            if do is not None:
+                self.cache.count(fromcache)
+            ret[name] = self.__setreturn(do, cached=fromcache, return_tuple=return_tuple)
+        if notfound is not None:
+            exc = ipcclientxerrors.VarNotFoundError()
+            exc.errno = ipcclientxerrors.IPCERROR_NO_VALUE_FOUND
+            exc.updatemessage(notfound[1], notfound[0])
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+        return ret
+
+    def mdelete(self, names, author=None, return_tuple=False):
+        """
+        Deletes many items from the datastore in a single call and returns the deleted values. Items not found are
+        returned as None.
+
+        :param names: *Required*. A list of variable names and/or (author, name) tuples
+        :type names: list
+        :param author: *Optional keyword*. The author used for plain variable names. Defaults to the addon id.
+        :type author: str
+        :param return_tuple: *Optional keyword*. Return each value as a namedtuple as in
+                              :func:`get() <IPCClientX.get>`
+        :type return_tuple: bool
+        :return: A dict keyed by the items in names. Returns None on failure.
+        :rtype: dict
+
+        """
+        keys = self.__normalizekeys(names, author)
+        dos, exc = self.__callwrapper('mdelete', keys, records=True)
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return None
+        ret = {}
+        for name, key, do in zip(names, keys, dos):
+            self.cache.pop(key)
+            if isinstance(do, str):
+                do = None
+            ret[name] = self.__setreturn(do, return_tuple=return_tuple)
+        return ret
+
+    def subscribe(self, names=None, author=None, lease=60.0):
+        """
+        Subscribes to server-push invalidations for the given variables, or for every variable of the author if no
+        names are given. While the subscription is live, :func:`get() <IPCClientX.get>` serves subscribed values
+        straight from the local cache without contacting the server. The server drops the cached copy on the client
+        as soon as the data is set, deleted or cleared. The subscription is renewed automatically every ``lease``/2
+        seconds during gets. Call :func:`unsubscribe() <IPCClientX.unsubscribe>` when done.
+
+        :param names: *Optional keyword*. A list of variable names and/or (author, name) tuples
+        :type names: list or None
+        :param author: *Optional keyword*. The author of the data. Defaults to the addon id.
+        :type author: str
+        :param lease: *Optional keyword*. Seconds after which the server drops a subscription that was not renewed
+        :type lease: float
+        :return: True on success, False on failure
+        :rtype: bool
+
+        """
+        if names is None:
+            self.__subauthors.add(author if author is not None else self.addonname)
+        else:
+            self.__subkeys.update(self.__normalizekeys(names, author))
+        self.__lease = lease
+        if self.__listener is None:
+            host = pyro4.core.URI(self.uri).host
+            if host not in ('localhost', '127.0.0.1'):
+                host = pyro4.socketutil.getInterfaceAddress(host)
+            self.__listener = CacheListener(self.cache)
+            self.__callbackuri = CallbackDaemon.instance(host).register(self.__listener)
+        return self.__renewsubscription()
+
+    def unsubscribe(self):
+        """
+        Cancels all subscriptions made with :func:`subscribe() <IPCClientX.subscribe>`.
+
+        :return: True on success, False on failure
+        :rtype: bool
+
+        """
+        if self.__listener is None:
+            return True
+        do, exc = self.__callwrapper('unsubscribe', self.__callbackuri)
+        CallbackDaemon.instance().unregister(self.__listener)
+        self.__listener = None
+        self.__callbackuri = None
+        self.__subkeys = set()
+        self.__subauthors = set()
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return False
+        else:
+            return True
+
+    def __renewsubscription(self):
+        existed, exc = self.__callwrapper('subscribe', self.__callbackuri, list(self.__subkeys),
+                                          list(self.__subauthors), self.__lease)
+        if exc.errno != -1:
+            self.__renewat = 0
+            self.__listener.reset()
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            return False
+        if not existed:
+            # Invalidations may have been missed while the server did not know about us
+            self.__listener.reset()
+        self.__renewat = time.time() + self.__lease / 2.0
+        return True
+
+    def __subscribed(self, idx):
+        return idx in self.__subkeys or idx[0] in self.__subauthors
+
+    def __pushcached(self, idx):
+        """
+        Returns the cached copy of idx if it can be served without contacting the server, otherwise None.
+        """
+        listener = self.__listener
+        if listener is None or not self.__subscribed(idx):
+            return None
+        if time.time() > self.__renewat:
+            if not self.__renewsubscription():
+                return None
+        if idx in listener.trusted:
+            return self.cache.get(idx)
+        return None
+
+    def __trust(self, idx, generation):
+        if self.__listener is not None and self.__subscribed(idx):
+            self.__listener.trust(idx, generation)
+
     def get_data_list(self, author=None):
         """
         Retrieves either a dict or list containing the variables names stored on the server.
@@ -357,6 +1651,65 @@ class IPCClientX(IPCClient):
         else:
             return dl
 
+    def scan(self, prefix='', author=None, pattern=None, cursor=None, limit=100, values=False, return_tuple=False):
+        """
+        Retrieves a page of the keys stored on the server in (author, name) order, optionally with their values.
+        Namespaced names such as 'player.video.fps' can be listed by prefix ('player.video.') or by glob
+        ('player.*.fps'). Pass the returned cursor back to get the next page, or use
+        :func:`iterscan() <IPCClientX.iterscan>`.
+
+        :param prefix: *Optional keyword*. The start of the names to list
+        :type prefix: str
+        :param author: *Optional keyword*. The author whose keys are listed. Defaults to all authors.
+        :type author: str or None
+        :param pattern: *Optional keyword*. A case sensitive glob the names must match (see :mod:`fnmatch`)
+        :type pattern: str or None
+        :param cursor: *Optional keyword*. The cursor returned with the previous page
+        :type cursor: tuple or None
+        :param limit: *Optional keyword*. The number of keys per page, at most 1000
+        :type limit: int
+        :param values: *Optional keyword*. Whether to retrieve the values along with the keys
+        :type values: bool
+        :param return_tuple: *Optional keyword*. Return each value as a namedtuple as in
+                              :func:`get() <IPCClientX.get>`
+        :type return_tuple: bool
+        :return: A list of (author, name) keys, or of (key, value) pairs if values is True, and the cursor for the
+                 next page, None once the scan is complete. Returns None on failure or raises an exception.
+        :rtype: tuple (list, tuple)
+
+        """
+        do, exc = self.__callwrapper('scan', prefix, author, pattern, cursor, limit, values)
+        if exc.errno != -1:
+            self.logexception(exc)
+            if self.raise_exception:
+                raise exc
+            else:
+                return None
+        page, cursor = do
+        if values:
+            page = [(tuple(key), self.__setreturn(self.__record(item), return_tuple=return_tuple))
+                    for key, item in page]
+        else:
+            page = [tuple(key) for key in page]
+        return page, (tuple(cursor) if cursor is not None else None)
+
+    def iterscan(self, prefix='', author=None, pattern=None, limit=100, values=False, return_tuple=False):
+        """
+        Generator over all the keys (or (key, value) pairs) matched by :func:`scan() <IPCClientX.scan>`, retrieved
+        a page of limit keys at a time. Keys stored or deleted during the iteration may or may not be seen.
+
+        """
+        cursor = None
+        while True:
+            ret = self.scan(prefix, author, pattern, cursor, limit, values, return_tuple)
+            if ret is None:
+                return
+            page, cursor = ret
+            for item in page:
+                yield item
+            if cursor is None:
+                return
+
     def clearall(self):
         """
         Clears all of the data on the server. Use with caution if multiple users are storing data.
@@ -366,7 +1719,7 @@ class IPCClientX(IPCClient):
 
         """
         do, exc = self.__callwrapper('clearall')
-        self.cache = {}
+        self.cache.clear()
         if exc.errno != -1:
             if self.raise_exception:
                 self.logexception(exc)
@@ -385,7 +1738,7 @@ class IPCClientX(IPCClient):
 
         """
         do, exc = self.__callwrapper('clearcache', self.addonname)
-        self.cache = {}
+        self.cache.clear()
         if exc.errno != -1:
             if self.raise_exception:
                 self.logexception(exc)
@@ -495,7 +1848,7 @@ class IPCClientX(IPCClient):
 
     def add_persistence(self, varname, author=None):
         """
-        Adds a persistence tag to a pre-existing stored object and saves data to backup.
+        Adds a persistence tag to a pre-existing stored object and records it in the persistence log.
 
         :param varname:
         :type varname: str
@@ -518,7 +1871,7 @@ class IPCClientX(IPCClient):
 
     def remove_persistence(self, varname, author=None):
         """
-        Removes the persistence tag from a stored object and deletes it from backup.
+        Removes the persistence tag from a stored object and records it in the persistence log.
 
         :param varname:
         :type varname: str
@@ -539,3 +1892,110 @@ class IPCClientX(IPCClient):
         else:
             return True
 
+    def persistence_stats(self):
+        """
+        Retrieves the state of the server's persistence log writer: the queue depth, the number of records queued,
+        coalesced and written, how often callers were blocked waiting for the writer and the last, average and maximum
+        flush latency in seconds.
+
+        :return: A dict of counters, empty if the server does not persist data. Returns None on failure or raises an
+                 exception.
+        :rtype: dict
+        """
+        stats, exc = self.__callwrapper('persistence_stats')
+        if exc.errno != -1:
+            if self.raise_exception:
+                self.logexception(exc)
+                raise exc
+            else:
+                return None
+        else:
+            return stats
+
+    def expiry_stats(self):
+        """
+        Retrieves the server's counters for items stored with a time to live: the number of expiry times scheduled, and
+        the number of items removed by the background sweeper and found expired when accessed.
+
+        :return: A dict of counters. Returns None on failure or raises an exception.
+        :rtype: dict
+        """
+        stats, exc = self.__callwrapper('expiry_stats')
+        if exc.errno != -1:
+            if self.raise_exception:
+                self.logexception(exc)
+                raise exc
+            else:
+                return None
+        else:
+            return stats
+
+    def memory_stats(self):
+        """
+        Retrieves the server's memory accounting: the budget in bytes (None for no limit), the bytes used by the stored
+        values in total and per author, the number of items, the number that can be evicted and the number of items and
+        bytes evicted so far. Sizes are measured as the serialized size of the values.
+
+        :return: A dict of counters. Returns None on failure or raises an exception.
+        :rtype: dict
+        """
+        stats, exc = self.__callwrapper('memory_stats')
+        if exc.errno != -1:
+            if self.raise_exception:
+                self.logexception(exc)
+                raise exc
+            else:
+                return None
+        else:
+            return stats
+
+    def stats(self):
+        """
+        Retrieves the server's operation metrics: the number of keys, of keys tagged for persistence, the bytes used
+        by the values, the persistence log writer's queue depth and the uptime in seconds, and under 'methods', for
+        each method called, the number of calls, errors and items answered with the client's cached copy, the average,
+        maximum and 50th, 90th and 99th percentile latency in seconds and the latency histogram.
+
+        :return: A dict of counters. Returns None on failure or raises an exception.
+        :rtype: dict
+        """
+        stats, exc = self.__callwrapper('stats')
+        if exc.errno != -1:
+            if self.raise_exception:
+                self.logexception(exc)
+                raise exc
+            else:
+                return None
+        else:
+            return stats
+
+    def cache_stats(self):
+        """
+        Returns the local cache's counters: the number of cached items and bytes, its limits, the number of results
+        served from the cache (hits) or fetched from the server (misses) and the number of items evicted. No call is
+        made to the server.
+
+        :rtype: dict
+        """
+        return self.cache.stats()
+
+    def metrics(self):
+        """
+        Returns the client's own counters: for each server operation, the number of calls, errors and answers to use
+        the cached copy with the average, maximum and 50th, 90th and 99th percentile latency in seconds and the
+        latency histogram (under 'operations'), the number of retries and of reconnects, the number of errors by
+        exception type (under 'errors') and the local cache's counters (under 'cache', see
+        :func:`cache_stats() <IPCClientX.cache_stats>`). No call is made to the server.
+
+        :rtype: dict
+        """
+        ret = self.__metrics.snapshot()
+        ret['cache'] = self.cache.stats()
+        return ret
+
+    def reset_metrics(self):
+        """
+        Zeroes the counters returned by :func:`metrics() <IPCClientX.metrics>`, except those of the local cache.
+
+        """
+        self.__metrics.reset()
@@ -0,0 +1,441 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 KenV99
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import threading
+import traceback
+import Queue
+
+# required modules that should be in local path
+from resources.lib.ipcclientx import IPCClientX, ProxyPool
+import resources.lib.ipcclientxerrors as ipcclientxerrors
+
+
+class AsyncResult(object):
+    """
+    The future result of a call made through :class:`AsyncIPCClientX`, with the interface of pyro4's FutureResult:
+    ``value`` waits for the result and raises the exception of a failed call, ``ready`` and ``wait(timeout)`` poll,
+    ``then(call)`` chains a call on the value and ``iferror(handler)`` is called with the exception instead.
+    """
+
+    def __init__(self):
+        self.__ready = threading.Event()
+        self.__lock = threading.Lock()
+        self.__value = None
+        self.__excinfo = None  # sys.exc_info() of a failed call
+        self.__chain = []
+        self.__handler = None
+        self.__handled = False  # whether the handler was called with the exception
+        self.__running = False  # whether a thread is running the callbacks
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: *Optional keyword*. The most seconds to wait, None to wait as long as needed
+        :type timeout: float
+        :return: True if the result is ready
+        :rtype: bool
+        """
+        self.__ready.wait(timeout)
+        return self.__ready.is_set()
+
+    @property
+    def ready(self):
+        return self.__ready.is_set()
+
+    @property
+    def value(self):
+        self.__ready.wait()
+        excinfo = self.__excinfo
+        if excinfo is not None:
+            raise excinfo[0], excinfo[1], excinfo[2]
+        return self.__value
+
+    def set_value(self, value):
+        with self.__lock:
+            self.__value = value
+        self.__runcallbacks()
+
+    def set_exception(self, excinfo):
+        """
+        :param excinfo: The sys.exc_info() of the failed call
+        :type excinfo: tuple
+        """
+        with self.__lock:
+            self.__excinfo = excinfo
+        self.__runcallbacks()
+
+    def then(self, call, *args, **kwargs):
+        """
+        Calls call with the value, and any extra arguments, once the result is ready, on the thread that makes it
+        ready (or at once if it is). What it returns replaces the value. Not called if the call failed.
+
+        :return: self, to chain further calls
+        :rtype: AsyncResult
+        """
+        with self.__lock:
+            self.__chain.append((call, args, kwargs))
+            ready = self.__ready.is_set()
+        if ready:
+            self.__runcallbacks()
+        return self
+
+    def iferror(self, handler):
+        """
+        Calls handler with the exception if the call fails. An exception raised by the handler is logged.
+
+        :return: self, to chain further calls
+        :rtype: AsyncResult
+        """
+        with self.__lock:
+            self.__handler = handler
+            self.__handled = False
+            ready = self.__ready.is_set()
+        if ready:
+            self.__runcallbacks()
+        return self
+
+    def __runcallbacks(self):
+        """
+        Runs the callbacks and the error handler that are due, in order and outside the lock, so that they may use the
+        result themselves. Callbacks added meanwhile, from the callbacks too, are run by the thread already running
+        them. The result is made ready, under the lock, once none is left, so that a waiter sees the final value.
+        """
+        with self.__lock:
+            if self.__running:
+                return
+            self.__running = True
+        try:
+            while True:
+                with self.__lock:
+                    if self.__excinfo is None and self.__chain:
+                        call, args, kwargs = self.__chain.pop(0)
+                        value = self.__value
+                    elif self.__excinfo is not None and self.__handler is not None and not self.__handled:
+                        call = None
+                        handler = self.__handler
+                        self.__handled = True
+                        exc = self.__excinfo[1]
+                    else:
+                        if self.__excinfo is not None:
+                            self.__chain = []
+                        self.__running = False
+                        self.__ready.set()
+                        return
+                if call is not None:
+                    try:
+                        value = call(value, *args, **kwargs)
+                    except Exception:
+                        excinfo = sys.exc_info()
+                        with self.__lock:
+                            self.__excinfo = excinfo
+                    else:
+                        with self.__lock:
+                            self.__value = value
+                else:
+                    try:
+                        handler(exc)
+                    except Exception:
+                        AsyncResult.logexception()
+        finally:
+            with self.__lock:
+                if self.__running:  # left by an unexpected exception, the result must still become ready
+                    self.__running = False
+                    self.__ready.set()
+
+    @staticmethod
+    def logexception():
+        """
+        Logs the exception being handled, raised by a callback where nobody is waiting to catch it.
+        """
+        IPCClientX.logexception(ipcclientxerrors.UnknownError(sys.exc_info()[1], traceback.format_exc()))
+
+
+class AsyncJob(object):
+    """
+    A call waiting for an :class:`AsyncWorker`, with the result it is to be delivered to.
+    """
+    __slots__ = ('result', 'method', 'args', 'kwargs')
+
+    def __init__(self, result, method, args, kwargs):
+        self.result = result
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+
+class AsyncWorker(threading.Thread):
+    """
+    Carries out the calls queued by an :class:`AsyncIPCClientX` over its own kept-alive connection. Gets found waiting
+    in the queue behind a get are coalesced into a single :func:`mget() <ipcclientx.IPCClientX.mget>`, so a burst of
+    gets costs a few round trips rather than one each.
+    """
+    STOP = 'stop'  # queued once per worker by AsyncIPCClientX.close()
+
+    def __init__(self, queue, client, max_batch):
+        """
+        :param queue: The queue of AsyncJob
+        :type queue: Queue.Queue
+        :param client: The client making the calls
+        :type client: IPCClientX
+        :param max_batch: The most gets coalesced into one mget
+        :type max_batch: int
+        """
+        super(AsyncWorker, self).__init__(name='ipcdatastore.AsyncWorker')
+        self.daemon = True
+        self.queue = queue
+        self.client = client
+        self.max_batch = max_batch
+
+    def run(self):
+        job = self.queue.get()
+        while job is not AsyncWorker.STOP:
+            following = None
+            batch = [job]
+            try:
+                if job.method == 'get' and not job.args[4] and not self.client.raise_exception:
+                    while len(batch) < self.max_batch:
+                        try:
+                            following = self.queue.get_nowait()
+                        except Queue.Empty:
+                            following = None
+                            break
+                        if following is not AsyncWorker.STOP and following.method == 'get' and \
+                                following.args[2] == job.args[2] and not following.args[4]:
+                            batch.append(following)
+                            following = None
+                        else:
+                            break
+                    self.getmany(batch)
+                else:
+                    self.call(job)
+            except Exception:
+                # One bad job must neither stop the worker nor leave the results of its batch waiting forever
+                AsyncResult.logexception()
+                excinfo = sys.exc_info()
+                for pending in batch:
+                    if not pending.result.ready:
+                        pending.result.set_exception(excinfo)
+            job = following if following is not None else self.queue.get()
+
+    def call(self, job):
+        try:
+            value = getattr(self.client, job.method)(*job.args, **job.kwargs)
+        except Exception:
+            job.result.set_exception(sys.exc_info())
+        else:
+            job.result.set_value(value)
+
+    def getmany(self, batch):
+        """
+        Delivers the gets in batch, all for the same requestor, from a single mget.
+        """
+        if len(batch) == 1:
+            self.call(batch[0])
+            return
+        keys = [(job.args[1], job.args[0]) for job in batch]
+        try:
+            ret = self.client.mget(keys, requestor=batch[0].args[2], return_tuple=True)
+        except Exception:
+            excinfo = sys.exc_info()
+            for job in batch:
+                job.result.set_exception(excinfo)
+            return
+        for job, key in zip(batch, keys):
+            nt = ret[key] if ret is not None else self.client.ReturnData(None, None, False)
+            job.result.set_value(nt if job.args[3] else nt.value)
+
+
+class AsyncIPCClientX(object):
+    """
+    Non-blocking counterpart of :class:`ipcclientx.IPCClientX`, for scripts that want to overlap calls to the
+    datastore with other work or with each other without managing threads. Each call returns at once with an
+    :class:`AsyncResult`: read its ``value`` to wait for the result (exceptions are raised there), check ``ready`` or
+    ``wait(timeout)`` to poll, or register a callback with ``then(callback)``; callbacks run on a worker thread. The
+    results and exceptions are those of the same call on IPCClientX.
+
+    The calls are queued and carried out by up to ``max_connections`` worker threads, each with its own kept-alive
+    connection from the client's own :class:`ipcclientx.ProxyPool`. At most ``max_pending`` calls wait in the queue;
+    beyond that, making a call blocks until there is room. Gets waiting in the queue are coalesced into mgets, so
+    hundreds of outstanding gets cost a few round trips.
+
+    Kodi's Python 2 has no asyncio, hence futures rather than coroutines.
+    """
+    MAX_BATCH = 64
+
+    def __init__(self, addon_id='', name='kodi-IPC', host='localhost', port=9099, datatype='pickle', max_connections=8,
+                 max_pending=1024):
+        """
+        :param addon_id: *Optional keyword*. See :class:`ipcclientx.IPCClientX`
+        :type addon_id: str
+        :param name: *Optional keyword*. See :class:`ipcclientx.IPCClientX`
+        :type name: str
+        :param port: *Optional keyword*. See :class:`ipcclientx.IPCClientX`
+        :type port: int
+        :param datatype: *Optional keyword*. See :class:`ipcclientx.IPCClientX`
+        :type datatype: str
+        :param max_connections: *Optional keyword*. The number of calls carried out at the same time, each over its
+                                own connection
+        :type max_connections: int
+        :param max_pending: *Optional keyword*. The number of calls that may wait to be carried out
+        :type max_pending: int
+
+        The IPCClientX making the calls is available as ``client``, to change its settings (``raise_exception``,
+        ``cache`` limits...) or read its :func:`metrics() <ipcclientx.IPCClientX.metrics>`.
+
+        """
+        self.client = IPCClientX(addon_id, name, host, port, datatype)
+        self.client.proxypool = ProxyPool(max_proxies=max_connections)
+        self.max_connections = max_connections
+        self.max_batch = AsyncIPCClientX.MAX_BATCH
+        self.__queue = Queue.Queue(max_pending)
+        self.__workers = []
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Queues a call to any method of IPCClientX.
+
+        :param method: The name of the IPCClientX method
+        :type method: str
+        :return: The future result of the call
+        :rtype: AsyncResult
+        """
+        if self.__closed:
+            raise RuntimeError('AsyncIPCClientX is closed')
+        if len(self.__workers) < self.max_connections:
+            with self.__lock:
+                while len(self.__workers) < self.max_connections:
+                    worker = AsyncWorker(self.__queue, self.client, self.max_batch)
+                    worker.start()
+                    self.__workers.append(worker)
+        result = AsyncResult()
+        self.__queue.put(AsyncJob(result, method, args, kwargs))
+        return result
+
+    def get(self, name, author=None, requestor=None, return_tuple=False, mapped=False):
+        """
+        See :func:`ipcclientx.IPCClientX.get`.
+
+        :rtype: AsyncResult
+        """
+        author = author if author is not None else self.client.addonname
+        requestor = requestor if requestor is not None else self.client.addonname
+        return self.submit('get', name, author, requestor, return_tuple, mapped)
+
+    def set(self, name, value, author=None, persist=False, ttl=None):
+        """
+        See :func:`ipcclientx.IPCClientX.set`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('set', name, value, author, persist, ttl)
+
+    def delete(self, name, author=None, return_tuple=False):
+        """
+        See :func:`ipcclientx.IPCClientX.delete`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('delete', name, author, return_tuple)
+
+    def get_data_list(self, author=None):
+        """
+        See :func:`ipcclientx.IPCClientX.get_data_list`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('get_data_list', author)
+
+    def savedata(self, author=None):
+        """
+        See :func:`ipcclientx.IPCClientX.savedata`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('savedata', author)
+
+    def restoredata(self, author=None):
+        """
+        See :func:`ipcclientx.IPCClientX.restoredata`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('restoredata', author)
+
+    def delete_data(self, author=None):
+        """
+        See :func:`ipcclientx.IPCClientX.delete_data`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('delete_data', author)
+
+    def add_persistence(self, varname, author=None):
+        """
+        See :func:`ipcclientx.IPCClientX.add_persistence`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('add_persistence', varname, author)
+
+    def remove_persistence(self, varname, author=None):
+        """
+        See :func:`ipcclientx.IPCClientX.remove_persistence`.
+
+        :rtype: AsyncResult
+        """
+        return self.submit('remove_persistence', varname, author)
+
+    @staticmethod
+    def gather(results, timeout=None):
+        """
+        Waits for the results of several calls.
+
+        :param results: The future results
+        :type results: list
+        :param timeout: *Optional keyword*. The most seconds to wait for each result, None to wait as long as needed
+        :type timeout: float
+        :return: The values, in the order of results. A call that raised raises here, and WaitTimeoutError is raised
+                 if a result is not ready in time.
+        :rtype: list
+        """
+        if timeout is not None:
+            for result in results:
+                if not result.wait(timeout):
+                    exc = ipcclientxerrors.WaitTimeoutError()
+                    exc.message = 'Timed out after {0} sec waiting for a call to the datastore'.format(timeout)
+                    raise exc
+        return [result.value for result in results]
+
+    def close(self):
+        """
+        Stops the workers once the calls already queued are carried out and closes their connections.
+
+        """
+        with self.__lock:
+            self.__closed = True
+            workers = self.__workers
+            self.__workers = []
+        for worker in workers:
+            self.__queue.put(AsyncWorker.STOP)
+        for worker in workers:
+            if worker is not threading.current_thread():
+                worker.join()
+        self.client.proxypool.closeall()
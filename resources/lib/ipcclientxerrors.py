@@ -25,6 +25,11 @@ IPCERROR_CONNECTION_CLOSED = 4
 IPCERROR_NONSERIALIZABLE = 5
 IPCERROR_SAVEFAILED = 6
 IPCERROR_RESTOREFAILED = 7
+IPCERROR_WAIT_TIMEOUT = 8
+IPCERROR_STREAM_NOT_FOUND = 9
+IPCERROR_NOT_STREAMABLE = 10
+IPCERROR_UPDATE_FAILED = 11
+IPCERROR_CONFLICT = 12
 
 
 class IPCClientError(Exception):
@@ -124,6 +129,55 @@ class RestoreFailedError(IPCClientError):
         self.message = 'Restore failed for author={0}, filename={1}'.format(author, fn)
 
 
+class WaitTimeoutError(IPCClientError):
+    """
+    Raised when the data waited for was not provided within the timeout
+    """
+    def __init__(self):
+        self.message = ''
+
+    def updatemessage(self, varname, author, timeout):
+        self.message = 'Timed out after {2} sec waiting for author={0}, var_name={1}'.format(author, varname, timeout)
+
+
+class StreamNotFoundError(IPCClientError):
+    """
+    Raised when a stream is used after it was closed or after the server dropped it for being idle
+    """
+    def __init__(self):
+        self.message = 'Stream closed or expired on the server'
+
+
+class NotStreamableError(IPCClientError):
+    """
+    Raised when a value that is not a str is read with get_stream
+    """
+    def __init__(self):
+        self.message = ''
+
+    def updatemessage(self, varname, author):
+        self.message = 'Only str values can be streamed, author={0}, var_name={1}'.format(author, varname)
+
+
+class UpdateFailedError(IPCClientError):
+    """
+    Raised when a partial update does not apply to the stored value, such as a dict operation on a list
+    """
+    def __init__(self):
+        self.message = ''
+
+    def updatemessage(self, varname, author, op):
+        self.message = 'Update {2} failed for author={0}, var_name={1}'.format(author, varname, op)
+
+
+class ConflictError(IPCClientError):
+    """
+    Reported when compare_and_set finds that the item was changed since the expected version
+    """
+    def __init__(self):
+        self.message = 'Item changed since the expected version'
+
+
 class UnknownError(IPCClientError):
     """
     Error otherwise not defined
@@ -17,35 +17,122 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+"""
+Stand-ins for the Kodi modules (xbmc, xbmcaddon, xbmcvfs and xbmcgui) so that the datastore, the client, the tests and
+the benchmarks can run outside of Kodi. Kodi's special:// paths map to ``xbmc.userdata`` and ``xbmc.home``, add-ons are
+looked up in ``xbmcaddon.addons_dir`` (the KODI_ADDONS environment variable, by default ~/.kodi/addons) and this
+add-on itself resolves to its own directory. Call :func:`install` before importing the modules that use them.
+"""
+
 import os
+import sys
+import time
+from xml.etree import ElementTree
 
 
 class xbmc(object):
-    LOGERROR = 2
+    LOGDEBUG = 0
+    LOGINFO = 1
+    LOGNOTICE = 2
+    LOGWARNING = 3
+    LOGERROR = 4
+    LOGSEVERE = 5
+    LOGFATAL = 6
+    LOGNONE = 7
+    abortRequested = False
+    if sys.platform.startswith('win'):
+        home = os.path.join(os.path.expanduser('~'), 'AppData', 'Roaming', 'XBMC')
+    else:
+        home = os.path.join(os.path.expanduser('~'), '.kodi')
+    userdata = os.path.join(home, 'userdata')
+    loglevel = LOGDEBUG
+
+    @staticmethod
+    def log(msg, level=LOGDEBUG):
+        if level >= xbmc.loglevel:
+            print msg
 
     @staticmethod
-    def log(msg, level=None):
-        print msg
+    def sleep(msec):
+        time.sleep(msec / 1000.0)
 
     @staticmethod
     def translatePath(path):
-        ret = path.replace(r'special://masterprofile', r'C:\Users\Ken User\AppData\Roaming\XBMC\userdata')
-        ret = ret.replace('/', '\\')
-        return ret
+        for special, real in (('special://masterprofile', xbmc.userdata), ('special://profile', xbmc.userdata),
+                              ('special://userdata', xbmc.userdata), ('special://home', xbmc.home),
+                              ('special://temp', os.path.join(xbmc.home, 'temp'))):
+            if path.startswith(special):
+                path = real + path[len(special):]
+                break
+        return path.replace('/', os.sep)
+
+    @staticmethod
+    def getCondVisibility(condition):
+        return False
+
+    @staticmethod
+    def getInfoLabel(label):
+        return ''
+
+    @staticmethod
+    def executebuiltin(function, wait=False):
+        pass
+
+    @staticmethod
+    def getLocalizedString(id):
+        return str(id)
 
 
 class AddOn(object):
     def __init__(self, name=''):
         if name == '':
-            name = 'ipcdatastore'
+            name = 'service.ipcdatastore'
         self.name = name
+        if name == 'service.ipcdatastore':
+            self.path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        else:
+            self.path = os.path.join(xbmcaddon.addons_dir, name)
+        self.__settings = xbmcaddon.settings.setdefault(name, self.__defaults())
+
+    def __defaults(self):
+        """
+        Reads the default values of the add-on's settings from its resources/settings.xml, if there is one.
+        """
+        settings = {}
+        try:
+            for setting in ElementTree.parse(os.path.join(self.path, 'resources', 'settings.xml')).iter('setting'):
+                if setting.get('id') is not None:
+                    settings[setting.get('id')] = setting.get('default', '')
+        except (IOError, OSError, ElementTree.ParseError):
+            pass
+        return settings
 
     def getAddonInfo(self, myid):
-        if myid == 'name':
+        if myid in ('name', 'id'):
             return self.name
+        elif myid == 'path':
+            return self.path
+        elif myid == 'profile':
+            return xbmc.translatePath('special://profile/addon_data/{0}/'.format(self.name))
+        elif myid == 'version':
+            return '0.0.0'
+        else:
+            return ''
+
+    def getSetting(self, id):
+        return self.__settings.get(id, '')
+
+    def setSetting(self, id, value):
+        self.__settings[id] = str(value)
+
+    def getLocalizedString(self, id):
+        return str(id)
 
 
 class xbmcaddon(object):
+    addons_dir = os.environ.get('KODI_ADDONS', os.path.join(xbmc.home, 'addons'))
+    settings = {}  # add-on id -> settings, shared by all AddOn instances as in Kodi
+
     @staticmethod
     def Addon(name=''):
         return AddOn(name)
@@ -61,4 +148,46 @@ class xbmcvfs(object):
 
     @staticmethod
     def mkdirs(path):
-        os.makedirs(path)
\ No newline at end of file
+        os.makedirs(path)
+
+    @staticmethod
+    def delete(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class Dialog(object):
+    def ok(self, heading, *lines):
+        xbmc.log('{0}: {1}'.format(heading, ' '.join(lines)))
+        return True
+
+    def yesno(self, heading, *lines, **kwargs):
+        xbmc.log('{0}: {1}'.format(heading, ' '.join(lines)))
+        return True
+
+    def notification(self, heading, message, *args, **kwargs):
+        xbmc.log('{0}: {1}'.format(heading, message))
+
+
+class xbmcgui(object):
+    Dialog = Dialog
+
+
+def install():
+    """
+    Makes the stand-ins importable as xbmc, xbmcaddon, xbmcvfs and xbmcgui, unless the real modules are available.
+
+    :return: True if the stand-ins were installed, False when running under Kodi
+    :rtype: bool
+    """
+    try:
+        import xbmc as real
+        return False
+    except ImportError:
+        pass
+    for module in (xbmc, xbmcaddon, xbmcvfs, xbmcgui):
+        sys.modules.setdefault(module.__name__, module)
+    return True
@@ -19,9 +19,14 @@
 
 import sys
 import os
+import gzip
+import mmap
+import cPickle
 import shutil
 import stat
+import tempfile
 import time
+import threading
 import unittest
 
 if 'win' in sys.platform:
@@ -46,7 +51,9 @@ import pyro4
 
 # required modules that should be in local path
 from resources.lib.ipcclientx import IPCClientX
-from resources.lib.datastore import DataObjects
+from resources.lib.ipcclientxasync import AsyncIPCClientX
+from resources.lib.datastore import DataObjects, DataObjectX, DataLog, LogWriter, Snapshot, DataIO, Metrics, \
+    SharedBlob
 import resources.lib.ipcclientxerrors as ipcclientxerrors
 
 # Globals
@@ -93,18 +100,302 @@ class TestIPCClient(unittest.TestCase):
         else:
             self.assertEqual(1, 2, 'Failed: data list returned in wrong format')
 
+    def test_wait_for(self):
+        ts = self.client.get('int', author=self.name, return_tuple=True).ts
+        t = threading.Timer(0.3, self.client.get_exposed_object().set, args=('int', 7, self.name))
+        t.start()
+        x = self.client.wait_for('int', author=self.name, newer_than=ts, timeout=5.0, return_tuple=True)
+        self.assertEqual(x.value, 7, msg='Failed to wait for new value')
+        self.client.raise_exception = True
+        ee = None
+        try:
+            self.client.wait_for('int', author=self.name, newer_than=x.ts, timeout=0.2)
+        except Exception as e:
+            ee = e
+        self.client.raise_exception = False
+        self.assertEqual(ee.__class__.__name__, ipcclientxerrors.WaitTimeoutError.__name__, msg='Failed to raise'
+                         ' WaitTimeoutError')
+        # waits longer than a single call are made of several calls
+        max_wait = IPCClientX.MAX_WAIT
+        IPCClientX.MAX_WAIT = 0.1
+        try:
+            t = threading.Timer(0.3, self.client.get_exposed_object().set, args=('int', 9, self.name))
+            t.start()
+            y = self.client.wait_for('int', author=self.name, newer_than=x.ts, timeout=5.0)
+        finally:
+            IPCClientX.MAX_WAIT = max_wait
+        self.assertEqual(y, 9, msg='Failed to wait across calls')
+
+    def test_get_data_list_author(self):
+        self.client.delete('tuple', author=self.name)
+        dl = self.client.get_data_list(self.name)
+        self.assertEqual(dl.keys(), [self.name], msg='Failed: data list contains other authors')
+        self.assertEqual('tuple' in dl[self.name], False, msg='Failed: author data list not updated on delete')
+        self.assertEqual(set(dl[self.name]) >= set(k for k in self.data if k != 'tuple'), True,
+                         msg='Failed: author data list incomplete')
+
+    def test_ttl(self):
+        self.client.set('ttl', 'short lived', author=self.name, ttl=0.3)
+        self.client.set('ttl_swept', 'short lived', author=self.name, ttl=0.3)
+        x = self.client.get('ttl', author=self.name, requestor='tests')
+        time.sleep(0.8)
+        y = self.client.get('ttl', author=self.name, requestor='tests')
+        self.client.set('ttl_deleted', 'short lived', author=self.name, ttl=0.3)
+        time.sleep(0.4)
+        z = self.client.delete('ttl_deleted', author=self.name)
+        self.client.set('ttl_counter', 0, author=self.name, ttl=60)
+        scheduled = self.client.expiry_stats()['scheduled']
+        for i in xrange(20):
+            self.client.incr('ttl_counter', author=self.name)
+        dl = self.client.get_data_list(self.name)[self.name]
+        stats = self.client.expiry_stats()
+        self.assertEqual(x, 'short lived', msg='Failed ttl before expiry')
+        self.assertIsNone(y, msg='Failed ttl after expiry')
+        self.assertIsNone(z, msg='Failed ttl delete after expiry')
+        self.assertNotIn('ttl_swept', dl, msg='Failed ttl sweeper')
+        self.assertGreaterEqual(stats['expired'], 2, msg='Failed ttl stats')
+        self.assertEqual(stats['scheduled'], scheduled, msg='Failed ttl rescheduling on incr')
+
     def test_delete(self):
         x = self.client.delete('tuple', author=self.name)
         self.assertEqual(x, self.data['tuple'], msg='Failed to return data on delete')
         x = self.client.get('tuple')
         self.assertEqual(x, None, msg='Failed to return None after delete')
 
+    def test_mget(self):
+        x = self.client.mget(self.data.keys() + ['garbage'], author=self.name, requestor='tests')
+        for key in self.data:
+            self.assertEqual(x[key], self.data[key], msg='Failed mget for: {0}'.format(key))
+        self.assertEqual(x['garbage'], None, msg='Failed mget for missing value')
+        x = self.client.mget([(self.name, 'int'), (self.name, 'str')], requestor='tests', return_tuple=True)
+        self.assertEqual(x[(self.name, 'int')].cached, True, msg='Failed to use cache in mget')
+
+    def test_mset_mdelete(self):
+        self.client.mset({'a': 1, (self.name, 'b'): 2}, author=self.name)
+        x = self.client.mdelete(['a', 'b', 'garbage'], author=self.name)
+        self.assertEqual(x, {'a': 1, 'b': 2, 'garbage': None}, msg='Failed mset/mdelete')
+
     def test_cache(self):
         x = self.client.get('str', author=self.name, requestor='tests', return_tuple=True)
         self.assertEqual(x.cached, False, msg='Failed due to value cached on first pass')
         x = self.client.get('str', author=self.name, requestor='tests', return_tuple=True)
         self.assertEqual(x.cached, True, msg='Failed to cache value')
 
+    def test_cache_bounded(self):
+        self.client.cache.max_entries = 2
+        self.client.use_conditional_get = False
+        for key in ('int', 'float', 'str'):
+            self.client.get(key, author=self.name, requestor='tests')
+        self.assertNotIn((self.name, 'int'), self.client.cache, msg='Failed to evict least recently used item')
+        # The server still believes 'tests' holds 'int'
+        x = self.client.get('int', author=self.name, requestor='tests', return_tuple=True)
+        self.assertEqual(x.value, self.data['int'], msg='Failed get of item evicted from the client cache')
+        self.assertEqual(x.cached, False, msg='Failed get of item evicted from the client cache')
+        self.client.cache.max_bytes = 10
+        self.client.get('str', author=self.name, requestor='tests')
+        self.client.set('big', 'x' * 100, author=self.name)
+        self.client.get('big', author=self.name, requestor='tests')
+        self.client.get('str', author=self.name, requestor='tests')
+        stats = self.client.cache_stats()
+        self.assertNotIn((self.name, 'big'), self.client.cache, msg='Failed to skip item larger than max_bytes')
+        self.assertLessEqual(stats['bytes'], 10, msg='Failed cache max_bytes')
+        self.assertEqual(stats['evictions'], 4, msg='Failed cache eviction count')
+        self.assertEqual(stats['hits'], 1, msg='Failed cache hit count')
+
+    def test_shared_blob(self):
+        big = 'artwork' * 50000
+        self.client.set('blob', big, author=self.name)
+        self.assertEqual(self.client.get('blob', author=self.name), big, msg='Failed shared blob value')
+        x = self.client.get('blob', author=self.name, return_tuple=True, mapped=True)
+        self.assertIsInstance(x.value, mmap.mmap, msg='Failed to map shared blob')
+        self.assertEqual(x.value[:], big, msg='Failed mapped shared blob value')
+        self.client.mset({'mblob': big + 'x'}, author=self.name)
+        dos = self.client.get_exposed_object()
+        item = dos.get('tests', 'mblob', self.name)
+        self.assertEqual(len(item), 4, msg='Failed server side shared blob')
+        self.assertEqual(dos.read_blob(item[2]), big + 'x', msg='Failed read_blob')
+        self.assertEqual(dos.read_blob('/etc/passwd'), chr(ipcclientxerrors.IPCERROR_NO_VALUE_FOUND),
+                         msg='Failed read_blob outside the blob directory')
+        self.client.set('blob', x.value, author=self.name)
+        y = self.client.get('blob', author=self.name, return_tuple=True)
+        self.assertGreater(y.ts, x.ts, msg='Failed to set mapped value')
+        self.assertEqual(y.value[:], big, msg='Failed to set mapped value')
+
+    def test_update(self):
+        self.client.set('videodata', {'title': 'a', 'playcount': 1}, author=self.name)
+        self.client.set('queue', [1, 2], author=self.name)
+        before = self.client.get('videodata', author=self.name, return_tuple=True)
+        self.assertTrue(self.client.set_field('videodata', 'playcount', 2, author=self.name), msg='Failed set_field')
+        self.client.merge('videodata', {'resume': 30, 'title': 'b'}, author=self.name)
+        self.client.delete_field('videodata', 'resume', author=self.name)
+        self.client.extend('queue', [3, 4, 5], author=self.name)
+        self.client.append('queue', 6, author=self.name)
+        self.client.trim('queue', 3, author=self.name)
+        after = self.client.get('videodata', author=self.name, return_tuple=True)
+        self.assertEqual(after.value, {'title': 'b', 'playcount': 2}, msg='Failed dict updates')
+        self.assertGreater(after.ts, before.ts, msg='Failed update timestamp')
+        self.assertEqual(before.value, {'title': 'a', 'playcount': 1}, msg='Failed update copy')
+        self.assertEqual(self.client.get('queue', author=self.name), [4, 5, 6], msg='Failed list updates')
+        self.assertFalse(self.client.append('videodata', 1, author=self.name), msg='Failed update type check')
+        self.assertFalse(self.client.append('garbage', 1, author=self.name), msg='Failed update of missing value')
+
+    def test_atomic(self):
+        self.client.delete('counter', author=self.name)
+        self.assertEqual(self.client.incr('counter', author=self.name), 1, msg='Failed incr of missing value')
+        self.assertEqual(self.client.incr('counter', 5, author=self.name), 6, msg='Failed incr')
+        self.assertEqual(self.client.decr('counter', author=self.name), 5, msg='Failed decr')
+        self.assertIsNone(self.client.incr('str', author=self.name), msg='Failed incr type check')
+        x = self.client.get('counter', author=self.name, return_tuple=True)
+        self.assertTrue(x.cached, msg='Failed to cache result of incr')
+
+        def worker():
+            c = IPCClientX()
+            for i in xrange(50):
+                c.incr('counter', author=self.name)
+
+        threads = [threading.Thread(target=worker) for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.client.get('counter', author=self.name), 205, msg='Failed concurrent incr')
+        self.assertTrue(self.client.compare_and_set('counter', 0, x.ts + 1, author=self.name) is False,
+                        msg='Failed compare_and_set conflict')
+        x = self.client.get('counter', author=self.name, return_tuple=True)
+        self.assertTrue(self.client.compare_and_set('counter', 0, x.ts, author=self.name), msg='Failed compare_and_set')
+        self.assertEqual(self.client.get('counter', author=self.name), 0, msg='Failed compare_and_set value')
+        self.assertEqual(self.client.setdefault('counter', 10, author=self.name), 0, msg='Failed setdefault existing')
+        self.client.delete('counter', author=self.name)
+        self.assertEqual(self.client.setdefault('counter', 10, author=self.name), 10, msg='Failed setdefault missing')
+
+    def test_metrics(self):
+        calls = []
+        self.client.reset_metrics()
+        self.client.metrics_hook = lambda *args: calls.append(args)
+        self.client.get('str', author=self.name)
+        self.client.get('str', author=self.name)
+        self.client.get('garbage', author=self.name)
+        self.client.metrics_hook = None
+        metrics = self.client.metrics()
+        m = metrics['operations']['get_if_modified']
+        self.assertEqual((m['calls'], m['cached'], m['errors']), (3, 1, 1), msg='Failed metrics counters')
+        self.assertEqual(metrics['errors'], {'VarNotFoundError': 1}, msg='Failed metrics error types')
+        self.assertGreaterEqual(metrics['cache']['hits'], 1, msg='Failed metrics cache hits')
+        self.assertEqual([call[0] for call in calls], ['get_if_modified'] * 3, msg='Failed metrics hook')
+        self.assertIsNone(calls[1][3], msg='Failed metrics hook cached copy is not an error')
+        c = IPCClientX(port=port + 1)
+        c.num_of_server_retries = 2
+        c.set('x', 1, author=self.name)
+        metrics = c.metrics()
+        self.assertEqual(metrics['retries'], 1, msg='Failed metrics retries')
+        self.assertEqual(metrics['errors'], {'ServerUnavailableError': 1}, msg='Failed metrics unavailable server')
+
+    def test_async(self):
+        client = AsyncIPCClientX(port=port, max_connections=2, max_pending=16)
+        try:
+            sets = [client.set('async{0}'.format(i), i, author=self.name) for i in xrange(50)]
+            client.gather(sets, timeout=10)
+            gets = [client.get('async{0}'.format(i), author=self.name) for i in xrange(50)]
+            self.assertEqual(client.gather(gets, timeout=10), range(50), msg='Failed async gets')
+            self.assertIsNone(client.get('garbage', author=self.name).value, msg='Failed async get missing value')
+            x = client.get('str', author=self.name, return_tuple=True).value
+            self.assertEqual(x.value, self.data['str'], msg='Failed async get return_tuple')
+            done = []
+            client.delete('async0', author=self.name).then(done.append).wait(10)
+            self.assertEqual(done, [0], msg='Failed async callback')
+            client.client.raise_exception = True
+            self.assertRaises(ipcclientxerrors.VarNotFoundError, lambda: client.get('async0', author=self.name).value)
+            failed = []
+            client.get('async0', author=self.name).iferror(failed.append).wait(10)
+            self.assertIsInstance(failed[0], ipcclientxerrors.VarNotFoundError, msg='Failed async error handler')
+
+            def raising(exc):
+                raise ValueError(exc)
+
+            x = client.get('async0', author=self.name).iferror(raising)
+            self.assertTrue(x.wait(10), msg='Failed async result after a raising error handler')
+            self.assertRaises(ipcclientxerrors.VarNotFoundError, lambda: x.value)
+            client.client.raise_exception = False
+            chained = []
+            x = client.get('async1', author=self.name)
+
+            def reentrant(value):
+                x.then(lambda v: chained.append(v) or v)
+                return value + 1
+
+            x.then(reentrant)
+            self.assertEqual(x.value, 2, msg='Failed async re-entrant callback')
+            self.assertEqual(chained, [2], msg='Failed async callback added by a callback')
+        finally:
+            client.close()
+        self.assertRaises(RuntimeError, client.get, 'str')
+
+    def test_scan(self):
+        author = 'tests.scan'
+        self.client.delete_data(author)
+        for name in ('player.video.fps', 'player.video.codec', 'player.audio.codec', 'skin.font'):
+            self.client.set(name, name.upper(), author=author)
+        page, cursor = self.client.scan('player.', author=author)
+        self.assertEqual(page, [(author, 'player.audio.codec'), (author, 'player.video.codec'),
+                                (author, 'player.video.fps')], msg='Failed scan prefix')
+        self.assertIsNone(cursor, msg='Failed scan end cursor')
+        page, cursor = self.client.scan(author=author, pattern='player.*.codec', values=True)
+        self.assertEqual(page, [((author, 'player.audio.codec'), 'PLAYER.AUDIO.CODEC'),
+                                ((author, 'player.video.codec'), 'PLAYER.VIDEO.CODEC')], msg='Failed scan glob')
+        page, cursor = self.client.scan(author=author, limit=3)
+        self.assertEqual(len(page), 3, msg='Failed scan limit')
+        page, cursor = self.client.scan(author=author, cursor=cursor, limit=3)
+        self.assertEqual(page, [(author, 'skin.font')], msg='Failed scan cursor')
+        self.client.delete('skin.font', author=author)
+        self.assertEqual([key[1] for key in self.client.iterscan(author=author, limit=1)],
+                         ['player.audio.codec', 'player.video.codec', 'player.video.fps'], msg='Failed iterscan')
+        names = [key[1] for key in self.client.iterscan('player.video.') if key[0] == author]
+        self.assertEqual(names, ['player.video.codec', 'player.video.fps'], msg='Failed scan of all authors')
+        self.client.delete_data(author)
+
+    def test_stream(self):
+        chunks = ['chunk{0:05d}'.format(i) * 1000 for i in xrange(50)]
+        self.assertTrue(self.client.set_stream('stream', iter(chunks), author=self.name), msg='Failed set_stream')
+        received = list(self.client.get_stream('stream', author=self.name, chunk_size=4096))
+        self.assertEqual(''.join(received), ''.join(chunks), msg='Failed get_stream value')
+        self.assertEqual(len(received[0]), 4096, msg='Failed get_stream chunk size')
+        stream = self.client.get_stream('stream', author=self.name)
+        next(stream)
+        stream.close()
+        self.client.raise_exception = True
+        try:
+            self.assertRaises(ipcclientxerrors.NotStreamableError, list, self.client.get_stream('int', author=self.name))
+        finally:
+            self.client.raise_exception = False
+
+    def test_conditional_get(self):
+        dos = self.client.get_exposed_object()
+        dos.set('cond', 5, self.name)
+        value, ts = dos.get_if_modified('cond', self.name)
+        self.assertEqual(value, 5, msg='Failed conditional get without timestamp')
+        x = dos.get_if_modified('cond', self.name, ts)
+        self.assertEqual(x, chr(ipcclientxerrors.IPCERROR_USE_CACHED_COPY), msg='Failed conditional get not modified')
+        dos.set('cond', 6, self.name)
+        x = dos.get_if_modified('cond', self.name, ts)
+        self.assertEqual(x[0], 6, msg='Failed conditional get after modification')
+
+    def test_subscribe(self):
+        accepted = set(pyro4.config.SERIALIZERS_ACCEPTED)
+        self.client.subscribe(['float'], author=self.name)
+        self.assertEqual(pyro4.config.SERIALIZERS_ACCEPTED, accepted, msg='Failed to leave accepted serializers alone')
+        self.client.get('float', author=self.name)
+        tmp = self.client.uri
+        self.client.uri = 'PYRO:kodi-IGA@localhost:9990'
+        x = self.client.get('float', author=self.name, return_tuple=True)
+        self.client.uri = tmp
+        self.assertEqual(x.cached, True, msg='Failed to serve subscribed value from cache')
+        self.assertEqual(x.value, self.data['float'], msg='Failed to serve subscribed value from cache')
+        self.client.get_exposed_object().set('float', 2.5, self.name)
+        time.sleep(0.5)
+        x = self.client.get('float', author=self.name, return_tuple=True)
+        self.client.unsubscribe()
+        self.assertEqual(x.value, 2.5, msg='Failed to invalidate subscribed value')
+
     def test_clearcache(self):
         x = self.client.get('int', author=self.name, requestor='tests', return_tuple=True)
         self.assertEqual(x.cached, False, msg='Failed due to value cached on first pass')
@@ -165,13 +456,100 @@ class TestIPCClient(unittest.TestCase):
         self.client.raise_exception = False
         self.client.uri = tmp
 
+    def test_connection_pool(self):
+        self.client.proxypool.closeall()
+        self.client.get('int', author=self.name, requestor='tests')
+        self.client.get('float', author=self.name, requestor='tests')
+        self.assertEqual(len(self.client.proxypool), 1, msg='Failed to reuse pooled connection')
+        self.client.use_connection_pool = False
+        x = self.client.get('int', author=self.name, requestor='tests', return_tuple=True)
+        self.client.use_connection_pool = True
+        self.assertEqual(x.value, self.data['int'], msg='Failed get without connection pool')
+
+    def test_connection_pool_threads(self):
+        # The server gives each open connection a worker thread of its own, the pool must not keep them all busy
+        numthreads = pyro4.config.THREADPOOL_SIZE + 2
+        got = []
+        done = threading.Event()
+
+        def worker():
+            got.append(IPCClientX().get('int', author=self.name))
+            done.wait(10)
+
+        threads = [threading.Thread(target=worker) for n in xrange(numthreads)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 10
+        while len(got) < numthreads and time.time() < deadline:
+            time.sleep(0.05)
+        done.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(got, [self.data['int']] * numthreads, msg='Failed gets from many threads')
+        self.assertLessEqual(len(self.client.proxypool), self.client.proxypool.max_proxies,
+                             msg='Failed to cap pooled connections')
+        self.client.proxypool.sweep()
+        self.assertLessEqual(len(self.client.proxypool), 1, msg='Failed to release connections of exited threads')
+        x = []
+        t = threading.Thread(target=lambda: x.append(IPCClientX().get('int', author=self.name)))
+        t.daemon = True
+        t.start()
+        t.join(5)
+        self.assertEqual(x, [self.data['int']], msg='Failed to serve a new client after many threads')
+
+    def test_concurrent_clients(self):
+        errors = []
+        shared = '{0}.shared'.format(self.name)
+        self.client.delete_data(shared)
+
+        def worker(n):
+            client = IPCClientX()
+            client.raise_exception = True
+            try:
+                for i in xrange(100):
+                    key = 'c{0}-{1}'.format(n, i % 10)
+                    client.set('s{0}-{1}'.format(n, i), i, author=shared)
+                    client.set(key, i, author=self.name)
+                    x = client.get(key, author=self.name, requestor='tests{0}'.format(n))
+                    if x != i:
+                        errors.append('{0}: {1} != {2}'.format(key, x, i))
+                    client.get_data_list(self.name)
+                    client.clearcache()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [], msg='Failed concurrent clients: {0}'.format(errors[:3]))
+        dl = self.client.get_data_list(self.name)[self.name]
+        missing = ['c{0}-{1}'.format(n, i) for n in xrange(8) for i in xrange(10) if 'c{0}-{1}'.format(n, i) not in dl]
+        self.assertEqual(missing, [], msg='Failed concurrent clients: lost updates')
+        # All threads added keys of one author at once, contending for the author index
+        dl = self.client.get_data_list(shared)[shared]
+        self.client.delete_data(shared)
+        self.assertEqual(len(dl), 800, msg='Failed concurrent clients: keys lost from a shared author')
+
+    def test_persistence_stats(self):
+        self.client.set('persist', 1, author=self.name, persist=True)
+        self.client.set('persist', 2, author=self.name, persist=True)
+        stats = self.client.persistence_stats()
+        self.client.remove_persistence('persist', author=self.name)
+        self.assertIn('queue_depth', stats, msg='Failed persistence stats')
+        self.assertGreaterEqual(stats['queued'], 2, msg='Failed persistence stats')
+
     def test_persistence(self):
         global server
         self.client.set('persist', 3.14159, author=self.name, persist=True)
+        self.client.get_exposed_object().close()
         server.stop()
         server = None
         server = IPCServer(DataObjects(persist_dir=persist_dir), port=port)
         server.start()
+        # connections opened before the restart are still served by the old datastore
+        self.client.proxypool.closeall()
         x = self.client.get('persist', author=self.name, requestor='tests')
         self.client.remove_persistence('persist', author=self.name)
         self.assertEqual(x, 3.14159, msg='Failed persistence bulk test')
@@ -180,15 +558,352 @@ class TestIPCClient(unittest.TestCase):
         global server
         self.client.set('persist', 3.14159, author=self.name, persist=True)
         self.client.get_exposed_object().setautosave(False)
+        # the persistence log is written in the background, a crash loses at most FLUSH_INTERVAL seconds of changes
+        time.sleep(2 * LogWriter.FLUSH_INTERVAL)
         server.stop()
         server = None
         server = IPCServer(DataObjects(persist_dir=persist_dir), port=port)
         server.start()
+        # connections opened before the restart are still served by the old datastore
+        self.client.proxypool.closeall()
         x = self.client.get('persist', author=self.name, requestor='tests')
         self.client.remove_persistence('persist', author=self.name)
         self.assertEqual(x, 3.14159, msg='Failed persistence backup test')
 
 
+class PersistDirTestCase(unittest.TestCase):
+    """
+    Base class of the tests that need a temporary persistence directory.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, DataLog.FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+
+class TestDataLog(PersistDirTestCase):
+    def test_replay(self):
+        log = DataLog(self.fn)
+        log.append(DataLog.OP_SET, ('a', 'x'), 1.0, 'one')
+        log.append(DataLog.OP_SET, ('a', 'y'), 2.0, [1, 2])
+        log.append(DataLog.OP_SET, ('a', 'x'), 3.0, 'three')
+        log.append(DataLog.OP_DELETE, ('a', 'y'))
+        log.close()
+        odict = {('b', 'z'): DataObjectX('old', True)}
+        self.assertEqual(DataLog.replay(self.fn, odict), 4, msg='Failed log replay count')
+        self.assertEqual(odict[('a', 'x')].value, 'three', msg='Failed log replay value')
+        self.assertEqual(odict[('a', 'x')].ts, 3.0, msg='Failed log replay ts')
+        self.assertNotIn(('a', 'y'), odict, msg='Failed log replay delete')
+        self.assertIn(('b', 'z'), odict, msg='Failed log replay existing')
+
+    def test_clear_truncate(self):
+        log = DataLog(self.fn)
+        log.append(DataLog.OP_SET, ('a', 'x'), 1.0, 'one')
+        log.append(DataLog.OP_CLEAR, ('', ''))
+        log.append(DataLog.OP_SET, ('a', 'y'), 2.0, 'two')
+        odict = {('b', 'z'): DataObjectX('old', True)}
+        DataLog.replay(self.fn, odict)
+        self.assertEqual(odict.keys(), [('a', 'y')], msg='Failed log replay clear')
+        log.truncate()
+        log.close()
+        self.assertEqual(DataLog.replay(self.fn, {}), 0, msg='Failed log truncate')
+
+    def test_torn_record(self):
+        log = DataLog(self.fn)
+        log.append(DataLog.OP_SET, ('a', 'x'), 1.0, 'one')
+        log.close()
+        record = DataLog.encode(DataLog.OP_SET, ('a', 'y'), 2.0, 'two')
+        with open(self.fn, 'ab') as f:
+            f.write(record[:-3])
+        odict = {}
+        self.assertEqual(DataLog.replay(self.fn, odict), 1, msg='Failed log torn record')
+        self.assertEqual(odict.keys(), [('a', 'x')], msg='Failed log torn record')
+
+    def test_corrupt_record(self):
+        good = DataLog.encode(DataLog.OP_SET, ('a', 'x'), 1.0, 'one')
+        bad = DataLog.encode(DataLog.OP_SET, ('a', 'y'), 2.0, 'two')
+        bad = bad[:-1] + chr(ord(bad[-1]) ^ 0xff)
+        with open(self.fn, 'wb') as f:
+            f.write(good + bad + good)
+        self.assertEqual(DataLog.replay(self.fn, {}), 1, msg='Failed log corrupt record')
+
+    def test_writer_coalesce(self):
+        writer = LogWriter(DataLog(self.fn), flush_interval=10.0)
+        writer.start()
+        for i in xrange(100):
+            writer.append(DataLog.OP_SET, ('a', 'x'), float(i), i)
+        writer.append(DataLog.OP_SET, ('a', 'y'), 1.0, 'y')
+        writer.flush()
+        stats = writer.stats()
+        writer.close()
+        self.assertEqual(stats['written'], 2, msg='Failed writer coalesce written')
+        self.assertEqual(stats['coalesced'], 99, msg='Failed writer coalesce count')
+        self.assertEqual(stats['queue_depth'], 0, msg='Failed writer coalesce queue depth')
+        odict = {}
+        DataLog.replay(self.fn, odict)
+        self.assertEqual(odict[('a', 'x')].value, 99, msg='Failed writer coalesce last write')
+
+    def test_writer_rotate(self):
+        writer = LogWriter(DataLog(self.fn), flush_interval=10.0)
+        writer.start()
+        writer.append(DataLog.OP_SET, ('a', 'x'), 1.0, 'old')
+        writer.append(DataLog.OP_SET, ('a', 'y'), 1.0, 'y')
+        writer.rotate()
+        writer.append(DataLog.OP_SET, ('a', 'x'), 2.0, 'new')
+        writer.close()
+        rotated = {}
+        DataLog.replay(DataLog.rotatedname(self.fn), rotated)
+        # the pending record for x was replaced by the newer one, which belongs to the new log
+        self.assertEqual(rotated.keys(), [('a', 'y')], msg='Failed writer rotate old log')
+        odict = {}
+        self.assertEqual(DataLog.replay(self.fn, odict), 1, msg='Failed writer rotate new log')
+        self.assertEqual(odict[('a', 'x')].value, 'new', msg='Failed writer rotate new log')
+
+    def test_writer_backpressure(self):
+        writer = LogWriter(DataLog(self.fn), max_pending=4, flush_size=100, flush_interval=10.0)
+        writer.start()
+        for i in xrange(20):
+            writer.append(DataLog.OP_SET, ('a', str(i)), 1.0, i)
+        writer.close()
+        stats = writer.stats()
+        self.assertGreater(stats['blocked'], 0, msg='Failed writer backpressure')
+        self.assertEqual(DataLog.replay(self.fn, {}), 20, msg='Failed writer backpressure records')
+
+
+
+class TestCompaction(PersistDirTestCase):
+    def test_compact(self):
+        dos = DataObjects(persist_dir=self.tmpdir)
+        for i in xrange(50):
+            dos.set('x', i, 'a', persist=True)
+        dos.set('y', 'y', 'a', persist=True)
+        self.assertTrue(dos.compact(), msg='Failed compact')
+        dos.set('x', 'after', 'a', persist=True)
+        stats = dos.persistence_stats()
+        dos.setautosave(False)
+        dos.close()
+        self.assertEqual(stats['compactions'], 1, msg='Failed compact count')
+        self.assertFalse(os.path.exists(DataLog.rotatedname(self.fn)), msg='Failed compact rotated log')
+        self.assertEqual(DataLog.replay(self.fn, {}), 1, msg='Failed compact log')
+        dos = DataObjects(persist_dir=self.tmpdir)
+        x = dos.get('tests', 'x', 'a')
+        y = dos.get('tests', 'y', 'a')
+        dos.close()
+        self.assertEqual(x[0], 'after', msg='Failed compact restore')
+        self.assertEqual(y[0], 'y', msg='Failed compact restore')
+
+
+class TestSnapshot(PersistDirTestCase):
+    def test_lazy_restore(self):
+        dos = DataObjects(persist_dir=self.tmpdir)
+        for i in xrange(20):
+            dos.set('v{0}'.format(i), range(i), 'a', persist=True)
+        used = dos.memory_stats()['used']
+        dos.set('temp', 1, 'a')
+        dos.close()
+        fn = os.path.join(self.tmpdir, Snapshot.FILENAME)
+        self.assertTrue(os.path.exists(fn), msg='Failed lazy restore save')
+        dos = DataObjects(persist_dir=self.tmpdir)
+        self.assertEqual(dos.memory_stats()['used'], used, msg='Failed lazy restore size accounting')
+        v5 = dos.get('tests', 'v5', 'a')
+        names = dos.get_data_list('a')['a']
+        startup = dos.persistence_stats()['startup']
+        dos.close()
+        self.assertEqual(v5[0], range(5), msg='Failed lazy restore value')
+        self.assertEqual(sorted(names), sorted(['v{0}'.format(i) for i in xrange(20)]), msg='Failed lazy restore keys')
+        self.assertEqual(startup['keys'], 20, msg='Failed lazy restore stats')
+        snapshot = Snapshot(fn)
+        offset = snapshot.index()[('a', 'v9')][1]
+        snapshot.close()
+        with open(fn, 'r+b') as f:
+            f.seek(offset)
+            f.write('\xff' * 4)
+        dos = DataObjects(persist_dir=self.tmpdir)
+        for i in xrange(50):
+            startup = dos.persistence_stats()['startup']
+            if 'warmup_time' in startup:
+                break
+            time.sleep(0.05)
+        v3 = dos.get('tests', 'v3', 'a')
+        dos.close()
+        self.assertEqual((startup['warmup_loaded'], startup['warmup_failed']), (19, 1), msg='Failed lazy restore warmup')
+        self.assertEqual(v3[0], range(3), msg='Failed lazy restore after warmup failure')
+
+
+class TestCodecs(PersistDirTestCase):
+    def test_codecs(self):
+        data = 'abc' * 1000
+        for codec in DataIO.CODECS:
+            for level in (1, 6, 9):
+                compressed = DataIO.compress(data, codec, level, threshold=0)
+                self.assertEqual(DataIO.decompress(compressed), data, msg='Failed codec {0}'.format(codec))
+        self.assertEqual(DataIO.compress('abc', 'zlib', threshold=10), '\x00abc', msg='Failed codec threshold')
+        self.assertRaises(ValueError, DataIO.decompress, '\xffabc')
+
+    def test_legacy_gzip(self):
+        fn = os.path.join(self.tmpdir, 'legacy.p')
+        output = gzip.open('{0}.gz'.format(fn), 'wb')
+        cPickle.dump({'x': 1}, output, -1)
+        output.close()
+        self.assertEqual(DataIO.restorepickle(fn), {'x': 1}, msg='Failed legacy gzip restore')
+        self.assertTrue(DataIO.savepickle(fn, {'x': 2}, codec='none'), msg='Failed codec save')
+        self.assertEqual(DataIO.restorepickle(fn), {'x': 2}, msg='Failed codec restore')
+
+
+class TestExpiry(PersistDirTestCase):
+    def test_ttl_persisted(self):
+        dos = DataObjects(persist_dir=self.tmpdir)
+        dos.set('short', 1, 'a', persist=True, ttl=0.3)
+        dos.set('long', 2, 'a', persist=True, ttl=60)
+        dos.close()
+        time.sleep(0.5)
+        dos = DataObjects(persist_dir=self.tmpdir)
+        short = dos.get('tests', 'short', 'a')
+        long = dos.get('tests', 'long', 'a')
+        dos.close()
+        self.assertEqual(short, chr(ipcclientxerrors.IPCERROR_NO_VALUE_FOUND), msg='Failed persisted ttl expiry')
+        self.assertEqual(long[0], 2, msg='Failed persisted ttl')
+
+
+class TestMemoryBudget(PersistDirTestCase):
+    def test_memory_budget(self):
+        dos = DataObjects(persist_dir=self.tmpdir, memory_budget=12000)
+        dos.set('kept', 'p' * 3000, 'a', persist=True)
+        for i in xrange(4):
+            dos.set('v{0}'.format(i), 'x' * 2000, 'a')
+        dos.get('tests', 'v0', 'a')
+        dos.set('big', 'y' * 2000, 'b')
+        names = dos.get_data_list()
+        stats = dos.memory_stats()
+        dos.close()
+        self.assertIn('kept', names['a'], msg='Failed memory budget persistent item evicted')
+        self.assertIn('v0', names['a'], msg='Failed memory budget recently used item evicted')
+        self.assertNotIn('v1', names['a'], msg='Failed memory budget least recently used item kept')
+        self.assertLessEqual(stats['used'], 12000, msg='Failed memory budget used')
+        self.assertEqual(stats['evicted'], 1, msg='Failed memory budget evicted')
+        self.assertEqual(stats['authors']['b'], 2000, msg='Failed memory budget author size')
+
+
+class TestRecords(PersistDirTestCase):
+    def test_slotted_records(self):
+        # A DataObjectX pickled by a version whose records had a __dict__
+        legacy = ("ccopy_reg\n_reconstructor\n(c{0}\nDataObjectX\nc__builtin__\nobject\nNtR(dS'ts'\nF1.5\n"
+                  "sS'value'\nS'old'\nsS'persist'\nI01\nsS'requestors'\n(dsb.").format(DataObjectX.__module__)
+        dox = cPickle.loads(legacy)
+        self.assertEqual((dox.value, dox.ts, dox.persist, dox.expires), ('old', 1.5, True, None),
+                         msg='Failed legacy record state')
+        self.assertFalse(hasattr(dox, '__dict__'), msg='Failed slotted record')
+        dos = DataObjects(persist_dir=self.tmpdir)
+        dos.set('x', [1, 2], 'a', persist=True)
+        dos.close()
+        dos = DataObjects(persist_dir=self.tmpdir)
+        fn = os.path.join(self.tmpdir, 'saved.p')
+        dos.savedata('a', fn)
+        dos.close()
+        saved = DataIO.restorepickle(fn)[('a', 'x')]
+        self.assertIs(type(saved), DataObjectX, msg='Failed lazy record pickled as DataObjectX')
+        self.assertEqual(saved.value, [1, 2], msg='Failed lazy record pickled value')
+
+
+class TestBlobs(PersistDirTestCase):
+    def test_blob_persisted(self):
+        dos = DataObjects(persist_dir=self.tmpdir, blob_threshold=100)
+        dos.set('big', 'b' * 1000, 'a', persist=True)
+        item = dos.get('tests', 'big', 'a')
+        directory = dos.blob_dir()
+        self.assertEqual(len(item), 4, msg='Failed blob threshold')
+        self.assertEqual(dos.memory_stats()['used'], 1000, msg='Failed blob size accounting')
+        self.assertTrue(dos.compact(), msg='Failed blob compact')
+        pinned = SharedBlob(item[2], item[3]).pin()
+        os.remove(item[2])
+        self.assertEqual(SharedBlob.plain(pinned), 'b' * 1000, msg='Failed pinned blob')
+        dos.close()
+        self.assertFalse(os.path.exists(directory), msg='Failed blob directory removal')
+        dos = DataObjects(persist_dir=self.tmpdir, blob_threshold=None)
+        item = dos.get('tests', 'big', 'a')
+        dos.close()
+        self.assertEqual(item[0], 'b' * 1000, msg='Failed persisted blob')
+
+
+class TestStreams(PersistDirTestCase):
+    def test_stream_memory(self):
+        for threshold in (None, 100):
+            dos = DataObjects(blob_threshold=threshold)
+            sid = dos.set_stream('x', 'a', persist=False)
+            for i in xrange(10):
+                dos.write_stream(sid, str(i) * 100)
+            self.assertEqual(dos.close_stream(sid), True, msg='Failed close_stream')
+            sid, ts, length = dos.get_stream('x', 'a', 300)
+            dos.set('x', 'replaced', 'a')
+            chunks = []
+            while True:
+                chunk = dos.read_stream(sid)
+                if not chunk:
+                    break
+                chunks.extend(chunk)
+            self.assertEqual(''.join(chunks), ''.join(str(i) * 100 for i in xrange(10)), msg='Failed stream value')
+            self.assertEqual(length, 1000, msg='Failed stream length')
+            self.assertEqual(dos.read_stream(sid), chr(ipcclientxerrors.IPCERROR_STREAM_NOT_FOUND),
+                             msg='Failed stream closed at end')
+            dos.close()
+
+
+class TestUpdates(PersistDirTestCase):
+    def test_update_persisted(self):
+        dos = DataObjects(persist_dir=self.tmpdir)
+        dos.set('d', {'a': 1}, 'a', persist=True, ttl=60)
+        used = dos.memory_stats()['used']
+        ts = dos.update('d', 'a', 'set_field', ('b', 'x' * 100))
+        self.assertGreater(dos.memory_stats()['used'], used + 100, msg='Failed update size accounting')
+        self.assertEqual(dos.update('d', 'a', 'trim', (1,)), chr(ipcclientxerrors.IPCERROR_UPDATE_FAILED),
+                         msg='Failed update type check')
+        dos.close()
+        dos = DataObjects(persist_dir=self.tmpdir)
+        value, restored = dos.get('tests', 'd', 'a')
+        dos.close()
+        self.assertEqual(value, {'a': 1, 'b': 'x' * 100}, msg='Failed persisted update')
+        self.assertEqual(restored, ts, msg='Failed persisted update timestamp')
+
+
+class TestServerStats(PersistDirTestCase):
+    def test_stats(self):
+        lines = []
+        dos = DataObjects(persist_dir=self.tmpdir, stats_interval=0.05, stats_log=lines.append)
+        dos.set('kept', 1, 'a', persist=True)
+        dos.set('x', 2, 'a')
+        x = dos.get_if_modified('x', 'a')
+        dos.get_if_modified('x', 'a', x[1])
+        dos.get_if_modified('missing', 'a')
+        dos.mget('tests', [('a', 'x'), ('a', 'kept')])
+        dos.mget('tests', [('a', 'x'), ('a', 'kept')])
+        dos.set('code', chr(ipcclientxerrors.IPCERROR_USE_CACHED_COPY), 'a')
+        sid = dos.get_stream('code', 'a', 1)[0]
+        dos.read_stream(sid)
+        time.sleep(0.2)
+        stats = dos.stats()
+        dos.remove_persistence('kept', 'a')
+        persisted = dos.stats()['persisted_keys']
+        dos.close()
+        self.assertEqual((stats['keys'], stats['persisted_keys'], persisted), (3, 1, 0), msg='Failed stats keys')
+        m = stats['methods']['get_if_modified']
+        self.assertEqual((m['calls'], m['cached'], m['errors']), (3, 1, 1), msg='Failed stats counters')
+        self.assertEqual(stats['methods']['mget']['cached'], 2, msg='Failed stats batch cached')
+        r = stats['methods']['read_stream']
+        self.assertEqual((r['cached'], r['errors']), (0, 0), msg='Failed stats value taken for a message code')
+        self.assertNotIn('get', stats['methods'], msg='Failed stats nested calls counted')
+        self.assertEqual(sum(count for upper, count in m['histogram']), 3, msg='Failed stats histogram')
+        self.assertLessEqual(m['p50'], m['p99'], msg='Failed stats percentiles')
+        self.assertGreaterEqual(m['p99'] * 1.25, m['max'], msg='Failed stats percentiles')
+        self.assertTrue(any('get_if_modified 3 calls' in line for line in lines), msg='Failed stats log dump')
+        for seconds in (1e-7, 1e-6, 3.3e-5, 0.01, 2.5):
+            bucket = Metrics.bucket(seconds)
+            self.assertLessEqual(seconds, Metrics.upper(bucket), msg='Failed stats bucket')
+            self.assertLessEqual(Metrics.upper(bucket), max(seconds * 1.25, 1e-6) * (1 + 1e-9),
+                                 msg='Failed stats bucket')
+
+
 def runtests():
     global server, persist_dir, port
     default_dir_mod = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
@@ -237,7 +952,10 @@ def runtests():
     try:
         with open(fn, 'a') as logf:
             logf.write('\n\nTests Started: {0}\n'.format(time.strftime('%x %I:%M %p %Z')))
-            suite = unittest.TestLoader().loadTestsFromTestCase(TestIPCClient)
+            loader = unittest.TestLoader()
+            cases = (TestIPCClient, TestDataLog, TestCompaction, TestSnapshot, TestCodecs, TestExpiry, TestMemoryBudget,
+                     TestRecords, TestBlobs, TestStreams, TestUpdates, TestServerStats)
+            suite = unittest.TestSuite([loader.loadTestsFromTestCase(case) for case in cases])
             unittest.TextTestRunner(stream=logf, verbosity=2).run(suite)
         server.stop()
     except Exception as e: